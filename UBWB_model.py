@@ -1,244 +1,1665 @@
-"""
-Python 3
-NOTE: This code has errors at boundary cases and certainly has undetected errors
-	  Use at your own risk.
-	  
-Title: Upper Basin Water Balance Model
-Author: Ben Harding, bharding@lynker.com
-Source:
-License: CC BY-SA 4.0, https://creativecommons.org/licenses/by-sa/4.0/
-
-Program to simulate the Upper Basin of the Colorado River using the approach
-of the 2007 USBR Hydrologic Determination method (2007HD).
-
- Author: Ben Harding, 2010
- 1-14-2010 CRWAS ensemble method
- 9-22-2019 Single-trace method
- 9-26-2019 refactoring:    1 make trace method module w/ integral validataion
-                           2 use pandas
- 4-25-2024 Added variable for accumulation period for Lee Ferry non-depletion
-           obligation.  
- 6-17-2024 Added code to simulate a trigger system
- 6-20-2024 Added code to use 'UB demand' time series if present in input_data
- 7-2-2024 Added code to eliminate negative shortages when demand is set
-          less than PPR amount. This has happened in an automated yield 
-          determination but it should not happen in a real case. But, JIC.
- 8-11-2024 Added code to check mass balance
- 10-29-2024 Added code to reduce UB_depletions when inflows are insufficient
-            This happens in 1977 and 2002 with 2007HD UB demands.
- 11-12-2024 Refactored into three modules, HD_model.py, HD_model_utilties.py
-            and HD_model_test.py
- 12-2-2024 Modifications to be consistent with paper:
-            default UB demand = 5.76
-            Use high-level storage options, 'active' and 'live'
-
-"""
-
-import pandas as pd
-#import HD_model_utilities as HDu
-
-TOLERANCE = 5 # acre-feet criterion for closure of evaporation solution
-MAX_TRIALS = 5
-LIVE_CAPACITY = 33833590
-ACTIVE_CAPACITY = 29530030
-MEXICO_SHARE = 750000
-
-"""
-The evaporation functions return reservoir evaporation as a function
-of reservoir contents. Developed using regression against HD 2007 outputs.
-The equations differ from equations called out in HD 2007 text.  USBR seems 
-to base evap on total storage, even though they say they base it on CRSP 
-storage. These equations result from regression against total storage,
-using the average of start & end reservoir contents.
-"""
-def active_evap(reservoir_contents):
-    '''Use when simulating active capacity'''
-    return int(round(0.020874 * reservoir_contents + 132877, 0))
-
-def live_evap(reservoir_contents):
-    '''Use when simulating live capacity.'''
-    return(int(round(0.021292*reservoir_contents+5017,0)))
-    
-reservoir_models = {
-    'active':(active_evap,ACTIVE_CAPACITY),
-    'live': (live_evap,LIVE_CAPACITY)
-    }
-
-def mor_release(lf_ann_q, lf_deficit, *args):
-    """
-    Minimum Objective Release as in LROC
-    but values other than 8.23 can be provided.
-    """ 
-    return max(lf_ann_q, lf_deficit)
-
-
-def no_mor_release(lf_ann_q, lf_deficit, *args):
-    """
-    Release the compact deficit 
-    """
-    return lf_deficit
-
-
-def trigger_cutback(res_capacity, res_contents, ub_non_ppr_depls):
-    """
-    An arbitrary trigger scheme based on reservoir contents
-    used for sensitivity analysis of the efficacy of triggers.
-    
-    Returns the amount to cut back Upper Basin beneficial use.
-    """
-    state = res_contents / float(res_capacity)
-    if state > 0.33:
-        return 0
-    elif state > 0.25:
-        return 0.1 * ub_non_ppr_depls
-    elif state > 0.15:
-        return 0.2 * ub_non_ppr_depls
-    elif state > 0.1:
-        return 0.4 * ub_non_ppr_depls
-    else:
-        return 0.7 * ub_non_ppr_depls
-
-
-def simulate_trace(input_data, start_contents=None, res_model='active',
-                   lees_ferry_ann_q=8230000, nyrs=10,
-                   lees_ferry_n_year_record=None,
-                   lf_release=mor_release, ub_demand=5760000,
-                   ppr_volume=2267000, trigger_func=None):
-    """
-    Simulate water balance in the Upper Basin.
-    start_contents default to full.  If user-entered value is greater than
-        capacity, start_contents is set to full, if negative set to 0.
-    res_model is either 'active' (default) or 'live'
-    input_data is expected to be a pandas dataframe with one row for each
-        year and with columns "year" and "flow", at a minimum.  If input_data
-        contains a column "UB demand" that column is expected to contain
-        an annual time series of Upper Basin demand for consumptive use. 
-        This can be used for validation or other analyses, but it has not
-        been tested. Any other columns in input_data are ignored.
-    """
-    # initialize parameters
-    if lees_ferry_n_year_record is None:
-        lees_ferry_n_year_record = nyrs * [lees_ferry_ann_q]
-    lees_ferry_cum_q = nyrs * lees_ferry_ann_q
-    if res_model not in reservoir_models.keys():
-        print('ERROR: Unknown reservoir model')
-        return None
-    evaporation, reservoir_capacity = reservoir_models[res_model]
-    if not start_contents:
-        start_contents = reservoir_capacity
-    else:
-        start_contents = max(min(start_contents,reservoir_capacity),0)
-    input_data = input_data.copy(deep=True)
-    if 'UB demand' not in input_data.columns:
-        input_data['UB demand'] = ub_demand
-
-    outputs = pd.DataFrame(columns=[
-        "year", "inflow", "start_con", 'trgr_cut', "UB_dmd", "evap",
-        "net_avail", "spill", "curtailment", "end_con", "UB_BU", "UB_CU",
-        f"LF_{nyrs}yr_flows", "LF_deficit", "LF_flow", "time_from_reset",
-        "evap_trials"
-    ])
-
-    time_from_reset = 0
-
-    for index, row in input_data.iterrows():
-        inflow = row["flow"]
-        year = row["year"]
-        outputs.loc[index, "year"] = year
-        outputs.loc[index, "inflow"] = inflow
-        outputs.loc[index, "start_con"] = start_contents
-
-        ub_depletions = row['UB demand']
-        if trigger_func:
-            cutback = trigger_func(reservoir_capacity, start_contents,
-                                   ub_depletions - ppr_volume)
-            outputs.loc[index, 'trgr_cut'] = cutback
-            ub_depletions -= cutback
-        # For the case where inflows are less than Upper Basin demand
-        ub_depletions = min(inflow, ub_depletions)
-        outputs.loc[index, "UB_dmd"] = ub_depletions
-        
-        # Look back nyrs-1 years
-        lees_ferry_n_year_record.pop()  
-        # in order to calculate this year's flow requirement
-        lees_ferry_deficit = max(0, 
-                                (lees_ferry_cum_q 
-                                 - sum(lees_ferry_n_year_record))
-                                )
-        
-        outputs.loc[index, "LF_deficit"] = lees_ferry_deficit
-        lf_target = lf_release(lees_ferry_ann_q, lees_ferry_deficit)
-
-        depleted_inflow = inflow - ub_depletions
-        evap = evaporation(start_contents)
-        evap_trial = 0
-
-        while True:
-            evap_trial += 1
-            trial_evap = evap
-            available_to_store = (depleted_inflow
-                                  + start_contents
-                                  - lf_target
-                                  - trial_evap)
-            
-            trial_contents = max(
-                                 min(available_to_store, reservoir_capacity),
-                                 0)
-            
-            evap = evaporation((start_contents + trial_contents) / 2)
-
-            if abs(trial_evap - evap) < TOLERANCE or evap_trial > MAX_TRIALS:
-                break
-
-        end_contents = trial_contents
-        outputs.loc[index, "evap_trials"] = evap_trial
-        outputs.loc[index, "evap"] = evap
-        outputs.loc[index, "end_con"] = end_contents
-        outputs.loc[index, "net_avail"] = available_to_store
-
-        spill = max(available_to_store - reservoir_capacity, 0)
-        outputs.loc[index, "spill"] = spill
-        
-        # Address case where inflows are less than PPR volume
-        ppr_supply = min(ppr_volume, inflow - evap)
-        
-        # Curtail by the shortfall meeting LF target
-        # or the amount of non-PPR use, whichever is less
-        curtailment = min(-min(available_to_store, 0),
-                          ub_depletions 
-                          - min(ub_depletions, ppr_supply))
-        
-        outputs.loc[index, "curtailment"] = curtailment
-        
-        # Calculate the water balance to determine the flow at Lee Ferry,
-        # which is the release from the reservoir
-        lees_ferry_flow = int(round(depleted_inflow
-                                    + start_contents 
-                                    - end_contents 
-                                    - evap 
-                                    + curtailment, -1))
-        
-        lees_ferry_n_year_record.insert(0, lees_ferry_flow)
-        outputs.loc[index, "LF_flow"] = lees_ferry_flow
-        outputs.loc[index, f"LF_{nyrs}yr_flows"] = sum(lees_ferry_n_year_record)
-
-        ub_bu = int(round(ub_depletions - curtailment, 0))
-        ub_cu = int(round(ub_bu + evap, 0))
-        outputs.loc[index, "UB_BU"] = ub_bu
-        outputs.loc[index, "UB_CU"] = ub_cu
-           
-        # If we have a curtailment, how long has it been from the last 
-        # spill or curtailment?
-        if (int(round(curtailment))!= 0):
-            if time_from_reset > 0:
-                outputs.at[index,"time_from_reset"] = time_from_reset
-            time_from_reset = 0
-        elif (spill != 0):
-            time_from_reset = 0
-        else:
-            time_from_reset += 1            
-
-        start_contents = end_contents
-
-    return outputs
-    
+"""
+Python 3
+NOTE: This code has errors at boundary cases and certainly has undetected errors
+	  Use at your own risk.
+	  
+Title: Upper Basin Water Balance Model
+Author: Ben Harding, bharding@lynker.com
+Source:
+License: CC BY-SA 4.0, https://creativecommons.org/licenses/by-sa/4.0/
+
+Program to simulate the Upper Basin of the Colorado River using the approach
+of the 2007 USBR Hydrologic Determination method (2007HD).
+
+ Author: Ben Harding, 2010
+ 1-14-2010 CRWAS ensemble method
+ 9-22-2019 Single-trace method
+ 9-26-2019 refactoring:    1 make trace method module w/ integral validataion
+                           2 use pandas
+ 4-25-2024 Added variable for accumulation period for Lee Ferry non-depletion
+           obligation.  
+ 6-17-2024 Added code to simulate a trigger system
+ 6-20-2024 Added code to use 'UB demand' time series if present in input_data
+ 7-2-2024 Added code to eliminate negative shortages when demand is set
+          less than PPR amount. This has happened in an automated yield 
+          determination but it should not happen in a real case. But, JIC.
+ 8-11-2024 Added code to check mass balance
+ 10-29-2024 Added code to reduce UB_depletions when inflows are insufficient
+            This happens in 1977 and 2002 with 2007HD UB demands.
+ 11-12-2024 Refactored into three modules, HD_model.py, HD_model_utilties.py
+            and HD_model_test.py
+ 12-2-2024 Modifications to be consistent with paper:
+            default UB demand = 5.76
+            Use high-level storage options, 'active' and 'live'
+ 10-17-2026 simulate_trace runs on preallocated NumPy arrays and builds
+            its DataFrame once, rather than writing cells with .loc
+            Added simulate_ensemble to step many traces together
+            Added optional numba-compiled engine
+            Added closed-form evaporation solution for linear models
+            Lee Ferry record kept by LeeFerryAccumulator, which can also
+            report alternative accumulation periods
+            Added stop_curtailment for early exit in yield searches
+            Added simulate_ism for Index Sequential Method runs
+            Added simulate_stream to run traces of any length in blocks
+            Added RunStats instrumentation
+            Added RunState so runs can continue from a saved year
+            Added TriggerPolicy tables and simulate_policies
+            pandas and numba are imported when first needed, so importing
+            this module, and UBWB_model_cli, needs only NumPy
+
+"""
+
+import hashlib
+import importlib
+import itertools
+import json
+import time
+
+import numpy as np
+# pandas is imported by the functions that return DataFrames, and numba
+# when the numba engine is first used, to keep this module quick to import
+#import HD_model_utilities as HDu
+
+TOLERANCE = 5 # acre-feet criterion for closure of evaporation solution
+MAX_TRIALS = 5
+LIVE_CAPACITY = 33833590
+ACTIVE_CAPACITY = 29530030
+MEXICO_SHARE = 750000
+
+"""
+The evaporation functions return reservoir evaporation as a function
+of reservoir contents. Developed using regression against HD 2007 outputs.
+The equations differ from equations called out in HD 2007 text.  USBR seems 
+to base evap on total storage, even though they say they base it on CRSP 
+storage. These equations result from regression against total storage,
+using the average of start & end reservoir contents.
+"""
+def active_evap(reservoir_contents):
+    '''Use when simulating active capacity'''
+    return int(round(0.020874 * reservoir_contents + 132877, 0))
+
+def live_evap(reservoir_contents):
+    '''Use when simulating live capacity.'''
+    return(int(round(0.021292*reservoir_contents+5017,0)))
+    
+reservoir_models = {
+    'active':(active_evap,ACTIVE_CAPACITY),
+    'live': (live_evap,LIVE_CAPACITY)
+    }
+
+# Slope and intercept of the evaporation functions that are linear in
+# contents.  Used to evaluate them on arrays of reservoir contents.
+linear_evaporation = {
+    active_evap: (0.020874, 132877),
+    live_evap: (0.021292, 5017)
+    }
+
+# How the end-of-year evaporation is found.  'iterative' is the fixed-point
+# iteration of the 2007HD method.  'closed_form' solves the linear models in
+# linear_evaporation directly and falls back to iteration for other
+# evaporation functions.  'validate' is 'closed_form' that also runs the
+# iteration and reports the difference in an 'evap_delta' output.
+EVAP_SOLVERS = ('iterative', 'closed_form', 'validate')
+
+def closed_form_evap(slope, intercept, start_contents, available,
+                     reservoir_capacity):
+    """
+    Evaporation from a reservoir whose evaporation is linear in the average
+    of start and end contents, without iteration.
+    available is the water available to store before evaporation is taken
+    out; end contents are available - evaporation, kept between 0 and
+    capacity.  Rounded to acre-feet, as the evaporation functions are.
+    """
+    evap = ((slope * (start_contents + available) / 2 + intercept)
+            / (1 + slope / 2))
+    if available - evap < 0:
+        # Reservoir empties
+        evap = slope * start_contents / 2 + intercept
+    elif available - evap > reservoir_capacity:
+        # Reservoir fills
+        evap = slope * (start_contents + reservoir_capacity) / 2 + intercept
+    return int(round(evap))
+
+def mor_release(lf_ann_q, lf_deficit, *args):
+    """
+    Minimum Objective Release as in LROC
+    but values other than 8.23 can be provided.
+    """ 
+    return max(lf_ann_q, lf_deficit)
+
+
+def no_mor_release(lf_ann_q, lf_deficit, *args):
+    """
+    Release the compact deficit 
+    """
+    return lf_deficit
+
+
+def trigger_cutback(res_capacity, res_contents, ub_non_ppr_depls):
+    """
+    An arbitrary trigger scheme based on reservoir contents
+    used for sensitivity analysis of the efficacy of triggers.
+    
+    Returns the amount to cut back Upper Basin beneficial use.
+    """
+    state = res_contents / float(res_capacity)
+    if state > 0.33:
+        return 0
+    elif state > 0.25:
+        return 0.1 * ub_non_ppr_depls
+    elif state > 0.15:
+        return 0.2 * ub_non_ppr_depls
+    elif state > 0.1:
+        return 0.4 * ub_non_ppr_depls
+    else:
+        return 0.7 * ub_non_ppr_depls
+
+
+class TriggerPolicy:
+    """
+    A trigger scheme declared as a table of storage thresholds and cutback
+    fractions, for use as trigger_func.
+
+    thresholds are increasing fractions of reservoir capacity.  Contents
+    at or below thresholds[k], and above any lower threshold, cut back
+    fractions[k] of Upper Basin non-PPR depletions; contents above the
+    last threshold cut back fractions[-1], normally 0.
+    A policy is evaluated with np.searchsorted, so it takes whole arrays of
+    contents at once and simulate_ensemble does not call it trace by trace.
+
+    TriggerPolicy.stack combines several policies, one row per trace, for
+    evaluating candidate policies in one ensemble run, as simulate_policies
+    does.  A stacked policy takes one contents value per row, so cannot be
+    used with simulate_trace; it raises ValueError for other contents.
+
+    name labels the policy in sweep tables and output metadata, as a
+    function's __name__ does, and defaults to a name built from the table.
+    to_dict and from_dict convert a policy to and from JSON types.
+    """
+
+    def __init__(self, thresholds, fractions, name=None):
+        thresholds = np.asarray(thresholds, dtype=np.float64)
+        fractions = np.asarray(fractions, dtype=np.float64)
+        if fractions.shape[-1] != thresholds.shape[-1] + 1:
+            raise ValueError('need one more fraction than thresholds')
+        with np.errstate(invalid='ignore'):     # padding is infinite
+            if (np.diff(thresholds, axis=-1) <= 0).any():
+                raise ValueError('thresholds must increase')
+        self.thresholds = thresholds
+        self.fractions = fractions
+        if name is None:
+            name = (f'TriggerPolicy({thresholds.tolist()}, '
+                    f'{fractions.tolist()})')
+        self.name = name
+        # Code that names trigger functions by __name__ names policies too
+        self.__name__ = name
+
+    def __eq__(self, other):
+        return (isinstance(other, TriggerPolicy)
+                and self.name == other.name
+                and np.array_equal(self.thresholds, other.thresholds)
+                and np.array_equal(self.fractions, other.fractions))
+
+    def __hash__(self):
+        return hash(self.name)
+
+    def __repr__(self):
+        return self.name
+
+    def cache_tag(self):
+        """Hash of the policy's table, identifying it in run caches."""
+        digest = hashlib.blake2b(digest_size=20)
+        for table in (self.thresholds, self.fractions):
+            digest.update(f'{table.shape}'.encode())
+            digest.update(np.ascontiguousarray(table).tobytes())
+        return digest.hexdigest()
+
+    def to_dict(self):
+        """The policy as a dict of JSON types."""
+        return {'name': self.name,
+                'thresholds': self.thresholds.tolist(),
+                'fractions': self.fractions.tolist()}
+
+    @classmethod
+    def from_dict(cls, values):
+        """A policy from the dict returned by to_dict."""
+        return cls(values['thresholds'], values['fractions'],
+                   values.get('name'))
+
+    @classmethod
+    def stack(cls, policies, repeats=1):
+        """
+        Policy applying policies[k] to rows k * repeats to
+        (k + 1) * repeats - 1 of an ensemble.
+        """
+        width = max(len(policy.thresholds) for policy in policies)
+        thresholds = np.full((len(policies), width), np.inf)
+        fractions = np.zeros((len(policies), width + 1))
+        for k, policy in enumerate(policies):
+            # Padding thresholds are infinite, so never reached
+            n = len(policy.thresholds)
+            thresholds[k, :n] = policy.thresholds
+            fractions[k, :n + 1] = policy.fractions
+        return cls(np.repeat(thresholds, repeats, axis=0),
+                   np.repeat(fractions, repeats, axis=0))
+
+    def __call__(self, res_capacity, res_contents, ub_non_ppr_depls):
+        """
+        Amount to cut back Upper Basin beneficial use, a float or an array
+        like res_contents.
+        """
+        state = np.asarray(res_contents) / float(res_capacity)
+        if self.thresholds.ndim == 1:
+            bands = np.searchsorted(self.thresholds, state)
+            fraction = self.fractions[bands]
+        else:
+            # One table per trace: count the thresholds below each state
+            if state.shape != self.thresholds.shape[:1]:
+                raise ValueError('stacked policy needs one contents value '
+                                 'per row')
+            bands = (self.thresholds < state[:, None]).sum(axis=1)
+            fraction = self.fractions[np.arange(len(bands)), bands]
+        if fraction.ndim == 0:
+            # As trigger_cutback, no cutback is the integer 0
+            return 0 if fraction == 0 else fraction.item() * ub_non_ppr_depls
+        return fraction * ub_non_ppr_depls
+
+
+# trigger_cutback as a table
+TRIGGER_CUTBACK_POLICY = TriggerPolicy([0.1, 0.15, 0.25, 0.33],
+                                       [0.7, 0.4, 0.2, 0.1, 0],
+                                       'TRIGGER_CUTBACK_POLICY')
+
+
+class LeeFerryAccumulator:
+    """
+    Rolling record of annual Lee Ferry flows with a running sum for each of
+    one or more compact accumulation windows, e.g. the 10-year obligation
+    alongside 5, 15 or 20-year alternatives.  Appending a year and reading
+    a sum or deficit cost the same however long the windows are.
+    """
+
+    def __init__(self, lees_ferry_ann_q, windows, record=None):
+        """
+        windows are accumulation periods in years.
+        record holds the Lee Ferry flows of the years before the simulation,
+            most recent first.  Years not in record are taken to have had
+            lees_ferry_ann_q.
+        """
+        self.lees_ferry_ann_q = lees_ferry_ann_q
+        self.windows = sorted(set(windows))
+        length = self.windows[-1]
+        history = [] if record is None else list(record)[:length]
+        history += (length - len(history)) * [lees_ferry_ann_q]
+        self._flows = history[::-1]     # oldest first
+        self._next = 0                  # slot of the oldest year
+        self._sums = {window: sum(history[:window])
+                      for window in self.windows}
+
+    def total(self, window):
+        """Lee Ferry flow over the last window years."""
+        return self._sums[window]
+
+    def deficit(self, window):
+        """
+        Flow needed this year to deliver window times the annual obligation
+        over the window, given the flows of the previous window - 1 years.
+        """
+        oldest = self._flows[(self._next - window) % len(self._flows)]
+        return max(0, (window * self.lees_ferry_ann_q
+                       - (self._sums[window] - oldest)))
+
+    def append(self, flow):
+        """Add the Lee Ferry flow of a new year."""
+        flows = self._flows
+        length = len(flows)
+        for window in self.windows:
+            self._sums[window] += flow - flows[(self._next - window) % length]
+        flows[self._next] = flow
+        self._next = (self._next + 1) % length
+
+    def record(self, window):
+        """Flows of the last window years, most recent first."""
+        length = len(self._flows)
+        return [self._flows[(self._next - k) % length]
+                for k in range(1, window + 1)]
+
+
+class RunStats:
+    """
+    Instrumentation of simulation runs, collected when an instance is
+    passed as the stats argument of simulate_trace.  Each run adds to it.
+
+    seconds holds the time spent in each of PHASES.  'year_loop' includes
+        'evaporation', which is timed only by the python engine.
+    counters holds the number of runs and years, the years whose
+        evaporation solve reached MAX_TRIALS, the years whose inflow was
+        less than the UB demand, and the years with a trigger cutback.
+    residuals holds the mass-balance residual of each year of the last
+        run: start contents plus inflow less UB_BU, evap, LF_flow and end
+        contents.  max_residual is the largest in any run.
+    """
+    PHASES = ('setup', 'year_loop', 'evaporation', 'output',
+              'post_processing')
+    COUNTERS = ('runs', 'years', 'max_trials', 'inflow_capped',
+                'trigger_cutbacks')
+
+    def __init__(self):
+        self.seconds = dict.fromkeys(self.PHASES, 0.0)
+        self.counters = dict.fromkeys(self.COUNTERS, 0)
+        self.residuals = np.zeros(0)
+        self.max_residual = 0
+        self._mark = time.perf_counter()
+
+    def start(self):
+        """Start timing a run."""
+        self._mark = time.perf_counter()
+
+    def lap(self, phase):
+        """Add the time since the last lap, or start, to phase."""
+        now = time.perf_counter()
+        self.seconds[phase] += now - self._mark
+        self._mark = now
+
+    def count(self, outputs, ub_demands):
+        """Update the counters and residuals from the outputs of a run."""
+        n = len(outputs["inflow"])
+        self.counters['runs'] += 1
+        self.counters['years'] += n
+        self.counters['max_trials'] += int(
+            (outputs["evap_trials"] > MAX_TRIALS).sum())
+        self.counters['inflow_capped'] += int(
+            (outputs["UB_dmd"]
+             < np.asarray(ub_demands)[:n] - outputs["trgr_cut"]).sum())
+        self.counters['trigger_cutbacks'] += int(
+            (outputs["trgr_cut"] > 0).sum())
+        self.residuals = (outputs["start_con"] + outputs["inflow"]
+                          - outputs["UB_BU"] - outputs["evap"]
+                          - outputs["LF_flow"] - outputs["end_con"])
+        if n:
+            self.max_residual = max(self.max_residual,
+                                    np.abs(self.residuals).max())
+
+    def __str__(self):
+        lines = [f"{phase}: {seconds * 1000:.3f} ms"
+                 for phase, seconds in self.seconds.items()]
+        lines += [f"{name}: {count}" for name, count in self.counters.items()]
+        lines.append(f"max mass-balance residual: {self.max_residual}")
+        return '\n'.join(lines)
+
+
+def output_columns(nyrs=10):
+    """Names of the simulate_trace output columns, in order."""
+    return ["year", "inflow", "start_con", 'trgr_cut', "UB_dmd", "evap",
+            "net_avail", "spill", "curtailment", "end_con", "UB_BU", "UB_CU",
+            f"LF_{nyrs}yr_flows", "LF_deficit", "LF_flow", "time_from_reset",
+            "evap_trials"]
+
+
+def _is_integral(values):
+    """True if all of the scalars and arrays in values hold integers."""
+    for value in values:
+        if isinstance(value, np.ndarray):
+            if value.dtype.kind not in 'iu':
+                return False
+        elif not isinstance(value, (int, np.integer)):
+            return False
+    return True
+
+
+def _n_year_record(record, years, lees_ferry_ann_q):
+    """
+    The first years of a Lee Ferry record, most recent first, padded with
+    lees_ferry_ann_q if the record is shorter.  record may be a list or an
+    array with one record per row.
+    """
+    if isinstance(record, np.ndarray):
+        record = record[..., :years]
+        padding = np.full(record.shape[:-1] + (years - record.shape[-1],),
+                          lees_ferry_ann_q)
+        return np.concatenate([record, padding], axis=-1)
+    record = list(record)[:years]
+    return record + (years - len(record)) * [lees_ferry_ann_q]
+
+
+def simulate_arrays(flows, ub_demands, start_contents, evaporation,
+                    reservoir_capacity, lees_ferry_ann_q, nyrs,
+                    lees_ferry_n_year_record, lf_release, ppr_volume,
+                    trigger_func=None, engine='python',
+                    evap_solver='iterative', lf_windows=(),
+                    stop_curtailment=None, time_from_reset=0,
+                    intervals=False, stats=None, last_event=None):
+    """
+    The annual water-balance recurrence behind simulate_trace.
+
+    flows and ub_demands are one-dimensional arrays with one value per year.
+    The other arguments are the resolved simulate_trace parameters.
+    lees_ferry_n_year_record is a list, most recent year first, and is
+    updated in place.  Only its first nyrs years, or as many as the longest
+    of lf_windows, are used; missing years count as lees_ferry_ann_q.
+    engine 'numba' runs the compiled kernel when numba is installed and the
+    run uses only linear_evaporation, mor_release or no_mor_release and no
+    trigger_func.  Otherwise the Python loop below is used.
+    evap_solver is one of EVAP_SOLVERS.  Years solved in closed form report
+    zero evap_trials.
+    lf_windows are accumulation periods, in years, to report alongside nyrs.
+    If stop_curtailment is given the run stops after the first year whose
+    curtailment exceeds it and the outputs end with that year.
+    time_from_reset is the count of years since the last spill or
+    curtailment before the first year, for runs that continue another.
+    stats is a RunStats to update, or None.
+    last_event is passed to event_intervals when intervals is True.
+
+    Returns a dict of NumPy arrays keyed by the simulate_trace output column
+    names, except "year", plus "evap_delta" if evap_solver is 'validate',
+    "LF_{n}yr_flows" and "LF_{n}yr_deficit" for each n in lf_windows and
+    "from_spill" and "from_curtailment", as event_intervals returns them,
+    if intervals is True.
+    The water-balance columns are int64 when flows, demands and parameters
+    are all integers and float64 otherwise.
+    trgr_cut is zero when there is no trigger_func and time_from_reset is
+    zero in years where it is not reported.
+    """
+    validate = evap_solver == 'validate'
+    lf_windows = [window for window in lf_windows if window != nyrs]
+    # Every engine reads the record as LeeFerryAccumulator does
+    record_years = max([nyrs, *lf_windows])
+    lees_ferry_n_year_record[:] = _n_year_record(lees_ferry_n_year_record,
+                                                 record_years,
+                                                 lees_ferry_ann_q)
+    if (engine == 'numba' and not validate and not lf_windows
+            and _compilable(evaporation, lf_release, trigger_func)):
+        outputs = _simulate_compiled(flows, ub_demands, start_contents,
+                                     evaporation, reservoir_capacity,
+                                     lees_ferry_ann_q, nyrs,
+                                     lees_ferry_n_year_record, lf_release,
+                                     ppr_volume, evap_solver == 'closed_form',
+                                     stop_curtailment, time_from_reset,
+                                     stats)
+        if intervals:
+            _add_intervals(outputs, last_event)
+        if stats is not None:
+            stats.count(outputs, ub_demands)
+        return outputs
+    slope = intercept = None
+    if evap_solver != 'iterative' and evaporation in linear_evaporation:
+        slope, intercept = linear_evaporation[evaporation]
+    n = len(flows)
+    integral = _is_integral((flows, ub_demands, start_contents,
+                             lees_ferry_ann_q, ppr_volume,
+                             *lees_ferry_n_year_record))
+    # inflow, start_con, trgr_cut, UB_dmd, evap, net_avail, spill,
+    # curtailment, end_con, LF_Nyr_flows, LF_deficit
+    balance = np.zeros((n, 11), dtype=np.int64 if integral else np.float64)
+    # UB_BU, UB_CU, LF_flow, evap_trials
+    rounded = np.zeros((n, 4), dtype=np.int64)
+    resets = np.zeros(n, dtype=np.int64)
+    evap_deltas = np.zeros(n, dtype=np.int64)
+    window_flows = np.zeros((len(lf_windows), n), dtype=balance.dtype)
+    window_deficits = np.zeros((len(lf_windows), n), dtype=balance.dtype)
+
+    flows = flows.tolist()
+    ub_demands = ub_demands.tolist()
+    lees_ferry = LeeFerryAccumulator(lees_ferry_ann_q, [nyrs, *lf_windows],
+                                     lees_ferry_n_year_record)
+    cutback = 0
+    timed = stats is not None
+    if timed:
+        stats.lap('setup')
+
+    for i in range(n):
+        inflow = flows[i]
+        ub_depletions = ub_demands[i]
+        if trigger_func:
+            cutback = trigger_func(reservoir_capacity, start_contents,
+                                   ub_depletions - ppr_volume)
+            ub_depletions -= cutback
+        # For the case where inflows are less than Upper Basin demand
+        ub_depletions = min(inflow, ub_depletions)
+
+        # Look back nyrs-1 years
+        # in order to calculate this year's flow requirement
+        lees_ferry_deficit = lees_ferry.deficit(nyrs)
+        for j, window in enumerate(lf_windows):
+            window_deficits[j, i] = lees_ferry.deficit(window)
+        lf_target = lf_release(lees_ferry_ann_q, lees_ferry_deficit)
+
+        depleted_inflow = inflow - ub_depletions
+        if timed:
+            evap_start = time.perf_counter()
+        if slope is None or validate:
+            evap = evaporation(start_contents)
+            evap_trial = 0
+
+            while True:
+                evap_trial += 1
+                trial_evap = evap
+                available_to_store = (depleted_inflow
+                                      + start_contents
+                                      - lf_target
+                                      - trial_evap)
+
+                trial_contents = max(
+                                     min(available_to_store,
+                                         reservoir_capacity),
+                                     0)
+
+                evap = evaporation((start_contents + trial_contents) / 2)
+
+                if (abs(trial_evap - evap) < TOLERANCE
+                        or evap_trial > MAX_TRIALS):
+                    break
+
+        if slope is not None:
+            closed_evap = closed_form_evap(slope, intercept, start_contents,
+                                           depleted_inflow + start_contents
+                                           - lf_target,
+                                           reservoir_capacity)
+            if validate:
+                evap_deltas[i] = closed_evap - evap
+            evap = closed_evap
+            evap_trial = 0
+            available_to_store = (depleted_inflow
+                                  + start_contents
+                                  - lf_target
+                                  - evap)
+            trial_contents = max(min(available_to_store, reservoir_capacity),
+                                 0)
+        if timed:
+            stats.seconds['evaporation'] += time.perf_counter() - evap_start
+
+        end_contents = trial_contents
+        spill = max(available_to_store - reservoir_capacity, 0)
+
+        # Address case where inflows are less than PPR volume
+        ppr_supply = min(ppr_volume, inflow - evap)
+
+        # Curtail by the shortfall meeting LF target
+        # or the amount of non-PPR use, whichever is less
+        curtailment = min(-min(available_to_store, 0),
+                          ub_depletions
+                          - min(ub_depletions, ppr_supply))
+
+        # Calculate the water balance to determine the flow at Lee Ferry,
+        # which is the release from the reservoir
+        lees_ferry_flow = int(round(depleted_inflow
+                                    + start_contents
+                                    - end_contents
+                                    - evap
+                                    + curtailment, -1))
+        lees_ferry.append(lees_ferry_flow)
+        for j, window in enumerate(lf_windows):
+            window_flows[j, i] = lees_ferry.total(window)
+
+        ub_bu = int(round(ub_depletions - curtailment, 0))
+        ub_cu = int(round(ub_bu + evap, 0))
+
+        # A user-supplied function can introduce fractional acre-feet
+        if integral and (isinstance(evap, float)
+                         or isinstance(lf_target, float)
+                         or isinstance(cutback, float)):
+            integral = False
+            balance = balance.astype(np.float64)
+            window_flows = window_flows.astype(np.float64)
+            window_deficits = window_deficits.astype(np.float64)
+
+        balance[i] = (inflow, start_contents, cutback, ub_depletions, evap,
+                      available_to_store, spill, curtailment, end_contents,
+                      lees_ferry.total(nyrs), lees_ferry_deficit)
+        rounded[i] = (ub_bu, ub_cu, lees_ferry_flow, evap_trial)
+
+        # If we have a curtailment, how long has it been from the last
+        # spill or curtailment?
+        if (int(round(curtailment))!= 0):
+            if time_from_reset > 0:
+                resets[i] = time_from_reset
+            time_from_reset = 0
+        elif (spill != 0):
+            time_from_reset = 0
+        else:
+            time_from_reset += 1
+
+        start_contents = end_contents
+
+        if stop_curtailment is not None and curtailment > stop_curtailment:
+            n = i + 1
+            break
+
+    if timed:
+        stats.lap('year_loop')
+    balance, rounded, resets = balance[:n], rounded[:n], resets[:n]
+    evap_deltas = evap_deltas[:n]
+    window_flows = window_flows[:, :n]
+    window_deficits = window_deficits[:, :n]
+    outputs = _columns(np.ascontiguousarray(balance.T),
+                       np.ascontiguousarray(rounded.T), resets, nyrs)
+    if validate:
+        outputs["evap_delta"] = evap_deltas
+    for j, window in enumerate(lf_windows):
+        outputs[f"LF_{window}yr_flows"] = window_flows[j]
+        outputs[f"LF_{window}yr_deficit"] = window_deficits[j]
+    lees_ferry_n_year_record[:] = lees_ferry.record(nyrs)
+    if intervals:
+        _add_intervals(outputs, last_event)
+    if timed:
+        stats.lap('output')
+        stats.count(outputs, ub_demands)
+    return outputs
+
+
+def event_intervals(spill, curtailment, last_event=None):
+    """
+    Years from the last spill or curtailment to each curtailment.
+
+    spill and curtailment are arrays with one value per year along the
+    last axis, e.g. one trace or a traces x years ensemble.
+    An event is a year with spill or curtailment.  For each curtailment
+    year, the interval is counted from the most recent earlier event and
+    reported in from_spill if that event had spill, else in
+    from_curtailment.  The interval includes the year of the curtailment
+    since depletions accumulate in that year.
+    last_event is the event before the first year, for runs that continue
+    another: the number of years before the first year, 1 for the year
+    just before, and whether it had spill.  Default None, no such event.
+
+    Returns from_spill and from_curtailment, float arrays like curtailment
+    that are NaN except in curtailment years with such an interval.
+    """
+    spill = np.asarray(spill)
+    curtailment = np.asarray(curtailment)
+    spilled = spill > 0
+    curtailed = curtailment > 0
+    years = np.arange(curtailment.shape[-1])
+    first, spilled_before = ((-1, False) if last_event is None
+                             else (-last_event[0], last_event[1]))
+    # Index of the most recent event up to each year, first before the first
+    latest = np.maximum.accumulate(
+        np.where(spilled | curtailed, years, first), axis=-1)
+    previous = np.concatenate(
+        (np.full(latest.shape[:-1] + (1,), first), latest[..., :-1]),
+        axis=-1)
+    known = previous >= 0 if last_event is None else True
+    interval = np.where(curtailed & known, years - previous, np.nan)
+    from_spill = np.where(
+        previous >= 0,
+        np.take_along_axis(spilled, np.maximum(previous, 0), axis=-1),
+        spilled_before)
+    return (np.where(from_spill, interval, np.nan),
+            np.where(from_spill, np.nan, interval))
+
+
+def _add_intervals(outputs, last_event=None):
+    """Add the event_intervals outputs to a dict of outputs."""
+    outputs["from_spill"], outputs["from_curtailment"] = event_intervals(
+        outputs["spill"], outputs["curtailment"], last_event)
+    return outputs
+
+
+def _last_event(outputs, last_event=None):
+    """
+    The last spill or curtailment of a run, as the last_event argument of
+    event_intervals for a run that continues it.
+    """
+    spill = outputs["spill"] > 0
+    events = np.flatnonzero(spill | (outputs["curtailment"] > 0))
+    n = len(spill)
+    if len(events):
+        return (int(n - events[-1]), bool(spill[events[-1]]))
+    if last_event is None:
+        return None
+    return (last_event[0] + n, last_event[1])
+
+
+def _columns(balance, rounded, resets, nyrs):
+    """
+    Name the columns of the arrays filled by the simulation kernels.
+    balance and rounded hold one output column in each row.
+    """
+    names = output_columns(nyrs)
+    outputs = dict(zip(names[1:10] + [names[12], names[13]], balance))
+    outputs.update(zip([names[10], names[11], names[14], names[16]],
+                       rounded))
+    outputs["time_from_reset"] = resets
+    return outputs
+
+
+"""
+Compiled kernel.  The same recurrence as simulate_arrays, restricted to
+linear evaporation and the built-in release rules, written so numba can
+compile it.  Used when a simulation is run with engine='numba'.
+"""
+ENGINES = ('python', 'numba')
+_closed_form_kernel = closed_form_evap
+_numba = False      # not yet imported
+
+
+def _balance_kernel(flows, ub_demands, start_contents, slope, intercept,
+                    reservoir_capacity, lees_ferry_ann_q, lees_ferry_cum_q,
+                    record, mor, ppr_volume, closed_form, stop_curtailment,
+                    time_from_reset, balance, rounded, resets):
+    """
+    Fill balance, rounded and resets for one trace.  balance and rounded
+    hold the columns of simulate_arrays, in the same order, one per row.
+    record holds the Lee Ferry flows, oldest first, and is used as a ring.
+    The run stops after the first year whose curtailment exceeds
+    stop_curtailment.  Returns the ring position of the oldest year and
+    the number of years simulated.
+    """
+    n_record = record.shape[0]
+    record_sum = record.sum()
+    oldest = 0
+    for i in range(flows.shape[0]):
+        inflow = flows[i]
+        # For the case where inflows are less than Upper Basin demand
+        ub_depletions = min(inflow, ub_demands[i])
+
+        # Look back nyrs-1 years to calculate this year's flow requirement
+        record_sum -= record[oldest]
+        lees_ferry_deficit = max(0, lees_ferry_cum_q - record_sum)
+        if mor:
+            lf_target = max(lees_ferry_ann_q, lees_ferry_deficit)
+        else:
+            lf_target = lees_ferry_deficit
+
+        depleted_inflow = inflow - ub_depletions
+        if closed_form:
+            evap = _closed_form_kernel(slope, intercept, start_contents,
+                                    depleted_inflow + start_contents
+                                    - lf_target,
+                                    reservoir_capacity)
+            evap_trial = 0
+            available_to_store = (depleted_inflow
+                                  + start_contents
+                                  - lf_target
+                                  - evap)
+            trial_contents = max(min(available_to_store, reservoir_capacity),
+                                 0)
+        else:
+            evap = int(np.rint(slope * start_contents + intercept))
+            evap_trial = 0
+            while True:
+                evap_trial += 1
+                trial_evap = evap
+                available_to_store = (depleted_inflow
+                                      + start_contents
+                                      - lf_target
+                                      - trial_evap)
+                trial_contents = max(min(available_to_store,
+                                         reservoir_capacity), 0)
+                evap = int(np.rint(slope * ((start_contents
+                                             + trial_contents) / 2)
+                                   + intercept))
+                if (abs(trial_evap - evap) < TOLERANCE
+                        or evap_trial > MAX_TRIALS):
+                    break
+
+        end_contents = trial_contents
+        spill = max(available_to_store - reservoir_capacity, 0)
+
+        # Address case where inflows are less than PPR volume
+        ppr_supply = min(ppr_volume, inflow - evap)
+
+        # Curtail by the shortfall meeting LF target
+        # or the amount of non-PPR use, whichever is less
+        curtailment = min(-min(available_to_store, 0),
+                          ub_depletions - min(ub_depletions, ppr_supply))
+
+        # Lee Ferry flow rounded to tens, ties to the even multiple
+        release = (depleted_inflow + start_contents - end_contents
+                   - evap + curtailment)
+        tens = release // 10
+        remainder = release - 10 * tens
+        if remainder > 5 or (remainder == 5 and tens % 2 == 1):
+            tens += 1
+        lees_ferry_flow = int(tens * 10)
+        record[oldest] = lees_ferry_flow
+        record_sum += lees_ferry_flow
+        oldest = (oldest + 1) % n_record
+
+        ub_bu = int(np.rint(ub_depletions - curtailment))
+        ub_cu = int(np.rint(ub_bu + evap))
+
+        balance[0, i] = inflow
+        balance[1, i] = start_contents
+        balance[3, i] = ub_depletions
+        balance[4, i] = evap
+        balance[5, i] = available_to_store
+        balance[6, i] = spill
+        balance[7, i] = curtailment
+        balance[8, i] = end_contents
+        balance[9, i] = record_sum
+        balance[10, i] = lees_ferry_deficit
+        rounded[0, i] = ub_bu
+        rounded[1, i] = ub_cu
+        rounded[2, i] = lees_ferry_flow
+        rounded[3, i] = evap_trial
+
+        # If we have a curtailment, how long has it been from the last
+        # spill or curtailment?
+        if np.rint(curtailment) != 0:
+            if time_from_reset > 0:
+                resets[i] = time_from_reset
+            time_from_reset = 0
+        elif spill != 0:
+            time_from_reset = 0
+        else:
+            time_from_reset += 1
+
+        start_contents = end_contents
+
+        if curtailment > stop_curtailment:
+            return oldest, i + 1
+    return oldest, flows.shape[0]
+
+
+def _ensemble_kernel(flows_2d, ub_demands_2d, start_contents, slope,
+                     intercept, reservoir_capacity, lees_ferry_ann_q,
+                     lees_ferry_cum_q, records, mor, ppr_volume, closed_form,
+                     balance, rounded, resets):
+    """Run _balance_kernel over each row of flows_2d."""
+    for k in range(flows_2d.shape[0]):
+        _balance_kernel(flows_2d[k], ub_demands_2d[k], start_contents[k],
+                        slope, intercept, reservoir_capacity,
+                        lees_ferry_ann_q, lees_ferry_cum_q, records[k], mor,
+                        ppr_volume, closed_form, np.inf, 0, balance[:, k],
+                        rounded[:, k], resets[k])
+
+
+def _load_numba():
+    """
+    Import numba and wrap the kernels for compilation, the first time it is
+    called.  Returns the numba module, or None if it is not installed.
+    """
+    global _numba, _closed_form_kernel, _balance_kernel, _ensemble_kernel
+    if _numba is False:
+        try:
+            _numba = importlib.import_module('numba')
+        except ImportError:
+            _numba = None
+        else:
+            _closed_form_kernel = _numba.njit(cache=True)(closed_form_evap)
+            _balance_kernel = _numba.njit(cache=True)(_balance_kernel)
+            _ensemble_kernel = _numba.njit(cache=True)(_ensemble_kernel)
+    return _numba
+
+
+def __getattr__(name):
+    # UBWB_model.numba is the numba module, or None if it is not installed
+    if name == 'numba':
+        return _load_numba()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def _compilable(evaporation, lf_release, trigger_func):
+    """True if a run can use the compiled kernel."""
+    return (_load_numba() is not None
+            and evaporation in linear_evaporation
+            and lf_release in (mor_release, no_mor_release)
+            and trigger_func is None)
+
+
+def _simulate_compiled(flows, ub_demands, start_contents, evaporation,
+                       reservoir_capacity, lees_ferry_ann_q, nyrs,
+                       lees_ferry_n_year_record, lf_release, ppr_volume,
+                       closed_form, stop_curtailment, time_from_reset,
+                       stats=None):
+    """simulate_arrays using the compiled kernel."""
+    integral = _is_integral((flows, ub_demands, start_contents,
+                             lees_ferry_ann_q, ppr_volume,
+                             *lees_ferry_n_year_record))
+    dtype = np.int64 if integral else np.float64
+    n = len(flows)
+    balance = np.zeros((11, n), dtype=dtype)
+    rounded = np.zeros((4, n), dtype=np.int64)
+    resets = np.zeros(n, dtype=np.int64)
+    record = np.array(lees_ferry_n_year_record[::-1], dtype=dtype)
+    slope, intercept = linear_evaporation[evaporation]
+    if stop_curtailment is None:
+        stop_curtailment = np.inf
+    if stats is not None:
+        stats.lap('setup')
+    oldest, n = _balance_kernel(
+        flows.astype(dtype), ub_demands.astype(dtype), dtype(start_contents),
+        slope, intercept, dtype(reservoir_capacity), dtype(lees_ferry_ann_q),
+        dtype(nyrs * lees_ferry_ann_q), record, lf_release is mor_release,
+        dtype(ppr_volume), closed_form, stop_curtailment, time_from_reset,
+        balance, rounded, resets)
+    if stats is not None:
+        stats.lap('year_loop')
+    # Leave the record as the Python loop would, most recent year first
+    lees_ferry_n_year_record[:] = np.roll(record, -oldest)[::-1].tolist()
+    outputs = _columns(balance[:, :n], rounded[:, :n], resets[:n], nyrs)
+    if stats is not None:
+        stats.lap('output')
+    return outputs
+
+
+def _with_missing(values, missing):
+    """Mark missing values so they are written as blanks."""
+    if values.dtype.kind == 'i':
+        import pandas as pd
+        return pd.arrays.IntegerArray(values, missing)
+    return np.where(missing, np.nan, values)
+
+
+def _intervals_with_missing(outputs):
+    """Write the event intervals, if present, as integers and blanks."""
+    for name in ("from_spill", "from_curtailment"):
+        if name in outputs:
+            intervals = np.asarray(outputs[name])
+            missing = np.isnan(intervals)
+            outputs[name] = _with_missing(
+                np.where(missing, 0, intervals).astype(np.int64), missing)
+
+
+def simulate_trace(input_data, start_contents=None, res_model='active',
+                   lees_ferry_ann_q=8230000, nyrs=10,
+                   lees_ferry_n_year_record=None,
+                   lf_release=mor_release, ub_demand=5760000,
+                   ppr_volume=2267000, trigger_func=None, as_arrays=False,
+                   engine='python', evap_solver='iterative', lf_windows=(),
+                   stop_curtailment=None, intervals=False, stats=None,
+                   state=None, return_state=False):
+    """
+    Simulate water balance in the Upper Basin.
+    start_contents default to full.  If user-entered value is greater than
+        capacity, start_contents is set to full, if negative set to 0.
+    res_model is either 'active' (default) or 'live'
+    input_data is expected to be a pandas dataframe with one row for each
+        year and with columns "year" and "flow", at a minimum.  If input_data
+        contains a column "UB demand" that column is expected to contain
+        an annual time series of Upper Basin demand for consumptive use. 
+        A dict of arrays with the same keys can be used instead, and
+        needs no pandas when as_arrays is True.
+        This can be used for validation or other analyses, but it has not
+        been tested. Any other columns in input_data are ignored.
+    as_arrays: if True, return the dict of NumPy arrays built by
+        simulate_arrays, plus "year", instead of a DataFrame.
+    engine is 'python' (default) or 'numba'.  'numba' compiles the annual
+        loop for the 'active' and 'live' models with mor_release or
+        no_mor_release and no trigger_func.  Other runs, or any run when
+        numba is not installed, use the 'python' engine.  Results are the
+        same either way.
+    evap_solver is one of EVAP_SOLVERS, default 'iterative' as in the
+        2007HD method.  With 'validate' an "evap_delta" column holds the
+        closed-form evaporation less the iterated evaporation.
+    lf_windows: other accumulation periods, in years, for which to report
+        the Lee Ferry flows and deficit in "LF_{n}yr_flows" and
+        "LF_{n}yr_deficit" columns.  Only nyrs drives the releases.
+    stop_curtailment: if given, stop after the first year whose curtailment
+        exceeds it.  The outputs end with that year.
+    intervals: if True, add "from_spill" and "from_curtailment" columns
+        holding the event_intervals of each curtailment year.
+    stats: a RunStats to which the run adds its phase timings, counters
+        and mass-balance residuals, or a function to call with a new
+        RunStats for the run when it finishes.  Default None, which
+        collects nothing.
+    state: a RunState to continue from.  The run starts with the state's
+        contents, Lee Ferry record and years since the last spill or
+        curtailment, and uses the state's model and parameters in place
+        of the arguments named in RunState.PARAMETERS.  input_data holds
+        the years after the state's year.
+    return_state: if True, return the outputs and a RunState at the end of
+        the run, from which a later run can continue.
+    """
+    run_stats = stats
+    if callable(stats):
+        run_stats = RunStats()
+    if run_stats is not None:
+        run_stats.start()
+    # initialize parameters
+    time_from_reset = 0
+    last_event = None
+    if state is not None:
+        (res_model, lees_ferry_ann_q, nyrs, lf_release, ub_demand,
+         ppr_volume, trigger_func, evap_solver, lf_windows) = (
+             state.parameters[name] for name in RunState.PARAMETERS)
+        lees_ferry_n_year_record = list(state.lees_ferry_record)
+        time_from_reset = state.time_from_reset
+        last_event = state.last_event
+    if lees_ferry_n_year_record is None:
+        lees_ferry_n_year_record = nyrs * [lees_ferry_ann_q]
+    if res_model not in reservoir_models.keys():
+        print('ERROR: Unknown reservoir model')
+        return None
+    if engine not in ENGINES:
+        print('ERROR: Unknown engine')
+        return None
+    if evap_solver not in EVAP_SOLVERS:
+        print('ERROR: Unknown evaporation solver')
+        return None
+    evaporation, reservoir_capacity = reservoir_models[res_model]
+    if state is not None:
+        start_contents = state.contents
+    elif not start_contents:
+        start_contents = reservoir_capacity
+    else:
+        start_contents = max(min(start_contents,reservoir_capacity),0)
+    flows = np.asarray(input_data["flow"])
+    if 'UB demand' in input_data:
+        ub_demands = np.asarray(input_data['UB demand'])
+    else:
+        ub_demands = np.full(len(flows), ub_demand)
+    if return_state:
+        # Longer windows need a longer record to continue exactly
+        record_years = max([nyrs, *lf_windows])
+        first_record = (list(lees_ferry_n_year_record)
+                        + record_years * [lees_ferry_ann_q])[:record_years]
+
+    outputs = simulate_arrays(flows, ub_demands, start_contents, evaporation,
+                              reservoir_capacity, lees_ferry_ann_q, nyrs,
+                              lees_ferry_n_year_record, lf_release,
+                              ppr_volume, trigger_func, engine, evap_solver,
+                              lf_windows, stop_curtailment,
+                              time_from_reset=time_from_reset,
+                              intervals=intervals, stats=run_stats,
+                              last_event=last_event)
+    n = len(outputs["inflow"])
+    outputs["year"] = np.asarray(input_data["year"])[:n]
+    if return_state:
+        end_state = RunState(
+            outputs["end_con"][-1].item() if n else start_contents,
+            (outputs["LF_flow"][::-1].tolist()
+             + first_record)[:record_years],
+            _final_time_from_reset(outputs, time_from_reset),
+            _last_event(outputs, last_event),
+            outputs["year"][-1].item() if n else (
+                None if state is None else state.year),
+            dict(zip(RunState.PARAMETERS,
+                     (res_model, lees_ferry_ann_q, nyrs, lf_release,
+                      ub_demand, ppr_volume, trigger_func, evap_solver,
+                      tuple(lf_windows)))))
+    if as_arrays:
+        if callable(stats):
+            stats(run_stats)
+        return (outputs, end_state) if return_state else outputs
+
+    if trigger_func is None:
+        outputs['trgr_cut'] = _with_missing(outputs['trgr_cut'],
+                                            np.ones(n, dtype=bool))
+    resets = outputs["time_from_reset"]
+    outputs["time_from_reset"] = _with_missing(resets, resets == 0)
+    _intervals_with_missing(outputs)
+    columns = output_columns(nyrs)
+    columns += [name for name in outputs if name not in columns]
+    import pandas as pd
+    outputs = pd.DataFrame({name: outputs[name] for name in columns},
+                           index=(input_data.index[:n]
+                                  if isinstance(input_data, pd.DataFrame)
+                                  else None))
+    if run_stats is not None:
+        run_stats.lap('post_processing')
+        if callable(stats):
+            stats(run_stats)
+    return (outputs, end_state) if return_state else outputs
+
+
+def _final_time_from_reset(outputs, time_from_reset):
+    """
+    Years since the last spill or curtailment at the end of a run that
+    started time_from_reset years after one.
+    """
+    resets = ((np.rint(outputs["curtailment"]) != 0)
+              | (outputs["spill"] != 0))
+    n = len(resets)
+    if resets.any():
+        return int(n - 1 - np.flatnonzero(resets)[-1])
+    return time_from_reset + n
+
+
+class RunState:
+    """
+    State of a run at the end of its last year, from which a later run can
+    continue: the reservoir contents, the Lee Ferry record, the years since
+    the last spill or curtailment, the last event for event_intervals, and
+    the reservoir model and parameters of the run.
+    simulate_trace(..., return_state=True) returns one and
+    simulate_trace(..., state=state) continues from it, giving the same
+    results as running the whole trace at once.
+
+    States are saved to and loaded from JSON files.  lf_release and
+    trigger_func are saved by name, so must be functions of this module,
+    except that a TriggerPolicy trigger_func is saved as its table.
+    """
+    PARAMETERS = ('res_model', 'lees_ferry_ann_q', 'nyrs', 'lf_release',
+                  'ub_demand', 'ppr_volume', 'trigger_func', 'evap_solver',
+                  'lf_windows')
+    FUNCTIONS = ('lf_release', 'trigger_func')
+
+    def __init__(self, contents, lees_ferry_record, time_from_reset,
+                 last_event, year, parameters):
+        """
+        contents are the reservoir contents at the end of year.
+        lees_ferry_record holds the Lee Ferry flows of the last
+            max(nyrs, *lf_windows) years, most recent first.
+        last_event is as for event_intervals.
+        parameters is a dict of the simulate_trace arguments in PARAMETERS.
+        """
+        self.contents = contents
+        self.lees_ferry_record = list(lees_ferry_record)
+        self.time_from_reset = time_from_reset
+        self.last_event = None if last_event is None else tuple(last_event)
+        self.year = year
+        self.parameters = dict(parameters)
+
+    def __eq__(self, other):
+        return (isinstance(other, RunState)
+                and vars(self) == vars(other))
+
+    def to_dict(self):
+        """The state as a dict of JSON types, or None if it has none."""
+        parameters = dict(self.parameters)
+        for name in self.FUNCTIONS:
+            function = parameters[name]
+            if function is None:
+                continue
+            if isinstance(function, TriggerPolicy):
+                parameters[name] = function.to_dict()
+                continue
+            function_name = getattr(function, '__name__', None)
+            if globals().get(function_name) is not function:
+                print(f'ERROR: {name} is not a function of UBWB_model')
+                return None
+            parameters[name] = function.__name__
+        parameters['lf_windows'] = list(parameters['lf_windows'])
+        return {'contents': self.contents,
+                'lees_ferry_record': self.lees_ferry_record,
+                'time_from_reset': self.time_from_reset,
+                'last_event': self.last_event,
+                'year': self.year,
+                'parameters': parameters}
+
+    @classmethod
+    def from_dict(cls, values):
+        """A state from the dict returned by to_dict."""
+        parameters = dict(values['parameters'])
+        for name in cls.FUNCTIONS:
+            if isinstance(parameters[name], dict):
+                parameters[name] = TriggerPolicy.from_dict(parameters[name])
+            elif parameters[name] is not None:
+                parameters[name] = globals()[parameters[name]]
+        parameters['lf_windows'] = tuple(parameters['lf_windows'])
+        return cls(values['contents'], values['lees_ferry_record'],
+                   values['time_from_reset'], values['last_event'],
+                   values['year'], parameters)
+
+    def save(self, file_spec):
+        """Write the state to a JSON file.  Returns file_spec, or None."""
+        values = self.to_dict()
+        if values is None:
+            return None
+        with open(file_spec, 'w') as file:
+            json.dump(values, file, indent=1)
+        return file_spec
+
+    @classmethod
+    def load(cls, file_spec):
+        """Read a state written by save."""
+        with open(file_spec) as file:
+            return cls.from_dict(json.load(file))
+
+
+def simulate_stream(records, block_size=1000, as_rows=False,
+                    start_contents=None, res_model='active',
+                    lees_ferry_ann_q=8230000, nyrs=10,
+                    lees_ferry_n_year_record=None, lf_release=mor_release,
+                    ub_demand=5760000, ppr_volume=2267000, trigger_func=None,
+                    engine='python', evap_solver='iterative'):
+    """
+    Simulate water balance in the Upper Basin for a trace of any length,
+    read and reported a block of years at a time.
+
+    records is an iterable of (year, flow) or (year, flow, UB demand)
+        tuples, e.g. a generator reading a large file or producing a
+        synthetic trace.  Records without a UB demand use ub_demand.
+    block_size is the number of years simulated at a time.  Only one block
+        of inputs and outputs is held in memory; the run carries forward
+        just the reservoir contents, the Lee Ferry record and the years
+        since the last spill or curtailment.
+    as_rows: if True, yield one dict of output values per year instead of
+        one dict of arrays per block.
+    The other arguments are as for simulate_trace.
+
+    Yields dicts keyed by the simulate_trace output column names, as
+    simulate_trace(as_arrays=True) returns.  Joined end to end the blocks
+    equal the simulate_trace outputs for the whole trace.
+    """
+    if res_model not in reservoir_models.keys():
+        print('ERROR: Unknown reservoir model')
+        return
+    if engine not in ENGINES:
+        print('ERROR: Unknown engine')
+        return
+    if evap_solver not in EVAP_SOLVERS:
+        print('ERROR: Unknown evaporation solver')
+        return
+    if lees_ferry_n_year_record is None:
+        lees_ferry_n_year_record = nyrs * [lees_ferry_ann_q]
+    evaporation, reservoir_capacity = reservoir_models[res_model]
+    if not start_contents:
+        start_contents = reservoir_capacity
+    else:
+        start_contents = max(min(start_contents,reservoir_capacity),0)
+    time_from_reset = 0
+
+    records = iter(records)
+    while True:
+        block = list(itertools.islice(records, block_size))
+        if not block:
+            return
+        years = np.array([record[0] for record in block])
+        flows = np.array([record[1] for record in block])
+        ub_demands = np.array([record[2] if len(record) > 2 else ub_demand
+                               for record in block])
+
+        outputs = simulate_arrays(flows, ub_demands, start_contents,
+                                  evaporation, reservoir_capacity,
+                                  lees_ferry_ann_q, nyrs,
+                                  lees_ferry_n_year_record, lf_release,
+                                  ppr_volume, trigger_func, engine,
+                                  evap_solver,
+                                  time_from_reset=time_from_reset)
+        outputs["year"] = years
+        start_contents = outputs["end_con"][-1].item()
+        time_from_reset = _final_time_from_reset(outputs, time_from_reset)
+
+        if as_rows:
+            columns = output_columns(nyrs)
+            columns += [name for name in outputs if name not in columns]
+            for row in zip(*(outputs[name].tolist() for name in columns)):
+                yield dict(zip(columns, row))
+        else:
+            yield outputs
+
+
+def _elementwise(func, nin):
+    """Apply a scalar model function to NumPy arrays one element at a time."""
+    ufunc = np.frompyfunc(func, nin, 1)
+    return lambda *args: ufunc(*args).astype(np.float64)
+
+
+def _array_evaporation(evaporation, integral):
+    """Evaporation function that accepts an array of reservoir contents."""
+    if evaporation in linear_evaporation:
+        slope, intercept = linear_evaporation[evaporation]
+        dtype = np.int64 if integral else np.float64
+        # np.rint rounds half to even, as round() does
+        return lambda contents: np.rint(slope * contents
+                                        + intercept).astype(dtype)
+    return _elementwise(evaporation, 1)
+
+
+def _array_release(lf_release):
+    """Lee Ferry release function that accepts arrays of deficits."""
+    if lf_release is mor_release:
+        return np.maximum
+    if lf_release is no_mor_release:
+        return no_mor_release
+    return _elementwise(lf_release, 2)
+
+
+def _round_tens(values):
+    """int(round(value, -1)) for each element of an array."""
+    quotient, remainder = np.divmod(values, 10)
+    # ties go to the even multiple of ten
+    quotient += (remainder > 5) | ((remainder == 5) & (quotient % 2 == 1))
+    return (quotient * 10).astype(np.int64)
+
+
+def _closed_form_array(slope, intercept, start_contents, available,
+                       reservoir_capacity):
+    """closed_form_evap for arrays of start contents and available water."""
+    evap = ((slope * (start_contents + available) / 2 + intercept)
+            / (1 + slope / 2))
+    evap = np.where(available - evap < 0,
+                    slope * start_contents / 2 + intercept,
+                    np.where(available - evap > reservoir_capacity,
+                             slope * (start_contents + reservoir_capacity) / 2
+                             + intercept,
+                             evap))
+    return np.rint(evap).astype(np.int64)
+
+
+def simulate_ensemble(flows_2d, years=None, start_contents=None,
+                      res_model='active', lees_ferry_ann_q=8230000, nyrs=10,
+                      lees_ferry_n_year_record=None, lf_release=mor_release,
+                      ub_demand=5760000, ppr_volume=2267000,
+                      trigger_func=None, as_frame=False, engine='python',
+                      evap_solver='iterative', intervals=False):
+    """
+    Simulate water balance in the Upper Basin for an ensemble of traces.
+
+    All traces are stepped forward together, one year at a time, and each
+    trace gives the same result as simulate_trace would for it alone.
+    flows_2d is an array of annual flows with one row per trace and one
+        column per year.
+    years labels the columns of flows_2d, default 0, 1, 2, ..., or is an
+        array like flows_2d giving the year of each flow.
+    start_contents may be a scalar or one value per trace.  As for
+        simulate_trace, a zero starts the trace full.
+    ub_demand may be a scalar, one value per year, or a traces x years
+        array like flows_2d.
+    lees_ferry_n_year_record is a list, most recent year first, applied to
+        every trace, or an array with one such row per trace.  As in
+        simulate_trace, its first nyrs years are used, padded with
+        lees_ferry_ann_q if it is shorter.  Unlike simulate_trace, it is
+        not modified.
+    The other arguments are as for simulate_trace.  lf_release,
+        trigger_func and evaporation functions not in linear_evaporation
+        are called once per trace and year, except that a TriggerPolicy
+        trigger_func is called once per year for all traces.
+    engine, evap_solver and intervals are as for simulate_trace.  With
+        'numba' the traces are run one after another by the compiled kernel.
+
+    Returns a dict of traces x years arrays keyed by the simulate_trace
+    output column names, with "year" holding the years, or, if as_frame is
+    True, a DataFrame of the traces stacked one after another with a
+    leading "trace" column.
+    """
+    if res_model not in reservoir_models.keys():
+        print('ERROR: Unknown reservoir model')
+        return None
+    if engine not in ENGINES:
+        print('ERROR: Unknown engine')
+        return None
+    if evap_solver not in EVAP_SOLVERS:
+        print('ERROR: Unknown evaporation solver')
+        return None
+    evaporation, reservoir_capacity = reservoir_models[res_model]
+    flows_2d = np.asarray(flows_2d)
+    n_traces, n_years = flows_2d.shape
+    if years is None:
+        years = np.arange(n_years)
+    if lees_ferry_n_year_record is None:
+        lees_ferry_n_year_record = nyrs * [lees_ferry_ann_q]
+    record = _n_year_record(np.asarray(lees_ferry_n_year_record), nyrs,
+                            lees_ferry_ann_q)
+    # oldest year first
+    record = np.array(np.broadcast_to(record, (n_traces, nyrs))[:, ::-1])
+    # As in simulate_trace, no or zero start contents means full
+    if start_contents is None:
+        start_contents = reservoir_capacity
+    start_contents = np.asarray(start_contents)
+    start_contents = np.where(start_contents == 0, reservoir_capacity,
+                              np.clip(start_contents, 0, reservoir_capacity))
+    start_contents = np.array(np.broadcast_to(start_contents, n_traces))
+    ub_demands = np.broadcast_to(np.asarray(ub_demand), flows_2d.shape)
+
+    integral = (_is_integral((flows_2d, ub_demands, start_contents, record,
+                              lees_ferry_ann_q, ppr_volume))
+                and evaporation in linear_evaporation
+                and lf_release in (mor_release, no_mor_release)
+                and trigger_func is None)
+    dtype = np.int64 if integral else np.float64
+    start_contents = start_contents.astype(dtype)
+    record = record.astype(dtype)
+    validate = evap_solver == 'validate'
+    if (engine == 'numba' and not validate
+            and _compilable(evaporation, lf_release, trigger_func)):
+        outputs = _ensemble_compiled(flows_2d, ub_demands, start_contents,
+                                     evaporation, reservoir_capacity,
+                                     lees_ferry_ann_q, nyrs, record,
+                                     lf_release, ppr_volume, dtype,
+                                     evap_solver == 'closed_form')
+        return _ensemble_result(outputs, years, nyrs, trigger_func, as_frame,
+                                intervals)
+
+    slope = intercept = None
+    if evap_solver != 'iterative' and evaporation in linear_evaporation:
+        slope, intercept = linear_evaporation[evaporation]
+    evaporation = _array_evaporation(evaporation, integral)
+    lf_release = _array_release(lf_release)
+    if trigger_func and not isinstance(trigger_func, TriggerPolicy):
+        trigger_func = _elementwise(trigger_func, 3)
+
+    # Outputs are filled one year (row) at a time and transposed at the end
+    names = output_columns(nyrs)
+    outputs = {name: np.zeros((n_years, n_traces),
+                              dtype=np.int64 if name in (
+                                  "UB_BU", "UB_CU", "LF_flow",
+                                  "time_from_reset", "evap_trials")
+                              else dtype)
+               for name in names[1:]}
+    if validate:
+        outputs["evap_delta"] = np.zeros((n_years, n_traces), dtype=np.int64)
+    lees_ferry_cum_q = nyrs * lees_ferry_ann_q
+    record_sum = record.sum(axis=1)
+    oldest = 0
+    time_from_reset = np.zeros(n_traces, dtype=np.int64)
+    traces = np.arange(n_traces)
+
+    for t in range(n_years):
+        inflow = flows_2d[:, t]
+        ub_depletions = ub_demands[:, t]
+        if trigger_func:
+            cutback = trigger_func(reservoir_capacity, start_contents,
+                                   ub_depletions - ppr_volume)
+            outputs['trgr_cut'][t] = cutback
+            ub_depletions = ub_depletions - cutback
+        # For the case where inflows are less than Upper Basin demand
+        ub_depletions = np.minimum(inflow, ub_depletions)
+
+        # Look back nyrs-1 years to calculate this year's flow requirement
+        record_sum -= record[:, oldest]
+        lees_ferry_deficit = np.maximum(0, lees_ferry_cum_q - record_sum)
+        lf_target = lf_release(lees_ferry_ann_q, lees_ferry_deficit)
+
+        depleted_inflow = inflow - ub_depletions
+        base = depleted_inflow + start_contents - lf_target
+        evap = evaporation(start_contents)
+        evap_trials = np.zeros(n_traces, dtype=np.int64)
+        available_to_store = np.zeros(n_traces, dtype=base.dtype)
+        end_contents = np.zeros(n_traces, dtype=base.dtype)
+
+        # Iterate only the traces whose evaporation has not converged
+        unsettled = traces if slope is None or validate else traces[:0]
+        while len(unsettled):
+            evap_trials[unsettled] += 1
+            trial_evap = evap[unsettled]
+            available = base[unsettled] - trial_evap
+            trial_contents = np.clip(available, 0, reservoir_capacity)
+            new_evap = evaporation((start_contents[unsettled]
+                                    + trial_contents) / 2)
+            available_to_store[unsettled] = available
+            end_contents[unsettled] = trial_contents
+            evap[unsettled] = new_evap
+            unsettled = unsettled[
+                (np.abs(trial_evap - new_evap) >= TOLERANCE)
+                & (evap_trials[unsettled] <= MAX_TRIALS)]
+
+        if slope is not None:
+            closed_evap = _closed_form_array(slope, intercept, start_contents,
+                                             base, reservoir_capacity)
+            if validate:
+                outputs["evap_delta"][t] = closed_evap - evap
+            evap = closed_evap
+            evap_trials[:] = 0
+            available_to_store = base - evap
+            end_contents = np.clip(available_to_store, 0, reservoir_capacity)
+
+        spill = np.maximum(available_to_store - reservoir_capacity, 0)
+
+        # Address case where inflows are less than PPR volume
+        ppr_supply = np.minimum(ppr_volume, inflow - evap)
+
+        # Curtail by the shortfall meeting LF target
+        # or the amount of non-PPR use, whichever is less
+        curtailment = np.minimum(-np.minimum(available_to_store, 0),
+                                 ub_depletions
+                                 - np.minimum(ub_depletions, ppr_supply))
+
+        # Calculate the water balance to determine the flow at Lee Ferry,
+        # which is the release from the reservoir
+        lees_ferry_flow = _round_tens(depleted_inflow
+                                      + start_contents
+                                      - end_contents
+                                      - evap
+                                      + curtailment)
+        record[:, oldest] = lees_ferry_flow
+        record_sum += lees_ferry_flow
+        oldest = (oldest + 1) % record.shape[1]
+
+        ub_bu = np.rint(ub_depletions - curtailment).astype(np.int64)
+        ub_cu = np.rint(ub_bu + evap).astype(np.int64)
+
+        # If we have a curtailment, how long has it been from the last
+        # spill or curtailment?
+        curtailed = np.rint(curtailment) != 0
+        outputs["time_from_reset"][t] = np.where(curtailed, time_from_reset, 0)
+        time_from_reset = np.where(curtailed | (spill != 0), 0,
+                                   time_from_reset + 1)
+
+        outputs["inflow"][t] = inflow
+        outputs["start_con"][t] = start_contents
+        outputs["UB_dmd"][t] = ub_depletions
+        outputs["evap"][t] = evap
+        outputs["net_avail"][t] = available_to_store
+        outputs["spill"][t] = spill
+        outputs["curtailment"][t] = curtailment
+        outputs["end_con"][t] = end_contents
+        outputs["UB_BU"][t] = ub_bu
+        outputs["UB_CU"][t] = ub_cu
+        outputs[f"LF_{nyrs}yr_flows"][t] = record_sum
+        outputs["LF_deficit"][t] = lees_ferry_deficit
+        outputs["LF_flow"][t] = lees_ferry_flow
+        outputs["evap_trials"][t] = evap_trials
+
+        start_contents = end_contents
+
+    outputs = {name: values.T for name, values in outputs.items()}
+    return _ensemble_result(outputs, years, nyrs, trigger_func, as_frame,
+                            intervals)
+
+
+def _ensemble_compiled(flows_2d, ub_demands, start_contents, evaporation,
+                       reservoir_capacity, lees_ferry_ann_q, nyrs, record,
+                       lf_release, ppr_volume, dtype, closed_form):
+    """simulate_ensemble using the compiled kernel."""
+    n_traces, n_years = flows_2d.shape
+    balance = np.zeros((11, n_traces, n_years), dtype=dtype)
+    rounded = np.zeros((4, n_traces, n_years), dtype=np.int64)
+    resets = np.zeros((n_traces, n_years), dtype=np.int64)
+    slope, intercept = linear_evaporation[evaporation]
+    _ensemble_kernel(
+        flows_2d.astype(dtype, copy=False), np.asarray(ub_demands, dtype=dtype),
+        start_contents, slope, intercept, dtype(reservoir_capacity),
+        dtype(lees_ferry_ann_q), dtype(nyrs * lees_ferry_ann_q),
+        np.ascontiguousarray(record),
+        lf_release is mor_release, dtype(ppr_volume), closed_form, balance,
+        rounded, resets)
+    return _columns(balance, rounded, resets, nyrs)
+
+
+def _ensemble_result(outputs, years, nyrs, trigger_func, as_frame,
+                     intervals=False):
+    """Return the ensemble outputs as arrays or as a stacked DataFrame."""
+    names = output_columns(nyrs)
+    if intervals:
+        _add_intervals(outputs)
+    outputs["year"] = np.asarray(years)
+    if not as_frame:
+        return outputs
+
+    n_traces, n_years = outputs["inflow"].shape
+    years = outputs["year"]
+    stacked = {"trace": np.repeat(np.arange(n_traces), n_years),
+               "year": (years.ravel() if years.ndim == 2
+                        else np.tile(years, n_traces))}
+    stacked.update((name, outputs[name].ravel()) for name in names[1:])
+    stacked.update((name, values.ravel()) for name, values in outputs.items()
+                   if name not in stacked)
+    import pandas as pd
+    frame = pd.DataFrame(stacked)
+    if trigger_func is None:
+        frame['trgr_cut'] = _with_missing(frame['trgr_cut'].to_numpy(),
+                                          np.ones(len(frame), dtype=bool))
+    resets = frame["time_from_reset"].to_numpy()
+    frame["time_from_reset"] = _with_missing(resets, resets == 0)
+    _intervals_with_missing(frame)
+    return frame
+
+
+def simulate_ism(input_data, horizon, as_frame=False, **kwargs):
+    """
+    Simulate water balance by the Index Sequential Method.
+
+    A simulation of horizon years is started at every year of input_data,
+    wrapping around to the start of the record when it runs off the end.
+    All of the sequences are run together by simulate_ensemble.  They are
+    views of one wrapped copy of the record, not copies of each other.
+    input_data is as for simulate_trace.  A "UB demand" column is wrapped
+        along with the flows.
+    kwargs are simulate_ensemble arguments other than flows_2d and years.
+
+    Returns the simulate_ensemble outputs, start years x horizon arrays,
+    with "year" holding the year of each flow and "start_year" the first
+    year of each sequence.  If as_frame is True the sequences are stacked
+    in a DataFrame with a leading "start_year" column.
+    """
+    n = len(input_data)
+
+    def sequences(values):
+        # np.resize repeats the record as often as the horizon needs
+        wrapped = np.resize(np.asarray(values), n + horizon - 1)
+        return np.lib.stride_tricks.sliding_window_view(wrapped, horizon)
+
+    if 'UB demand' in input_data.columns:
+        kwargs['ub_demand'] = sequences(input_data['UB demand'])
+    years = sequences(input_data['year'])
+    outputs = simulate_ensemble(sequences(input_data['flow']), years=years,
+                                as_frame=as_frame, **kwargs)
+    if outputs is None:
+        return None
+    start_years = years[:, 0]
+    if as_frame:
+        outputs.insert(0, "start_year", start_years[outputs.pop("trace")])
+    else:
+        outputs["start_year"] = start_years
+    return outputs
+
+
+def simulate_policies(flows_2d, policies, as_frame=False, **kwargs):
+    """
+    Simulate an ensemble of traces under each of several trigger policies.
+
+    All of the policies are run together by one simulate_ensemble run of
+    the traces repeated once per policy, with TriggerPolicy.stack giving
+    each copy its policy.
+    policies is a list of TriggerPolicy.
+    kwargs are simulate_ensemble arguments other than flows_2d and
+        trigger_func.  Per-trace start_contents, ub_demand and
+        lees_ferry_n_year_record are repeated with the traces.
+
+    Returns the simulate_ensemble outputs as policies x traces x years
+    arrays, with "year" as simulate_ensemble returns it, or, if as_frame is
+    True, a DataFrame of the runs stacked one after another with leading
+    "policy" and "trace" columns.
+    """
+    flows_2d = np.asarray(flows_2d)
+    n_traces, n_years = flows_2d.shape
+    n_policies = len(policies)
+    if np.ndim(kwargs.get('start_contents')) == 1:
+        kwargs['start_contents'] = np.tile(kwargs['start_contents'],
+                                           n_policies)
+    for name in ('ub_demand', 'lees_ferry_n_year_record'):
+        if np.ndim(kwargs.get(name)) == 2:
+            kwargs[name] = np.tile(kwargs[name], (n_policies, 1))
+    years = kwargs.pop('years', None)
+    if years is not None and np.ndim(years) == 2:
+        years = np.tile(years, (n_policies, 1))
+    outputs = simulate_ensemble(np.tile(flows_2d, (n_policies, 1)),
+                                years=years, as_frame=as_frame,
+                                trigger_func=TriggerPolicy.stack(policies,
+                                                                 n_traces),
+                                **kwargs)
+    if outputs is None:
+        return None
+    if as_frame:
+        runs = outputs.pop("trace").to_numpy()
+        outputs.insert(0, "trace", runs % n_traces)
+        outputs.insert(0, "policy", runs // n_traces)
+        return outputs
+    for name, values in outputs.items():
+        if name != "year" or values.ndim == 2:
+            outputs[name] = values.reshape(n_policies, n_traces, -1)
+    return outputs
@@ -0,0 +1,437 @@
+# -*- coding: utf-8 -*-
+"""
+Batches of Upper Basin Water Balance model runs declared in a config file.
+
+A TOML or JSON config declares traces, named parameter sets and runs, and
+the outputs each run produces.  run_batch expands it into jobs, one per
+run and trace, followed by a summary job that depends on all of them.
+Each job is identified by a hash of its trace's flows and of its
+parameters, metadata and outputs.  When a job finishes a stamp holding the
+hash is written next to its outputs, so a job whose stamp and outputs are
+present and whose hash is unchanged is skipped.  A batch that is
+interrupted, or in which jobs fail, resumes where it stopped when it is
+run again.  The remaining jobs are spread over a pool of worker processes.
+
+An example config, reproducing the Meko run of UBWB_model_test:
+
+    output_path = "output/"
+
+    [traces]
+    meko = "input data/meko_et_al_2007_762_2005_trace.csv"
+    hd = {function = "UBWB_model_test.hd_validation_flows"}
+
+    [parameters.mor]
+    res_model = "active"
+    lees_ferry_ann_q = 8230000
+    lf_release = "mor_release"
+
+    [[runs]]
+    name = "Meko 2007 paleo_5790_8230_2317_PP_MOR"
+    traces = ["meko"]
+    parameters = "mor"
+    set = {ub_demand = 5790000, ppr_volume = 2317000}
+    metadata = {reservoir_capacity = "active,", Lees_Ferry_Ann_Q = "8230000, MOR"}
+
+    [[runs]]
+    name = "{trace}_{ub_demand}"
+    traces = ["meko", "hd"]
+    parameters = "mor"
+    grid = {ub_demand = [5500000, 6000000]}
+    outputs = ["ts"]
+
+Traces are file names, or tables with a file or a function, a module and
+    function name returning a simulate_trace input DataFrame, and
+    optionally first_year and last_year.
+Parameters are simulate_trace arguments.  lf_release and trigger_func
+    are names of UBWB_model functions, or trigger_func a table of
+    thresholds and fractions for a TriggerPolicy.
+Runs give a name, formatted with the trace name and the parameters, the
+    traces, a parameter set, extra parameters under set, a grid of
+    parameter values expanded as UBWB_model_sweep.expand_grid does, the
+    metadata written at the head of the outputs, and the outputs: "ts",
+    the time series, and "curtailments", as process_single_trace writes
+    them.  Default both.
+ts_format and max_workers may be given at the top level.
+
+Run from the repository directory, e.g.
+    python UBWB_model_batch.py runs.toml
+    python UBWB_model_batch.py runs.toml --dry-run
+
+License: CC BY-SA 4.0, https://creativecommons.org/licenses/by-sa/4.0/
+
+On Windows, code that calls run_batch must be protected by
+if __name__ == '__main__': because worker processes import the main module.
+"""
+import argparse
+import hashlib
+import importlib
+import json
+import os
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+try:
+    import tomllib
+except ImportError:
+    tomllib = None
+
+import numpy as np
+import pandas as pd
+
+import UBWB_model
+from UBWB_model import simulate_trace, TriggerPolicy
+import UBWB_model_utilities as Mu
+from UBWB_model_sweep import expand_grid, summarize_run
+
+OUTPUTS = ('ts', 'curtailments')
+STAMP_DIRECTORY = '.jobs'
+SUMMARY_FILE = 'run_summary.csv'
+
+# Traces held by each worker process, sent once when the worker starts
+_worker_traces = None
+
+
+def read_config(file_spec):
+    """Read a TOML or JSON batch config into a dict."""
+    if file_spec.endswith('.json'):
+        with open(file_spec) as file:
+            return json.load(file)
+    if tomllib is None:
+        print('ERROR: TOML configs need Python 3.11 or later')
+        return None
+    with open(file_spec, 'rb') as file:
+        return tomllib.load(file)
+
+
+def load_traces(trace_specs):
+    """
+    Load the traces of a config.  Returns a dict of trace names to
+    simulate_trace input DataFrames.
+    """
+    traces = {}
+    for name, spec in trace_specs.items():
+        if isinstance(spec, str):
+            spec = {'file': spec}
+        if 'file' in spec:
+            trace = Mu.load_trace(spec['file'])
+        else:
+            module, function = spec['function'].rsplit('.', 1)
+            trace = getattr(importlib.import_module(module), function)()
+        first = spec.get('first_year', -np.inf)
+        last = spec.get('last_year', np.inf)
+        traces[name] = trace[(trace['year'] >= first)
+                             & (trace['year'] <= last)]
+    return traces
+
+
+def trace_hash(trace):
+    """Hash of the years, flows and any UB demands of a trace."""
+    digest = hashlib.blake2b(digest_size=20)
+    for name in ('year', 'flow', 'UB demand'):
+        if name in trace.columns:
+            values = trace[name].to_numpy()
+            if values.dtype.kind == 'O':
+                # Hash objects, e.g. strings, by value, not by address
+                values = values.astype(str)
+            digest.update(f'{name}:{values.dtype}:'.encode())
+            digest.update(np.ascontiguousarray(values).tobytes())
+    return digest.hexdigest()
+
+
+def _metadata_text(metadata):
+    """Metadata lines as process_single_trace writes them."""
+    if isinstance(metadata, dict):
+        return '\n'.join(f'{key},{value}' for key, value in metadata.items())
+    return metadata
+
+
+def expand_jobs(config, trace_hashes):
+    """
+    The run jobs of a config, in config order, as dicts holding the job
+    name, trace name, parameters as written in the config, metadata,
+    outputs, and key, the hash identifying the job.
+    """
+    parameter_sets = config.get('parameters', {})
+    ts_format = config.get('ts_format', '.csv')
+    jobs = []
+    names = set()
+    for run in config['runs']:
+        base = dict(parameter_sets.get(run.get('parameters'), {}))
+        base.update(run.get('set', {}))
+        for grid_parameters in expand_grid(run.get('grid', {})):
+            parameters = dict(base, **grid_parameters)
+            for trace_name in run['traces']:
+                name = run['name'].format(trace=trace_name, **parameters)
+                if name in names:
+                    print(f'ERROR: duplicate job name {name}')
+                    return None
+                names.add(name)
+                job = {'name': name,
+                       'trace': trace_name,
+                       'parameters': parameters,
+                       'metadata': _metadata_text(run.get('metadata', '')),
+                       'outputs': list(run.get('outputs', OUTPUTS)),
+                       'ts_format': ts_format}
+                job['key'] = hashlib.blake2b(
+                    json.dumps([trace_hashes[trace_name], job],
+                               sort_keys=True).encode(),
+                    digest_size=20).hexdigest()
+                jobs.append(job)
+    return jobs
+
+
+def resolve_parameters(parameters):
+    """simulate_trace arguments of config parameters, with functions
+    named by the config replaced by the functions."""
+    kwargs = dict(parameters)
+    if isinstance(kwargs.get('lf_release'), str):
+        kwargs['lf_release'] = getattr(UBWB_model, kwargs['lf_release'])
+    trigger = kwargs.get('trigger_func')
+    if isinstance(trigger, str):
+        kwargs['trigger_func'] = getattr(UBWB_model, trigger)
+    elif isinstance(trigger, dict):
+        kwargs['trigger_func'] = TriggerPolicy.from_dict(trigger)
+    if 'lf_windows' in kwargs:
+        kwargs['lf_windows'] = tuple(kwargs['lf_windows'])
+    return kwargs
+
+
+def output_files(job, output_path):
+    """Files a job writes."""
+    files = []
+    if 'ts' in job['outputs']:
+        files.append(f"{output_path}{job['name']}.TS{job['ts_format']}")
+    if 'curtailments' in job['outputs']:
+        files.append(f"{output_path}{job['name']}.curtailments.csv")
+    return files
+
+
+def _stamp_file(output_path, name):
+    return os.path.join(output_path, STAMP_DIRECTORY, f'{name}.json')
+
+
+def read_stamp(job, output_path):
+    """
+    The stamp of a job if it is up to date: its key matches and all of its
+    outputs exist.  Otherwise None.
+    """
+    try:
+        with open(_stamp_file(output_path, job['name'])) as file:
+            stamp = json.load(file)
+    except (OSError, ValueError):
+        return None
+    if stamp.get('key') != job['key']:
+        return None
+    if not all(os.path.exists(file_spec)
+               for file_spec in output_files(job, output_path)):
+        return None
+    return stamp
+
+
+def _write_stamp(job, output_path, summary):
+    """Record a finished job.  The stamp is written whole or not at all."""
+    file_spec = _stamp_file(output_path, job['name'])
+    temporary = f'{file_spec}.{os.getpid()}.tmp'
+    with open(temporary, 'w') as file:
+        json.dump({'key': job['key'], 'summary': summary}, file, indent=1)
+    os.replace(temporary, file_spec)
+
+
+def _init_worker(traces):
+    global _worker_traces
+    _worker_traces = traces
+
+
+def run_job(job, output_path, traces=None):
+    """
+    Run one job and write its outputs.  Returns the summarize_run metrics
+    of the run as a dict of JSON types.
+    """
+    if traces is None:
+        traces = _worker_traces
+    outputs = simulate_trace(traces[job['trace']],
+                             **resolve_parameters(job['parameters']))
+    if outputs is None:
+        raise ValueError(f"simulate_trace failed for {job['name']}")
+    # Written beside the stamps, then moved into place, so an interrupted
+    # job leaves no partial outputs
+    with tempfile.TemporaryDirectory(
+            dir=os.path.join(output_path, STAMP_DIRECTORY)) as scratch:
+        # process_single_trace writes both outputs; keep those asked for
+        Mu.process_single_trace(outputs, job['name'], f'{scratch}/',
+                                metadata=job['metadata'],
+                                ts_format=job['ts_format'])
+        for file_spec in output_files(job, output_path):
+            os.replace(os.path.join(scratch, os.path.basename(file_spec)),
+                       file_spec)
+    return {name: value.item() if isinstance(value, np.generic) else value
+            for name, value in summarize_run(outputs).items()}
+
+
+def run_batch(config, max_workers=None, force=False, dry_run=False):
+    """
+    Run the jobs of a config that are not up to date.
+
+    config is a dict, as read_config returns, or the name of a config file.
+    max_workers is the number of worker processes, default the config's
+        max_workers or one per core.  With 1 the jobs are run in this
+        process.
+    force reruns every job.
+    dry_run lists the jobs and whether they would run, without running
+        them.
+
+    Failed jobs are reported and the rest of the batch carries on.  The
+    summary job writes run_summary.csv, one row per job that has finished,
+    with its trace, parameters and summarize_run metrics.
+
+    Returns a dict of job names to 'skipped', 'done' or 'failed', or None
+    if the config is in error.
+    """
+    if isinstance(config, str):
+        config = read_config(config)
+        if config is None:
+            return None
+    output_path = config.get('output_path', './')
+    traces = load_traces(config.get('traces', {}))
+    jobs = expand_jobs(config, {name: trace_hash(trace)
+                                for name, trace in traces.items()})
+    if jobs is None:
+        return None
+    status = {}
+    summaries = {}
+    pending = []
+    for job in jobs:
+        stamp = None if force else read_stamp(job, output_path)
+        if stamp is None:
+            pending.append(job)
+        else:
+            status[job['name']] = 'skipped'
+            summaries[job['name']] = stamp['summary']
+    if dry_run:
+        for job in jobs:
+            print(f"{job['name']}: "
+                  f"{status.get(job['name'], 'to run')}")
+        return status
+    os.makedirs(os.path.join(output_path, STAMP_DIRECTORY), exist_ok=True)
+
+    def finish(job, summary=None, error=None):
+        if error is not None:
+            print(f"ERROR: job {job['name']} failed: {error}")
+            status[job['name']] = 'failed'
+            return
+        _write_stamp(job, output_path, summary)
+        summaries[job['name']] = summary
+        status[job['name']] = 'done'
+        print(f"{job['name']}: done")
+
+    if max_workers is None:
+        max_workers = config.get('max_workers', os.cpu_count() or 1)
+    if max_workers == 1 or len(pending) <= 1:
+        for job in pending:
+            try:
+                finish(job, run_job(job, output_path, traces))
+            except Exception as error:
+                finish(job, error=error)
+    else:
+        used = {job['trace'] for job in pending}
+        with ProcessPoolExecutor(
+                max_workers=max_workers, initializer=_init_worker,
+                initargs=({name: traces[name] for name in used},)
+                ) as executor:
+            futures = {executor.submit(run_job, job, output_path): job
+                       for job in pending}
+            for future in as_completed(futures):
+                try:
+                    finish(futures[future], future.result())
+                except Exception as error:
+                    finish(futures[future], error=error)
+
+    # Summary job, after all the runs
+    rows = [{'run': job['name'], 'trace': job['trace'], **job['parameters'],
+             **summaries[job['name']]}
+            for job in jobs if job['name'] in summaries]
+    pd.DataFrame(rows).to_csv(f'{output_path}{SUMMARY_FILE}', index=False,
+                              lineterminator='\n')
+    return status
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('config', help='TOML or JSON batch config')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='worker processes, default one per core')
+    parser.add_argument('--force', action='store_true',
+                        help='rerun jobs that are up to date')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='list the jobs that would run')
+    args = parser.parse_args(argv)
+
+    status = run_batch(args.config, args.workers, args.force, args.dry_run)
+    if status is None:
+        return 2
+    counts = {state: list(status.values()).count(state)
+              for state in ('done', 'skipped', 'failed')}
+    print(', '.join(f'{count} {state}' for state, count in counts.items()))
+    return 1 if counts['failed'] else 0
+
+
+'''
+Test functions for this module.
+'''
+
+CANONICAL_RUN = 'Meko 2007 paleo_5790_8230_2317_PP_MOR'
+TEST_CONFIG = '''
+[traces]
+meko = "{data_path}meko_et_al_2007_762_2005_trace.csv"
+hd = {{function = "UBWB_model_test.hd_validation_flows"}}
+
+[parameters.mor]
+res_model = "active"
+lees_ferry_ann_q = 8230000
+lf_release = "mor_release"
+
+[[runs]]
+name = "{run_name}"
+traces = ["meko"]
+parameters = "mor"
+set = {{ub_demand = 5790000, ppr_volume = 2317000}}
+metadata = """reservoir_capacity,active,
+Lees_Ferry_Ann_Q,8230000, MOR
+UB_demand,5790000
+PPR_volume,3317000
+Trigger,False"""
+
+[[runs]]
+name = "{{trace}}_{{ub_demand}}_{{trigger_func}}"
+traces = ["meko", "hd"]
+parameters = "mor"
+grid = {{ub_demand = [5500000, 6000000], trigger_func = ["trigger_cutback"]}}
+outputs = ["ts"]
+'''
+
+
+def test_batch(data_path):
+    with tempfile.TemporaryDirectory() as output_path:
+        output_path = f'{output_path}/'
+        config = tomllib.loads(TEST_CONFIG.format(data_path=data_path,
+                                                 run_name=CANONICAL_RUN))
+        config['output_path'] = output_path
+        print(run_batch(config, max_workers=2))
+        for kind in ('TS', 'curtailments'):
+            with open(f'{output_path}{CANONICAL_RUN}.{kind}.csv') as file, \
+                    open(f'canonical_test_outputs/{CANONICAL_RUN}.{kind}.csv'
+                         ) as canonical:
+                print(f'{kind} matches canonical output: '
+                      f'{file.read() == canonical.read()}')
+
+        # Nothing to do the second time
+        print(run_batch(config, max_workers=2))
+        # An interrupted job, and a changed parameter
+        os.remove(_stamp_file(output_path, 'hd_5500000_trigger_cutback'))
+        config['runs'][1]['grid']['ub_demand'][1] = 6100000
+        print(run_batch(config, max_workers=1))
+        print(pd.read_csv(f'{output_path}{SUMMARY_FILE}').to_string())
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the Upper Basin Water Balance model and its post-processing.
+
+Times simulate_trace on the 2007HD validation flows, the low-flow test
+and the Meko trace, simulate_ensemble on ensembles of up to 10,000
+bootstrapped traces, and characterize_spells, calculate_intervals,
+write_percentiles and process_single_trace on the Meko run and on the
+outputs of each ensemble.  Each result holds the best wall time of
+several repeats, the time per simulated or processed year and the peak
+memory allocated, and is written to a JSON results file.
+Results can be compared with a stored baseline, flagging workloads that
+have slowed by more than a threshold ratio and a minimum time.
+
+Run from the repository directory, e.g.
+    python UBWB_model_benchmark.py --baseline benchmark_baseline.json
+    python UBWB_model_benchmark.py --save-baseline benchmark_baseline.json
+
+License: CC BY-SA 4.0, https://creativecommons.org/licenses/by-sa/4.0/
+"""
+import argparse
+import io
+import json
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from UBWB_model import simulate_trace, simulate_ensemble, numba
+import UBWB_model_utilities as Mu
+import UBWB_model_generator as Mg
+import UBWB_model_test as Mt
+
+# Slowdown, as a ratio of times, reported as a regression
+THRESHOLD = 1.25
+# Smallest slowdown, in seconds, reported as a regression, so that timer
+# noise in millisecond workloads is not
+MIN_SLOWDOWN = 0.01
+# Fewest repeats for results compared with a baseline
+MIN_REPEATS = 3
+ENSEMBLE_SIZES = (100, 1000, 10000)
+ENSEMBLE_YEARS = 100
+
+
+def measure(function, repeats=3):
+    """
+    Best wall time of repeats calls of function, in seconds, and the peak
+    memory allocated by one call, in bytes.  Memory is traced in a
+    separate call because tracing slows the code.
+    """
+    function()  # warm up caches and compilation
+    seconds = np.inf
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        seconds = min(seconds, time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        function()
+        peak_bytes = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return seconds, peak_bytes
+
+
+def workloads(data_path, output_path, quick=False):
+    """
+    The benchmarked workloads, as (name, years, function) tuples, where
+    years is the number of trace-years each call handles.  Files written
+    by process_single_trace go to output_path.
+    """
+    model = {'ub_demand': 5790000, 'ppr_volume': 2317000}
+    hd_flows = Mt.hd_validation_flows()
+    low_flows = Mt.low_flow_test_flows()
+    meko_flows = Mu.load_trace(
+        f"{data_path}meko_et_al_2007_762_2005_trace.csv")
+    meko_outputs = simulate_trace(meko_flows, **model)
+
+    jobs = [
+        ('simulate_trace HD 1929-2000', len(hd_flows),
+         lambda: simulate_trace(hd_flows, **model)),
+        ('simulate_trace low flow test', len(low_flows),
+         lambda: simulate_trace(low_flows, **model)),
+        ('simulate_trace Meko', len(meko_flows),
+         lambda: simulate_trace(meko_flows, **model)),
+        ]
+    if numba is not None:
+        jobs.append(('simulate_trace Meko numba', len(meko_flows),
+                     lambda: simulate_trace(meko_flows, engine='numba',
+                                            **model)))
+    # Post-processing is timed on the Meko run and on the outputs of each
+    # ensemble, its traces end to end
+    post_processing = {'Meko': meko_outputs}
+    for n_traces in ENSEMBLE_SIZES[:2] if quick else ENSEMBLE_SIZES:
+        flows = Mg.block_bootstrap(meko_flows['flow'].to_numpy(), n_traces,
+                                   ENSEMBLE_YEARS, rng=n_traces)
+        jobs.append((f'simulate_ensemble {n_traces} traces', flows.size,
+                     lambda flows=flows: simulate_ensemble(flows, **model)))
+        post_processing[f'{n_traces} traces'] = simulate_ensemble(
+            flows, as_frame=True, **model)
+
+    for label, outputs in post_processing.items():
+        curtailment = outputs['curtailment']
+        nested_spells, _ = Mu.characterize_spells(curtailment)
+        years = len(outputs)
+        jobs += [
+            (f'characterize_spells {label}', years,
+             lambda curtailment=curtailment:
+                 Mu.characterize_spells(curtailment)),
+            (f'calculate_intervals {label}', years,
+             lambda outputs=outputs: Mu.calculate_intervals(outputs)),
+            (f'write_percentiles {label} nested spells', years,
+             lambda nested_spells=nested_spells:
+                 Mu.write_spell_percentiles(io.StringIO(), nested_spells,
+                                            Mu.DEFAULT_QUANTILES)),
+            (f'process_single_trace {label}', years,
+             lambda outputs=outputs:
+                 Mu.process_single_trace(outputs, 'benchmark', output_path)),
+            ]
+    return jobs
+
+
+def run_benchmarks(data_path, quick=False, repeats=3):
+    """
+    Run the workloads.  Returns a dict of machine information and a dict
+    of results keyed by workload name.
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as output_path:
+        for name, years, function in workloads(data_path, f'{output_path}/',
+                                               quick):
+            seconds, peak_bytes = measure(function, repeats)
+            results[name] = {'years': years,
+                             'seconds': seconds,
+                             'microseconds_per_year': seconds / years * 1e6,
+                             'peak_mb': peak_bytes / 2 ** 20}
+            print(f"{name}: {seconds * 1000:.2f} ms, "
+                  f"{seconds / years * 1e6:.2f} us/year, "
+                  f"peak {peak_bytes / 2 ** 20:.1f} MB")
+    return {'machine': {'platform': platform.platform(),
+                        'python': platform.python_version(),
+                        'numpy': np.__version__,
+                        'pandas': pd.__version__,
+                        'numba': None if numba is None else numba.__version__,
+                        'time': time.strftime('%Y-%m-%d %H:%M:%S')},
+            'results': results}
+
+
+def compare(results, baseline, threshold=THRESHOLD,
+            min_slowdown=MIN_SLOWDOWN):
+    """
+    Compare results with a baseline, both as returned by run_benchmarks.
+    Returns the names of the workloads whose time is more than threshold
+    times their baseline time and more than min_slowdown seconds longer.
+    """
+    regressions = []
+    for name, result in results['results'].items():
+        if name not in baseline['results']:
+            print(f"{name}: not in baseline")
+            continue
+        baseline_seconds = baseline['results'][name]['seconds']
+        ratio = result['seconds'] / baseline_seconds
+        flag = (ratio > threshold
+                and result['seconds'] - baseline_seconds > min_slowdown)
+        if flag:
+            regressions.append(name)
+        print(f"{name}: {ratio:.2f} x baseline"
+              f"{'  REGRESSION' if flag else ''}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--data-path', default='./input data/')
+    parser.add_argument('--results', default='benchmark_results.json',
+                        help='file to write the results to')
+    parser.add_argument('--baseline', help='results file to compare with')
+    parser.add_argument('--save-baseline',
+                        help='also write the results to this file')
+    parser.add_argument('--threshold', type=float, default=THRESHOLD)
+    parser.add_argument('--min-slowdown', type=float, default=MIN_SLOWDOWN,
+                        help='seconds a regression must add, default '
+                             f'{MIN_SLOWDOWN}')
+    parser.add_argument('--repeats', type=int, default=3,
+                        help=f'at least {MIN_REPEATS} with --baseline')
+    parser.add_argument('--quick', action='store_true',
+                        help='skip the largest ensemble')
+    args = parser.parse_args(argv)
+    if args.baseline and args.repeats < MIN_REPEATS:
+        print(f'ERROR: comparing with a baseline needs at least '
+              f'{MIN_REPEATS} repeats')
+        return 2
+
+    results = run_benchmarks(args.data_path, args.quick, args.repeats)
+    for file_spec in (args.results, args.save_baseline):
+        if file_spec:
+            with open(file_spec, 'w') as file:
+                json.dump(results, file, indent=1)
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        regressions = compare(results, baseline, args.threshold,
+                              args.min_slowdown)
+        if regressions:
+            print(f"{len(regressions)} regressions beyond "
+                  f"{args.threshold:.2f} x baseline and "
+                  f"{args.min_slowdown * 1000:.0f} ms")
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
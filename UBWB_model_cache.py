@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+"""
+Result cache for the Upper Basin Water Balance model.
+
+RunCache.simulate_trace returns the outputs of an earlier identical run
+instead of simulating again.  Runs are identified by a hash of the input
+flows, years and UB demand column and of every simulate_trace argument.
+Callable arguments, such as lf_release and trigger_func, are identified
+by their qualified name and a version tag, the function's cache_version
+attribute if it has one.  Change the tag when a function's results change.
+
+Results are held in memory, least recently used first out, and, if a
+directory is given, on disk, where the least recently used files are
+removed when the directory grows past a size limit.
+
+License: CC BY-SA 4.0, https://creativecommons.org/licenses/by-sa/4.0/
+"""
+import collections
+import copy
+import hashlib
+import inspect
+import os
+import pickle
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from UBWB_model import mor_release, simulate_trace, RunState, TriggerPolicy
+import UBWB_model_utilities as Mu
+
+_SIGNATURE = inspect.signature(simulate_trace)
+
+
+def callable_tag(function):
+    """
+    Qualified name and version tag that identify a callable argument.  A
+    TriggerPolicy is identified by a hash of its table.
+    """
+    if isinstance(function, TriggerPolicy):
+        return f'TriggerPolicy:{function.cache_tag()}'
+    return (f"{function.__module__}.{function.__qualname__}"
+            f":{getattr(function, 'cache_version', '')}")
+
+
+def run_key(input_data, **kwargs):
+    """
+    Hash identifying a simulate_trace run of input_data with kwargs.
+    Arguments left out count as their defaults.
+    """
+    arguments = _SIGNATURE.bind(input_data, **kwargs)
+    arguments.apply_defaults()
+    digest = hashlib.blake2b(digest_size=20)
+    columns = ['year', 'flow'] + (['UB demand']
+                                  if 'UB demand' in input_data else [])
+    arrays = [np.asarray(input_data[name]) for name in columns]
+    if isinstance(input_data, pd.DataFrame):
+        arrays.append(input_data.index.to_numpy())
+    for values in arrays:
+        if values.dtype.kind == 'O':
+            # Hash objects, e.g. strings, by value, not by address
+            values = values.astype(str)
+        digest.update(str(values.dtype).encode())
+        digest.update(np.ascontiguousarray(values).tobytes())
+    for name, value in arguments.arguments.items():
+        if name == 'input_data':
+            continue
+        if callable(value):
+            value = callable_tag(value)
+        elif isinstance(value, RunState):
+            # By value, as to_dict gives it, with callables tagged as above
+            value = {**vars(value), 'parameters': {
+                name: callable_tag(parameter) if callable(parameter)
+                else parameter
+                for name, parameter in value.parameters.items()}}
+        elif isinstance(value, np.ndarray):
+            value = (value.dtype.str, value.shape,
+                     hashlib.blake2b(np.ascontiguousarray(value)).hexdigest())
+        digest.update(f"{name}={value!r};".encode())
+    return digest.hexdigest()
+
+
+def _copy(outputs):
+    """Copy of run outputs, so callers cannot change a cached result."""
+    if isinstance(outputs, tuple):
+        # return_state=True: outputs and a RunState
+        outputs, state = outputs
+        return _copy(outputs), copy.deepcopy(state)
+    if isinstance(outputs, pd.DataFrame):
+        return outputs.copy()
+    return {name: values.copy() for name, values in outputs.items()}
+
+
+class RunCache:
+    """
+    Memoized simulate_trace.
+
+    max_entries is the number of results held in memory.
+    directory, if given, holds a second tier of results on disk, limited
+    to max_bytes.
+    """
+
+    def __init__(self, max_entries=256, directory=None, max_bytes=2 ** 30):
+        self.max_entries = max_entries
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._memory = collections.OrderedDict()
+        self.counts = dict.fromkeys(
+            ('memory_hits', 'disk_hits', 'misses', 'memory_evictions',
+             'disk_evictions'), 0)
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def stats(self):
+        """Hit and miss counts, the hit rate and the sizes of the tiers."""
+        hits = self.counts['memory_hits'] + self.counts['disk_hits']
+        lookups = hits + self.counts['misses']
+        return {**self.counts,
+                'hit_rate': hits / lookups if lookups else 0.0,
+                'memory_entries': len(self._memory),
+                'disk_bytes': sum(size for _, size, _ in self._disk_files())}
+
+    def clear(self):
+        """Remove every cached result."""
+        self._memory.clear()
+        for file_spec, _, _ in self._disk_files():
+            os.remove(file_spec)
+
+    def simulate_trace(self, input_data, **kwargs):
+        """
+        simulate_trace(input_data, **kwargs), from the cache if the same run
+        has been made before.  As with simulate_trace, a
+        lees_ferry_n_year_record list is updated in place.  Runs with stats
+        are always simulated and not cached.  With return_state, the
+        outputs and RunState are cached together.
+        """
+        if kwargs.get('stats') is not None:
+            return simulate_trace(input_data, **kwargs)
+        key = run_key(input_data, **kwargs)
+        entry = self._get(key)
+        if entry is None:
+            self.counts['misses'] += 1
+            record = kwargs.get('lees_ferry_n_year_record')
+            outputs = simulate_trace(input_data, **kwargs)
+            if outputs is None:
+                return None
+            entry = (_copy(outputs), None if record is None else list(record))
+            self._put(key, entry)
+            return outputs
+        outputs, record = entry
+        if record is not None:
+            kwargs['lees_ferry_n_year_record'][:] = record
+        return _copy(outputs)
+
+    def _get(self, key):
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            self.counts['memory_hits'] += 1
+            return self._memory[key]
+        if self.directory is None:
+            return None
+        file_spec = os.path.join(self.directory, f'{key}.pkl')
+        try:
+            with open(file_spec, 'rb') as file:
+                entry = pickle.load(file)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        os.utime(file_spec)  # mark as recently used
+        self.counts['disk_hits'] += 1
+        self._remember(key, entry)
+        return entry
+
+    def _put(self, key, entry):
+        self._remember(key, entry)
+        if self.directory is None:
+            return
+        file_spec = os.path.join(self.directory, f'{key}.pkl')
+        temporary = f'{file_spec}.{os.getpid()}.tmp'
+        with open(temporary, 'wb') as file:
+            pickle.dump(entry, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary, file_spec)
+        self._evict_disk()
+
+    def _remember(self, key, entry):
+        self._memory[key] = entry
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+            self.counts['memory_evictions'] += 1
+
+    def _disk_files(self):
+        """(path, size, last use) of each file in the disk tier."""
+        if self.directory is None:
+            return []
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.pkl'):
+                status = entry.stat()
+                files.append((entry.path, status.st_size, status.st_mtime))
+        return files
+
+    def _evict_disk(self):
+        files = sorted(self._disk_files(), key=lambda file: file[2])
+        total = sum(size for _, size, _ in files)
+        for file_spec, size, _ in files:
+            if total <= self.max_bytes:
+                break
+            os.remove(file_spec)
+            total -= size
+            self.counts['disk_evictions'] += 1
+
+
+'''
+Test functions for this module.
+'''
+
+def test_cache(data_path):
+    meko_flows = Mu.load_trace(
+        f"{data_path}meko_et_al_2007_762_2005_trace.csv")
+    with tempfile.TemporaryDirectory() as directory:
+        cache = RunCache(max_entries=2, directory=directory)
+        for ub_demand in (5790000, 6000000, 5790000, 6200000, 6400000,
+                          5790000):
+            start = time.perf_counter()
+            outputs = cache.simulate_trace(meko_flows, ub_demand=ub_demand,
+                                           ppr_volume=2317000)
+            print(f"UB demand {ub_demand}: "
+                  f"{(time.perf_counter() - start) * 1000:.2f} ms")
+        direct = simulate_trace(meko_flows, ub_demand=5790000,
+                                ppr_volume=2317000)
+        print(f"cached outputs equal: {outputs.equals(direct)}")
+        print(cache.stats())
+
+    # A new version tag of a callable argument is a different run
+    def release(lf_ann_q, lf_deficit, *args):
+        return mor_release(lf_ann_q, lf_deficit)
+    before = run_key(meko_flows, lf_release=release)
+    release.cache_version = 2
+    after = run_key(meko_flows, lf_release=release)
+    print(f"version tag changes key: {before != after}")
+
+    # Equal string columns and indexes, and dict input
+    labeled = meko_flows.iloc[:100].astype({'year': str})
+    labeled.index = labeled['year']
+    copies = [labeled.copy(deep=True) for _ in range(2)]
+    print(f"equal string frames have the same key: "
+          f"{run_key(copies[0]) == run_key(copies[1])}")
+    arrays = {name: meko_flows[name].to_numpy() for name in ('year', 'flow')}
+    cache = RunCache()
+    cache.simulate_trace(arrays, as_arrays=True)
+    cached = cache.simulate_trace(dict(arrays), as_arrays=True)
+    direct = simulate_trace(meko_flows, as_arrays=True)
+    print(f"dict input cached: {cache.stats()['memory_hits'] == 1}, "
+          f"equal: {np.array_equal(cached['end_con'], direct['end_con'])}")
+
+    # Trigger policies are keyed by their tables, and states by value
+    policy_keys = {run_key(meko_flows, trigger_func=policy)
+                   for policy in (TriggerPolicy([0.2], [0.3, 0]),
+                                  TriggerPolicy([0.2], [0.4, 0]),
+                                  TriggerPolicy([0.2], [0.3, 0], 'copy'))}
+    print(f"policy keys differ by table: {len(policy_keys) == 2}")
+    cache = RunCache()
+    first, state = cache.simulate_trace(
+        meko_flows.iloc[:100], trigger_func=TriggerPolicy([0.2], [0.3, 0]),
+        ub_demand=6200000, return_state=True)
+    cached, cached_state = cache.simulate_trace(
+        meko_flows.iloc[:100], trigger_func=TriggerPolicy([0.2], [0.3, 0]),
+        ub_demand=6200000, return_state=True)
+    print(f"cached state equal: {cached_state == state}")
+    reloaded = RunState.from_dict(state.to_dict())
+    state_keys = {run_key(meko_flows.iloc[100:], state=run_state)
+                  for run_state in (state, reloaded)}
+    print(f"reloaded state has the same key: {len(state_keys) == 1}")
+    cache.simulate_trace(meko_flows.iloc[100:], state=state)
+    cache.simulate_trace(meko_flows.iloc[100:], state=reloaded)
+    print(cache.stats())
+
+
+if __name__ == '__main__':
+
+    data_path = './input data/'
+    test_cache(data_path)
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""
+Command-line entry point for the Upper Basin Water Balance model.
+
+Runs simulate_trace on a trace file, with its parameters given as flags,
+and writes the time series outputs as CSV.  Only NumPy and the standard
+library are imported, so each run starts quickly, e.g. in scripts that
+run the model many times.
+
+Run from the repository directory, e.g.
+    python -m UBWB_model_cli "input data/meko_et_al_2007_762_2005_trace.csv"
+        --ub-demand 5790000 --ppr-volume 2317000 --output meko.TS.csv
+
+The trace file is a CSV file with columns "year" and "flow", and
+optionally "UB demand", as simulate_trace takes.  Lines starting with #
+are comments.
+
+License: CC BY-SA 4.0, https://creativecommons.org/licenses/by-sa/4.0/
+"""
+import argparse
+import csv
+import os
+import sys
+
+import numpy as np
+
+from UBWB_model import (simulate_trace, output_columns, mor_release,
+                        no_mor_release, trigger_cutback, reservoir_models,
+                        ENGINES, EVAP_SOLVERS)
+
+LF_RELEASES = {'mor': mor_release, 'no_mor': no_mor_release}
+TRIGGERS = {'none': None, 'cutback': trigger_cutback}
+
+
+def _number(text):
+    """An int if text is one, else a float."""
+    try:
+        return int(text)
+    except ValueError:
+        return float(text)
+
+
+def read_trace(file_spec):
+    """
+    Read a trace CSV file into a dict of arrays keyed by column name, as
+    simulate_trace takes it.
+    """
+    with open(file_spec, newline='') as file:
+        rows = csv.reader(line for line in file
+                          if line.strip() and not line.startswith('#'))
+        names = [name.strip() for name in next(rows)]
+        columns = list(zip(*rows))
+    return {name: np.array([_number(value) for value in values])
+            for name, values in zip(names, columns)}
+
+
+def _text(value, missing):
+    """A value as pandas writes it to CSV, blank if missing."""
+    if missing:
+        return ''
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def write_outputs(file, outputs, trigger_func=None, nyrs=10):
+    """
+    Write simulate_trace array outputs as CSV, as the DataFrame returned by
+    simulate_trace is written by write_ts_output: trgr_cut is blank when
+    there is no trigger_func and time_from_reset blank where it is zero.
+    """
+    columns = output_columns(nyrs)
+    columns += [name for name in outputs if name not in columns]
+    n = len(outputs['year'])
+    missing = {name: np.zeros(n, dtype=bool) for name in columns}
+    if trigger_func is None:
+        missing['trgr_cut'][:] = True
+    missing['time_from_reset'] = outputs['time_from_reset'] == 0
+    for name in ('from_spill', 'from_curtailment'):
+        if name in outputs:
+            missing[name] = np.isnan(outputs[name])
+            outputs[name] = np.where(missing[name], 0,
+                                     outputs[name]).astype(np.int64)
+    writer = csv.writer(file, lineterminator='\n')
+    writer.writerow(columns)
+    values = [outputs[name].tolist() for name in columns]
+    flags = [missing[name].tolist() for name in columns]
+    for row, row_flags in zip(zip(*values), zip(*flags)):
+        writer.writerow([_text(value, flag)
+                         for value, flag in zip(row, row_flags)])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('trace_file', help='CSV file of year and flow')
+    parser.add_argument('--output', help='CSV file to write, default stdout')
+    parser.add_argument('--start-contents', type=_number, default=None)
+    parser.add_argument('--res-model', default='active',
+                        choices=list(reservoir_models))
+    parser.add_argument('--lees-ferry-ann-q', type=_number, default=8230000)
+    parser.add_argument('--nyrs', type=int, default=10)
+    parser.add_argument('--lf-release', default='mor',
+                        choices=list(LF_RELEASES))
+    parser.add_argument('--ub-demand', type=_number, default=5760000)
+    parser.add_argument('--ppr-volume', type=_number, default=2267000)
+    parser.add_argument('--trigger', default='none', choices=list(TRIGGERS))
+    parser.add_argument('--engine', default='python', choices=ENGINES)
+    parser.add_argument('--evap-solver', default='iterative',
+                        choices=EVAP_SOLVERS)
+    parser.add_argument('--intervals', action='store_true',
+                        help='add from_spill and from_curtailment columns')
+    args = parser.parse_args(argv)
+
+    trigger_func = TRIGGERS[args.trigger]
+    outputs = simulate_trace(read_trace(args.trace_file),
+                             start_contents=args.start_contents,
+                             res_model=args.res_model,
+                             lees_ferry_ann_q=args.lees_ferry_ann_q,
+                             nyrs=args.nyrs,
+                             lf_release=LF_RELEASES[args.lf_release],
+                             ub_demand=args.ub_demand,
+                             ppr_volume=args.ppr_volume,
+                             trigger_func=trigger_func,
+                             as_arrays=True, engine=args.engine,
+                             evap_solver=args.evap_solver,
+                             intervals=args.intervals)
+    if outputs is None:
+        return 1
+    if args.output is None:
+        write_outputs(sys.stdout, outputs, trigger_func, args.nyrs)
+        return 0
+    with open(args.output, 'w', newline='') as file:
+        write_outputs(file, outputs, trigger_func, args.nyrs)
+    curtailment = outputs['curtailment']
+    print(f"{len(curtailment)} years, {int((curtailment > 0).sum())} "
+          f"with curtailment, total curtailment {curtailment.sum()}, "
+          f"minimum storage {outputs['end_con'].min()}")
+    return 0
+
+
+'''
+Test functions for this module.
+'''
+
+def test_cli(data_path, output_path):
+    # Imported here so that the command line does not load pandas
+    import subprocess
+    import time
+
+    import UBWB_model_utilities as Mu
+
+    trace_file = f"{data_path}meko_et_al_2007_762_2005_trace.csv"
+    output_file = f"{output_path}test_cli.TS.csv"
+    main([trace_file, '--ub-demand', '5790000', '--ppr-volume', '2317000',
+          '--output', output_file])
+    outputs = simulate_trace(Mu.load_trace(trace_file), ub_demand=5790000,
+                             ppr_volume=2317000)
+    Mu.write_ts_output(f"{output_path}test_cli_pandas.TS.csv", {}, outputs)
+    with open(output_file) as cli_file, \
+            open(f"{output_path}test_cli_pandas.TS.csv") as pandas_file:
+        print(f"CLI output matches write_ts_output: "
+              f"{cli_file.read() == pandas_file.read()}")
+
+    # Cold start of a short run, with and without pandas
+    commands = {
+        'python -m UBWB_model_cli': [
+            sys.executable, '-m', 'UBWB_model_cli', trace_file,
+            '--output', os.devnull],
+        'UBWB_model_utilities and simulate_trace': [
+            sys.executable, '-c',
+            'import UBWB_model_utilities as Mu; '
+            f'Mu.simulate_trace(Mu.pd.read_csv({trace_file!r}, comment="#"))'
+            ]}
+    for name, command in commands.items():
+        start = time.perf_counter()
+        for _ in range(3):
+            subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+        print(f"{name}: {(time.perf_counter() - start) / 3:.2f} s per run")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,319 @@
+# -*- coding: utf-8 -*-
+"""
+CRWAS ensemble runner for the Upper Basin Water Balance model.
+
+Runs the hydrology ensembles of the Colorado River Water Availability
+Study (CRWAS), as "CRWAS HD model code, 2010/HD_ensemble_method.py" did,
+with UBWB_model.simulate_trace in place of the 2010 water balance.
+
+Each hydrology scenario is a tab-delimited *_ensemble.txt file with one
+trace of annual Lee Ferry flows per row.  Scenarios are grouped, e.g. into
+the 2040 and 2070 GCM sets, by a code in their file names.  The traces of
+a scenario are run in parallel, and its curtailments are written to disk
+as they are computed, so only one scenario's results are held at a time.
+
+Writes to output_path
+    all_curtailment_populations.txt, the curtailment of every trace-year
+        of every scenario, one column per scenario, as the 2010 code did,
+    {group}_curtailment_summary.csv, percentiles of the curtailments of
+        each scenario in a group and of the group as a whole, and
+    {scenario}_traces.csv, mean and maximum curtailment, curtailment years
+        and mass balance of each trace.
+
+Run from the repository directory, e.g.
+    python UBWB_model_crwas.py --output-path results/ hydrology/*_ensemble.txt
+
+License: CC BY-SA 4.0, https://creativecommons.org/licenses/by-sa/4.0/
+
+On Windows, code that calls run_scenarios must be protected by
+if __name__ == '__main__': because worker processes import the main module.
+"""
+import argparse
+import itertools
+import math
+import os
+import re
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from UBWB_model import simulate_trace
+import UBWB_model_utilities as Mu
+import UBWB_model_generator as Mg
+
+ENSEMBLE_SUFFIX = '_ensemble.txt'
+# System parameters of the 2010 runs: Lee Ferry delivery 8.25 maf, UB
+# depletions at the 82.5 maf Hydrologic Determination level, no PPR
+# volume and the capacity of all reservoirs
+CRWAS_PARAMETERS = {'res_model': 'live',
+                    'lees_ferry_ann_q': 8250000,
+                    'ub_demand': 5980000,
+                    'ppr_volume': 0}
+
+
+def scenario_name(file_spec):
+    """Name of the scenario in an ensemble file, its name less the suffix."""
+    return os.path.basename(file_spec).split(ENSEMBLE_SUFFIX)[0]
+
+
+def scenario_group(file_spec):
+    """
+    Group of a scenario, the period code of a CRWAS climate scenario name,
+    e.g. '2040' for sresa1b.ncar_ccsm3_0.2_2040.Adj_allStat..., or
+    'historical'.
+    """
+    match = re.search(r'_(20[0-9]{2})\.', scenario_name(file_spec))
+    return 'historical' if match is None else match.group(1)
+
+
+def group_scenarios(file_specs, group=scenario_group):
+    """
+    Dict of group names to lists of ensemble files, in the order the
+    groups and files are first seen.  group is a function of a file spec.
+    """
+    groups = {}
+    for file_spec in file_specs:
+        groups.setdefault(group(file_spec), []).append(file_spec)
+    return groups
+
+
+def read_ensemble(file_spec):
+    """
+    Traces of a tab-delimited ensemble file, as a traces x years array.
+    Empty columns, such as one left by trailing tabs, are dropped.
+    """
+    flows = pd.read_csv(file_spec, sep='\t', header=None, comment='#')
+    return flows.dropna(axis=1, how='all').to_numpy(dtype=np.float64)
+
+
+def _run_traces(flows, parameters):
+    """
+    Run a chunk of traces.  Returns the curtailments of each trace and a
+    row of trace metrics for each.
+    """
+    results = []
+    for trace in flows:
+        input_data = pd.DataFrame({'year': np.arange(len(trace)),
+                                   'flow': trace})
+        outputs = simulate_trace(input_data, as_arrays=True, **parameters)
+        curtailment = outputs['curtailment']
+        results.append((curtailment,
+                        {'mean_curtailment': curtailment.mean(),
+                         'max_curtailment': curtailment.max(),
+                         'curtailment_years': int((curtailment > 0).sum()),
+                         'mass_balance': Mu.check_mass_balance(outputs)}))
+    return results
+
+
+def run_scenario(flows, column_file, executor=None, chunksize=None,
+                 thresholds=(), **parameters):
+    """
+    Run the traces of one scenario, writing each curtailment to
+    column_file, one per line, in trace order.
+
+    executor is a concurrent.futures executor to spread the traces over,
+        or None to run them in this process.
+    chunksize is the number of traces sent to a worker at a time, default
+        a quarter of them.
+    thresholds are curtailments whose exceedances are counted.
+    parameters are simulate_trace arguments.
+
+    Returns an EnsembleStatistics of the curtailments and a DataFrame of
+    the metrics of each trace.
+    """
+    statistics = Mu.EnsembleStatistics(thresholds)
+    if chunksize is None:
+        chunksize = max(1, math.ceil(len(flows) / 4))
+    chunks = [flows[i:i + chunksize] for i in range(0, len(flows), chunksize)]
+    if executor is None:
+        results = map(_run_traces, chunks, itertools.repeat(parameters))
+    else:
+        results = executor.map(_run_traces, chunks,
+                               itertools.repeat(parameters))
+    rows = []
+    with open(column_file, 'w') as file:
+        for chunk_results in results:
+            for curtailment, row in chunk_results:
+                statistics.add(curtailment)
+                file.writelines(f'{value:.3f}\n' for value in curtailment)
+                rows.append(row)
+    traces = pd.DataFrame(rows, index=pd.RangeIndex(1, len(rows) + 1,
+                                                    name='trace'))
+    return statistics, traces
+
+
+def write_population_matrix(file_spec, names, column_files):
+    """
+    Write scenario curtailment columns side by side, tab-delimited with a
+    header of scenario names, as all_curtailment_populations.txt was.
+    Lines are read from each column file in step, so the matrix is never
+    held in memory.  Shorter columns are padded with blanks.
+    """
+    columns = [open(column_file) for column_file in column_files]
+    try:
+        with open(file_spec, 'w') as file:
+            file.write(''.join(f'{name}\t' for name in names) + '\n')
+            for values in itertools.zip_longest(*columns, fillvalue='\n'):
+                file.write(''.join(f'{value[:-1]}\t' for value in values)
+                           + '\n')
+    finally:
+        for column in columns:
+            column.close()
+
+
+def run_scenarios(file_specs, output_path, group=scenario_group,
+                  max_workers=None, chunksize=None,
+                  quantiles=Mu.DEFAULT_QUANTILES, thresholds=(),
+                  **parameters):
+    """
+    Run every trace of every scenario ensemble file and write the results.
+
+    file_specs are *_ensemble.txt files.
+    output_path is prefixed to the output file names.
+    group is a function of a file spec naming its scenario group.
+    max_workers is the number of worker processes, default one per core.
+        With 1 the traces are run in this process.
+    chunksize is the number of traces sent to a worker at a time.  The
+        default gives each worker about four chunks of each scenario.
+    quantiles are reported in the summaries, along with the probability
+        of curtailment exceeding each of thresholds.
+    parameters are simulate_trace arguments, default CRWAS_PARAMETERS.
+
+    Returns a dict of group names to their summary DataFrames.
+    """
+    parameters = dict(CRWAS_PARAMETERS, **parameters)
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    executor = (ProcessPoolExecutor(max_workers=max_workers)
+                if max_workers > 1 else None)
+    names = []
+    column_files = []
+    summaries = {}
+    try:
+        with tempfile.TemporaryDirectory() as column_path:
+            for group_name, group_files in group_scenarios(file_specs,
+                                                           group).items():
+                group_statistics = Mu.EnsembleStatistics(thresholds)
+                statistics = []
+                for file_spec in group_files:
+                    name = scenario_name(file_spec)
+                    print(f'Running {name}')
+                    flows = read_ensemble(file_spec)
+                    column_file = os.path.join(column_path,
+                                               f'{len(names)}.txt')
+                    size = chunksize or max(
+                        1, math.ceil(len(flows) / (4 * max_workers)))
+                    scenario_statistics, traces = run_scenario(
+                        flows, column_file, executor, size, thresholds,
+                        **parameters)
+                    traces.to_csv(f'{output_path}{name}_traces.csv',
+                                  lineterminator='\n')
+                    names.append(name)
+                    column_files.append(column_file)
+                    statistics.append(scenario_statistics)
+                    group_statistics.merge(scenario_statistics)
+                labels = ([scenario_name(file_spec)
+                           for file_spec in group_files]
+                          + [f'all {group_name}'])
+                statistics.append(group_statistics)
+                summary = Mu.percentile_table(statistics, labels, quantiles)
+                for threshold in group_statistics.thresholds:
+                    summary[f'P(>{threshold:g})'] = [
+                        (scenario.exceedance_table()
+                         .loc[threshold, 'Probability'])
+                        for scenario in statistics]
+                summary.to_csv(
+                    f'{output_path}{group_name}_curtailment_summary.csv',
+                    lineterminator='\n')
+                summaries[group_name] = summary
+            write_population_matrix(
+                f'{output_path}all_curtailment_populations.txt', names,
+                column_files)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    return summaries
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('ensemble_files', nargs='+',
+                        help='tab-delimited *_ensemble.txt files')
+    parser.add_argument('--output-path', default='./')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='worker processes, default one per core')
+    parser.add_argument('--res-model', default=CRWAS_PARAMETERS['res_model'])
+    parser.add_argument('--lees-ferry-ann-q', type=int,
+                        default=CRWAS_PARAMETERS['lees_ferry_ann_q'])
+    parser.add_argument('--ub-demand', type=int,
+                        default=CRWAS_PARAMETERS['ub_demand'])
+    parser.add_argument('--ppr-volume', type=int,
+                        default=CRWAS_PARAMETERS['ppr_volume'])
+    args = parser.parse_args(argv)
+
+    summaries = run_scenarios(args.ensemble_files, args.output_path,
+                              max_workers=args.workers,
+                              res_model=args.res_model,
+                              lees_ferry_ann_q=args.lees_ferry_ann_q,
+                              ub_demand=args.ub_demand,
+                              ppr_volume=args.ppr_volume)
+    for group_name, summary in summaries.items():
+        print(f'\n{group_name}')
+        print(summary.to_string())
+    return 0
+
+
+'''
+Test functions for this module.
+'''
+
+def test_crwas(data_path):
+    meko_flows = Mu.load_trace(
+        f"{data_path}meko_et_al_2007_762_2005_trace.csv")['flow'].to_numpy()
+    with tempfile.TemporaryDirectory() as path:
+        path = f'{path}/'
+        file_specs = []
+        for k, name in enumerate(('LeesFerryNFWY1950-2005',
+                                  'sresa2.ncar_pcm1.3_2040.SumToLeesFerry',
+                                  'sresb1.cccma_cgcm3_1.2_2040.SumToLeesFerry',
+                                  'sresa2.ncar_pcm1.3_2070.SumToLeesFerry')):
+            flows = Mg.block_bootstrap(meko_flows * (1 - 0.05 * k), 20, 56,
+                                       rng=k)
+            file_spec = f'{path}{name}{ENSEMBLE_SUFFIX}'
+            # Trailing tabs, as the 2010 files had
+            np.savetxt(file_spec, flows, fmt='%d', delimiter='\t',
+                       newline='\t\n')
+            file_specs.append(file_spec)
+        print(group_scenarios(file_specs).keys())
+
+        serial = run_scenarios(file_specs, path, max_workers=1,
+                               thresholds=[0, 1000000])
+        with open(f'{path}all_curtailment_populations.txt') as file:
+            serial_matrix = file.read()
+        parallel = run_scenarios(file_specs, path, max_workers=2,
+                                 thresholds=[0, 1000000])
+        with open(f'{path}all_curtailment_populations.txt') as file:
+            parallel_matrix = file.read()
+        for group_name, summary in serial.items():
+            print(f'{group_name}\n{summary.to_string()}')
+        matches = serial_matrix == parallel_matrix and all(
+            serial[name].equals(parallel[name]) for name in serial)
+        print(f'parallel run matches serial run: {matches}')
+
+        # A column of the matrix must match the trace run alone
+        matrix = pd.read_csv(f'{path}all_curtailment_populations.txt',
+                             sep='\t', usecols=range(len(file_specs)))
+        trace = read_ensemble(file_specs[2])[3]
+        outputs = simulate_trace(
+            pd.DataFrame({'year': np.arange(len(trace)), 'flow': trace}),
+            **CRWAS_PARAMETERS)
+        column = matrix.iloc[3 * len(trace):4 * len(trace), 2].to_numpy()
+        print(f'matrix matches simulate_trace: '
+              f'{np.allclose(column, outputs["curtailment"], atol=0.0005)}')
+
+
+if __name__ == '__main__':
+    sys.exit(main())
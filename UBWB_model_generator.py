@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic flow traces for the Upper Basin Water Balance model.
+
+Generates traces x years arrays of annual Lee Ferry flows from the
+historical natural flows or the paleo reconstruction, by
+    block bootstrap or Index Sequential Method (ISM) style resampling,
+    a lag-1 autoregressive (AR(1)) model, or
+    a lag-1 Markov chain of wet and dry states, optionally with the state
+    sequence fitted to the paleo record and the flows drawn from the
+    historical record (paleo-conditioned resampling).
+The arrays go straight to simulate_ensemble.  trace_chunks produces them a
+chunk at a time, each chunk with its own random stream, so any worker can
+generate any chunk and the traces do not depend on how the work is split.
+
+License: CC BY-SA 4.0, https://creativecommons.org/licenses/by-sa/4.0/
+"""
+import numpy as np
+
+from UBWB_model import simulate_ensemble
+import UBWB_model_utilities as Mu
+
+
+def chunk_rng(seed, chunk):
+    """
+    Random generator for one chunk of traces.  Streams for different
+    chunks of the same seed are independent.
+    """
+    return np.random.default_rng(np.random.SeedSequence(seed,
+                                                        spawn_key=(chunk,)))
+
+
+def block_bootstrap(flows, n_traces, n_years, block_length=10, rng=None):
+    """
+    Traces made of blocks of block_length consecutive years of flows,
+    starting at random years.  Blocks wrap around the end of the record.
+    """
+    rng = np.random.default_rng(rng)
+    flows = np.asarray(flows)
+    n_blocks = -(-n_years // block_length)
+    starts = rng.integers(0, len(flows), (n_traces, n_blocks, 1))
+    years = (starts + np.arange(block_length)) % len(flows)
+    return flows[years.reshape(n_traces, -1)[:, :n_years]]
+
+
+def ism_resample(flows, n_traces, n_years, rng=None):
+    """
+    Index Sequential Method sequences of n_years starting at random years
+    of flows, wrapping around the end of the record.  simulate_ism runs
+    every starting year instead.
+    """
+    return block_bootstrap(flows, n_traces, n_years, block_length=n_years,
+                           rng=rng)
+
+
+def fit_ar1(flows, log=False):
+    """
+    Fit a lag-1 autoregressive model to a record of annual flows.
+    If log is True the model is fitted to the logarithms of the flows,
+    which keeps generated flows positive.
+
+    Returns a dict of the model parameters for ar1_traces.
+    """
+    values = np.asarray(flows, dtype=np.float64)
+    if log:
+        values = np.log(values)
+    return {'mean': values.mean(),
+            'std': values.std(ddof=1),
+            'rho': np.corrcoef(values[:-1], values[1:])[0, 1],
+            'log': log}
+
+
+def ar1_traces(parameters, n_traces, n_years, rng=None):
+    """
+    Traces of a lag-1 autoregressive model fitted by fit_ar1.  Each trace
+    starts from the model's stationary distribution.  Flows are rounded
+    to acre-feet and negative flows set to zero.
+    """
+    rng = np.random.default_rng(rng)
+    mean, std, rho = (parameters[name] for name in ('mean', 'std', 'rho'))
+    noise = rng.standard_normal((n_traces, n_years))
+    noise[:, 1:] *= std * np.sqrt(1 - rho ** 2)
+    values = np.empty((n_traces, n_years))
+    values[:, 0] = mean + std * noise[:, 0]
+    for year in range(1, n_years):
+        values[:, year] = (mean + rho * (values[:, year - 1] - mean)
+                           + noise[:, year])
+    if parameters['log']:
+        values = np.exp(values)
+    return np.maximum(np.rint(values), 0).astype(np.int64)
+
+
+def _states(flows, n_states):
+    """State of each year of flows, 0 the driest, by quantile class."""
+    thresholds = np.quantile(flows, np.arange(1, n_states) / n_states)
+    return np.searchsorted(thresholds, flows, side='right')
+
+
+def fit_markov(state_flows, n_states=2, flows=None):
+    """
+    Fit a lag-1 Markov chain of flow states.
+
+    The states are the n_states quantile classes of state_flows, driest
+    first, and the transition probabilities are counted from their
+    sequence.  The flow of a year in a state is drawn from the years of
+    flows in the same quantile class of flows.  flows defaults to
+    state_flows.  For paleo-conditioned resampling state_flows is the
+    paleo record and flows the historical record.
+
+    Returns a dict of the model parameters for markov_traces.
+    """
+    state_flows = np.asarray(state_flows)
+    flows = state_flows if flows is None else np.asarray(flows)
+    states = _states(state_flows, n_states)
+    transitions = np.zeros((n_states, n_states))
+    np.add.at(transitions, (states[:-1], states[1:]), 1)
+    transitions /= transitions.sum(axis=1, keepdims=True)
+    flow_states = _states(flows, n_states)
+    order = np.argsort(flow_states, kind='stable')
+    counts = np.bincount(flow_states, minlength=n_states)
+    return {'cumulative': np.cumsum(transitions, axis=1),
+            'first': np.bincount(states, minlength=n_states) / len(states),
+            'pool': flows[order],
+            'offsets': np.cumsum(counts) - counts,
+            'counts': counts}
+
+
+def markov_traces(parameters, n_traces, n_years, rng=None):
+    """
+    Traces of a lag-1 Markov chain fitted by fit_markov.  The first state
+    is drawn from the frequencies of the states in the fitted record.
+    """
+    rng = np.random.default_rng(rng)
+    cumulative = parameters['cumulative']
+    n_states = len(cumulative)
+    draws = rng.random((n_traces, n_years))
+    states = np.empty((n_traces, n_years), dtype=np.int64)
+    states[:, 0] = np.searchsorted(np.cumsum(parameters['first']),
+                                   draws[:, 0], side='right')
+    for year in range(1, n_years):
+        states[:, year] = (draws[:, year, None]
+                           >= cumulative[states[:, year - 1]]).sum(axis=1)
+    np.minimum(states, n_states - 1, out=states)
+    picks = (parameters['offsets'][states]
+             + (rng.random((n_traces, n_years))
+                * parameters['counts'][states]).astype(np.int64))
+    return parameters['pool'][picks]
+
+
+def trace_chunks(generator, n_traces, n_years, chunk_size=1000, seed=None,
+                 chunks=None, **parameters):
+    """
+    Generate traces in chunks of chunk_size traces.
+
+    generator is block_bootstrap, ism_resample, ar1_traces, markov_traces
+        or another function taking n_traces, n_years and rng keywords.
+    parameters are the generator's other arguments, e.g. flows or the
+        parameters returned by fit_ar1.
+    seed makes the traces reproducible.  Chunk k is drawn from
+        chunk_rng(seed, k), so it is the same whichever chunks are made.
+    chunks lists the chunk numbers to make, e.g. range(worker, n_chunks,
+        n_workers) for one of n_workers processes.  Default all.
+
+    Yields the number of the first trace in each chunk and a traces x
+    years array of flows.
+    """
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+    n_chunks = -(-n_traces // chunk_size)
+    for chunk in (range(n_chunks) if chunks is None else chunks):
+        first = chunk * chunk_size
+        yield first, generator(n_traces=min(chunk_size, n_traces - first),
+                               n_years=n_years, rng=chunk_rng(seed, chunk),
+                               **parameters)
+
+
+'''
+Test functions for this module.
+'''
+
+def test_generator(data_path):
+    natural_flows = Mu.load_trace(
+        f"{data_path}NaturalFlows1906-2020_20221215.csv")['flow'].to_numpy()
+    meko_flows = Mu.load_trace(
+        f"{data_path}meko_et_al_2007_762_2005_trace.csv")['flow'].to_numpy()
+    ar1 = fit_ar1(natural_flows, log=True)
+    methods = {
+        'block bootstrap': (block_bootstrap, {'flows': meko_flows}),
+        'ISM': (ism_resample, {'flows': natural_flows}),
+        'AR(1)': (ar1_traces, {'parameters': ar1}),
+        'Markov': (markov_traces, {'parameters': fit_markov(natural_flows)}),
+        'paleo-conditioned': (markov_traces, {
+            'parameters': fit_markov(meko_flows, flows=natural_flows)})
+        }
+    print(f"natural flows mean {natural_flows.mean():.0f} "
+          f"std {natural_flows.std(ddof=1):.0f}")
+    for name, (generator, parameters) in methods.items():
+        curtailed = 0
+        for first, flows in trace_chunks(generator, 1000, 50, chunk_size=250,
+                                         seed=2024, **parameters):
+            outputs = simulate_ensemble(flows, ub_demand=5790000,
+                                        ppr_volume=2317000)
+            curtailed += (outputs['curtailment'] > 0).any(axis=1).sum()
+        print(f"{name}: last chunk mean {flows.mean():.0f} "
+              f"std {flows.std(ddof=1):.0f}, "
+              f"traces with curtailment {curtailed} of 1000")
+
+    # A chunk does not depend on which other chunks are made
+    _, whole = list(trace_chunks(ar1_traces, 1000, 50, chunk_size=250,
+                                 seed=2024, parameters=ar1))[2]
+    _, alone = next(trace_chunks(ar1_traces, 1000, 50, chunk_size=250,
+                                 seed=2024, chunks=[2], parameters=ar1))
+    print(f"chunk reproducible: {np.array_equal(whole, alone)}")
+
+
+if __name__ == '__main__':
+
+    data_path = './input data/'
+    test_generator(data_path)
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+Parameter sweeps of the Upper Basin Water Balance model.
+
+Runs simulate_trace for every combination of a parameter grid and a set
+of traces, spread over a pool of worker processes, and summarizes each run
+in one row of a table.
+
+License: CC BY-SA 4.0, https://creativecommons.org/licenses/by-sa/4.0/
+
+On Windows, code that calls run_sweep must be protected by
+if __name__ == '__main__': because worker processes import the main module.
+"""
+import itertools
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from UBWB_model import simulate_trace, TriggerPolicy, TRIGGER_CUTBACK_POLICY
+import UBWB_model_utilities as Mu
+
+# Traces held by each worker process, sent once when the worker starts
+_worker_traces = None
+
+
+def expand_grid(parameter_grid):
+    """
+    List the parameter sets of a grid.
+
+    parameter_grid is either a dict of simulate_trace argument names to
+    lists of values, which is expanded to every combination, or a list of
+    dicts each holding one parameter set.
+    """
+    if isinstance(parameter_grid, dict):
+        names = list(parameter_grid)
+        return [dict(zip(names, values))
+                for values in itertools.product(*parameter_grid.values())]
+    return [dict(parameters) for parameters in parameter_grid]
+
+
+def parameter_label(value):
+    """Value of a parameter as it is shown in a summary table."""
+    if isinstance(value, TriggerPolicy):
+        return value.name
+    if callable(value):
+        return value.__name__
+    if isinstance(value, list):
+        return str(value)
+    return value
+
+
+def summarize_run(outputs):
+    """Metrics of one simulate_trace run, as a dict."""
+    curtailment = np.asarray(outputs['curtailment'])
+    return {
+        'total_curtailment': curtailment.sum(),
+        'curtailment_years': int((curtailment > 0).sum()),
+        'min_storage': np.asarray(outputs['end_con']).min(),
+        'mass_balance': Mu.check_mass_balance(outputs)
+        }
+
+
+def _init_worker(traces):
+    global _worker_traces
+    _worker_traces = traces
+
+
+def _run_jobs(jobs, traces=None, fixed_parameters=None):
+    """Run a chunk of (run, trace name, parameters) jobs."""
+    if traces is None:
+        traces = _worker_traces
+    rows = []
+    for run, trace_name, parameters in jobs:
+        kwargs = dict(fixed_parameters or {}, **parameters)
+        if 'lees_ferry_n_year_record' in kwargs:
+            # simulate_trace updates the record in place
+            kwargs['lees_ferry_n_year_record'] = list(
+                kwargs['lees_ferry_n_year_record'])
+        outputs = simulate_trace(traces[trace_name], as_arrays=True, **kwargs)
+        row = {'run': run, 'trace': trace_name}
+        row.update((name, parameter_label(value))
+                   for name, value in parameters.items())
+        row.update(summarize_run(outputs))
+        rows.append(row)
+    return rows
+
+
+def run_sweep(traces, parameter_grid, max_workers=None, chunksize=None,
+              **fixed_parameters):
+    """
+    Run simulate_trace for every trace and parameter set in a grid.
+
+    traces is a dict of names to simulate_trace input DataFrames, or a list
+        of DataFrames named by position.
+    parameter_grid is as for expand_grid.
+    max_workers is the number of worker processes, default one per core.
+        With 1 the runs are made in this process.
+    chunksize is the number of runs sent to a worker at a time.  The
+        default gives each worker about four chunks.
+    fixed_parameters are simulate_trace arguments used for every run,
+        e.g. engine='numba'.
+
+    Returns a DataFrame with one row per run holding the run number, the
+    trace name, the swept parameters and the metrics of summarize_run.
+    Callable parameters are shown by name.
+    """
+    if not isinstance(traces, dict):
+        traces = dict(enumerate(traces))
+    parameter_sets = expand_grid(parameter_grid)
+    jobs = [(run, trace_name, parameters)
+            for run, (parameters, trace_name) in enumerate(
+                itertools.product(parameter_sets, traces))]
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+
+    if max_workers == 1 or len(jobs) <= 1:
+        rows = _run_jobs(jobs, traces, fixed_parameters)
+    else:
+        if chunksize is None:
+            chunksize = max(1, math.ceil(len(jobs) / (4 * max_workers)))
+        chunks = [jobs[i:i + chunksize]
+                  for i in range(0, len(jobs), chunksize)]
+        with ProcessPoolExecutor(max_workers=max_workers,
+                                 initializer=_init_worker,
+                                 initargs=(traces,)) as executor:
+            rows = [row
+                    for chunk_rows in executor.map(
+                        _run_jobs, chunks,
+                        itertools.repeat(None),
+                        itertools.repeat(fixed_parameters))
+                    for row in chunk_rows]
+    return pd.DataFrame(rows)
+
+
+'''
+Test functions for this module.
+'''
+
+def test_sweep(data_path):
+    data_file = "meko_et_al_2007_762_2005_trace.csv"
+    meko_flows = pd.read_csv(f"{data_path}{data_file}", comment="#")
+    traces = {'first half': meko_flows.iloc[:622],
+              'second half': meko_flows.iloc[622:]}
+    grid = {'ub_demand': [5000000, 5790000, 6500000],
+            'res_model': ['active', 'live']}
+
+    serial = run_sweep(traces, grid, max_workers=1, ppr_volume=2317000)
+    parallel = run_sweep(traces, grid, max_workers=2, ppr_volume=2317000)
+    print(serial.to_string())
+    print(f'parallel run matches serial run: {serial.equals(parallel)}')
+
+    # A grid of candidate trigger policies
+    policies = [TRIGGER_CUTBACK_POLICY,
+                TriggerPolicy([0.2], [0.3, 0]),
+                TriggerPolicy([0.15, 0.3], [0.5, 0.2, 0], 'two step')]
+    policy_sweep = run_sweep(traces, {'trigger_func': policies},
+                             max_workers=2, ub_demand=6200000,
+                             ppr_volume=2317000)
+    print(policy_sweep.to_string())
+
+
+if __name__ == '__main__':
+
+    data_path = './input data/'
+    test_sweep(data_path)
@@ -1,263 +1,479 @@
-# -*- coding: utf-8 -*-
-"""
-Test function for HD_model.py
-
-Created on Tue Nov 12 17:55:50 2024
-
-@author: bhard
-License: CC BY-SA 4.0, https://creativecommons.org/licenses/by-sa/4.0/
-"""
-import pandas as pd
-from UBWB_model import simulate_trace
-import UBWB_model_utilities as Mu
-
-def main(data_path,output_path):
-    # Codes to validate the 2007HD results and to validate against previous
-    # outputs to catch introduced bugs
-    
-    # Validation against 2007HD, runs 2 and 6, 1930-1963
-    # 1930 starts with reservoirs full. Shortages occur in 1963 and 1964.
-    # 33 years of accumulation will reveal any differences.
-    # 1977 shortages/curtailments will not match due to difference in 
-    #   conceptual model. 
-    HD_flows = pd.DataFrame(
-        columns=["year", "flow"],
-        data=[
-            [1929, 21829585], [1930, 14621041], [1931, 8474134],
-            [1932, 17422187], [1933, 12183500], [1934, 6178192],
-            [1935, 12630349], [1936, 14648873], [1937, 14306056],
-            [1938, 18148319], [1939, 11164059], [1940, 9931657],
-            [1941, 20116678], [1942, 17225136], [1943, 13731401],
-            [1944, 15369422], [1945, 14140528], [1946, 11095453],
-            [1947, 16439486], [1948, 15139294], [1949, 16933584],
-            [1950, 13140416], [1951, 12505894], [1952, 20805422],
-            [1953, 11165419], [1954, 8496102], [1955, 9413908],
-            [1956, 11426874], [1957, 21500963], [1958, 15862511],
-            [1959, 9598169], [1960, 11524160], [1961, 10010259],
-            [1962, 17377609], [1963, 8840900], [1964, 10863586],
-            [1965, 19875027],[1966,10679844],[1967,11670830],
-            [1968,13739932], [1969,15272159], [1970,15344136],
-            [1971,15493659], [1972,13186637], [1973,18650193],
-            [1974,13285426], [1975,17072661], [1976,11313561],
-            [1977,5551188], [1978,15335909], [1979,17825429],
-            [1980,17927076], [1981,9015200], [1982,17489400],
-            [1983,24361989], [1984,25359376], [1985,21246109],
-            [1986,23013446], [1987,15640478], [1988,11456357],
-            [1989,9921847], [1990,9639803], [1991,12170021],
-            [1992,10895580], [1993,18160118], [1994,11125503],
-            [1995,20047166], [1996,14502293], [1997,21622438],
-            [1998,16798378], [1999,15934210], [2000,10646526]
-        ]
-    )
-    
-    #**********************Run 2********************************
-
-    HD_2007_run2_validation_outputs = simulate_trace(
-        HD_flows,
-        res_model='active',
-        lees_ferry_ann_q=8250000,  # Consistency with 2007HD
-        ub_demand=5790000,
-        ppr_volume=0
-    )
-    
-    trial_curtailment = HD_2007_run2_validation_outputs[
-                        HD_2007_run2_validation_outputs["year"] == 1963
-                        ].iloc[0]["curtailment"]
-    true_curtailment = 1153349.0 # From 2007HD
-    delta = round((trial_curtailment - true_curtailment)
-                  / true_curtailment * 100, 3)
-    
-    print('***HD 2007 Run 2 validation:')
-    print(
-        f'Curtailment validation:\n'
-        f'1963 trial: {trial_curtailment} '
-        f' true: {true_curtailment} '
-        f'delta: {delta}%'
-    )
-    trial_curtailment = HD_2007_run2_validation_outputs[
-                        HD_2007_run2_validation_outputs["year"] == 1977
-                        ].iloc[0]["curtailment"]
-    true_curtailment = 3136608  # From 2007HD
-    delta = round((trial_curtailment - true_curtailment)
-                  / true_curtailment * 100, 3)
-    
-    print(
-        f'1977 trial: {trial_curtailment}'
-        f' true: {true_curtailment} '
-        f'delta: {delta}%'
-    )
-    print(
-        f'HD 2007 Run 2 mass balance: '
-        f'{Mu.check_mass_balance(HD_2007_run2_validation_outputs)}'
-    )
-    run_name = "2007HD Run 2 validation"
-    metadata = ('reservoir_capacity,active,\n'
-                'Lees_Ferry_Ann_Q,8250000, MOR\n'
-                'UB_demand,5790000\nPPR_volume,0\n'
-                'Trigger,False'
-                )
-    Mu.process_single_trace(
-        HD_2007_run2_validation_outputs,
-        f'{run_name}',
-        output_path,
-        metadata = metadata)
-    
-    #*******************************Run 6********************************
-    HD_2007_run6_validation_outputs = simulate_trace(
-        HD_flows,
-        res_model='live',
-        lees_ferry_ann_q=8250000,  # Consistency with 2007HD
-        ub_demand=5980000,
-        ppr_volume=0
-    )
-    
-    trial_curtailment = HD_2007_run6_validation_outputs[
-                        HD_2007_run6_validation_outputs["year"] == 1963
-                        ].iloc[0]["curtailment"]
-    true_curtailment = 703237 # From 2007HD
-    delta = round((trial_curtailment - true_curtailment)
-                  / true_curtailment * 100, 3)
-    
-    print('\n***HD 2007 Run 6 validation:')
-    print(
-        f'Curtailment validation:\n'
-        f'1963 trial: {trial_curtailment} '
-        f' true: {true_curtailment} '
-        f'delta: {delta}%'
-    )
-    trial_curtailment = HD_2007_run6_validation_outputs[
-                        HD_2007_run6_validation_outputs["year"] == 1977
-                        ].iloc[0]["curtailment"]
-    true_curtailment = 3665093   # From 2007HD
-    delta = round((trial_curtailment - true_curtailment)
-                  / true_curtailment * 100, 3)
-    
-    print(
-        f'1977 trial: {trial_curtailment}'
-        f' true: {true_curtailment} '
-        f'delta: {delta}%'
-    )
-    print(
-        f'HD 2007 Run 6 mass balance: '
-        f'{Mu.check_mass_balance(HD_2007_run6_validation_outputs)}'
-    )
-    run_name = "2007HD Run 6 validation"
-    metadata = ('reservoir_capacity,active,\n'
-                'Lees_Ferry_Ann_Q,8250000, MOR\n'
-                'UB_demand,5980000\nPPR_volume,0\n'
-                'Trigger,False'
-                )
-    Mu.process_single_trace(
-        HD_2007_run6_validation_outputs,
-        f'{run_name}',
-        output_path,
-        metadata = metadata)
-    #********************Run extreme low flow test******************
-    # test inflow less than depletions
-    test_flows = pd.DataFrame(columns=["year","flow"],
-        #Meko et al., 2007 flows
-        data = [
-        #year, flow (af)
-        [1869,15940000], [1870,12800000], [1871,8560000],
-        [1872,16380000], [1873,4000000],  [1874,11660000],
-        [1875,13150000], [1876,15120000], [1877,13110000],
-        [1878,12710000], [1879,4000000],  [1880,13610000],
-        [1881,12330000], [1882,10010000], [1883,11670000],
-        [1884,17930000], [1885,17840000], [1886,14150000],
-        [1887,9180000], [1888,13940000], [1889,12790000],
-        [1890,15430000], [1891,16090000]
-        ])
-    
-    low_flow_test_outputs =   simulate_trace(
-                                   test_flows,
-                                   res_model = 'active',
-                                   lees_ferry_ann_q = 8230000,
-                                   ub_demand = 5790000,
-                                   ppr_volume = 2267000)
-    run_name = "low_flow_test"
-    metadata = ('reservoir_capacity,active,\n'
-                'Lees_Ferry_Ann_Q,8230000\n'
-                'UB_demand,5790000\nPPR_volume,3317000\n'
-                'Trigger,False'
-                )
-    
-    Mu.process_single_trace(low_flow_test_outputs,run_name,output_path,metadata = metadata)
-    
-    print('\n****** Low-flow test *******')
-    trial_10yr = low_flow_test_outputs[
-                 low_flow_test_outputs["year"] == 1882
-                 ].iloc[0]["LF_10yr_flows"]
-    
-    true_10yr = 81680120  # taken from output of last code revision
-    delta = round((trial_10yr - true_10yr) / true_10yr * 100, 3)
-    print(
-        f"10yr validation: trial: {trial_10yr} true: {true_10yr} "
-        f"delta: {delta}%"
-    )
-    old_mass_balance = 6 # Hand calculated from output of last code revision.
-    print(
-        f'Low flow test mass balance: trial '
-        f'{Mu.check_mass_balance(low_flow_test_outputs)} '
-        f'last: {old_mass_balance}'
-        )
-
-    # ***********************Test using Meko outputs*******************
-
-    data_file = "meko_et_al_2007_762_2005_trace.csv"
-    Meko_LFflows = pd.read_csv(f"{data_path}{data_file}", comment="#")
-    Meko_LFflows = Meko_LFflows.astype(int)
-    
-    Meko_validation_outputs = simulate_trace(
-        Meko_LFflows, res_model = 'active',
-        lees_ferry_ann_q=8230000,
-        ub_demand=5790000,
-        ppr_volume=2317000
-    )
-    
-    print('\n***Meko 2007 test:')
-    trial_ppr = Meko_validation_outputs[
-                Meko_validation_outputs["year"] == 1902
-                ].iloc[0]["UB_BU"]
-    
-    true_ppr = 2317000  # will equal argument passed to simulate_trace
-    delta = round((trial_ppr - true_ppr) / true_ppr * 100, 3)
-    print(
-        f"PPR validation: trial: {trial_ppr} true: {true_ppr} "
-        f"delta: {delta}%"
-    )
-    
-    trial_10yr = Meko_validation_outputs[
-                 Meko_validation_outputs["year"] == 1902
-                 ].iloc[0]["LF_10yr_flows"]
-    
-    true_10yr = 77847390  # taken from output of last code revision
-    delta = round((trial_10yr - true_10yr) / true_10yr * 100, 3)
-    print(
-          f"10yr validation: trial: {trial_10yr} true: {true_10yr} "
-          f"delta: {delta}%"
-          )
-    
-    old_mass_balance = -57 # Hand calculated from output of last code revision.
-    print(
-        f'Meko 2007 mass balance: trial '
-        f'{Mu.check_mass_balance(Meko_validation_outputs)}'
-        f' last: {old_mass_balance}'
-    )
-    run_name = "Meko 2007 paleo_5790_8230_2317_PP_MOR"
-    metadata = ('reservoir_capacity,active,\n'
-                'Lees_Ferry_Ann_Q,8230000, MOR\n'
-                'UB_demand,5790000\nPPR_volume,3317000\n'
-                'Trigger,False'
-                )
-    Mu.process_single_trace(
-        Meko_validation_outputs,
-        f'{run_name}',
-        output_path,
-        metadata = metadata) 
-
-if __name__ == '__main__':
-
-    data_path = './'
-    output_path = './'
-    
-    main(data_path,output_path)
+# -*- coding: utf-8 -*-
+"""
+Test function for HD_model.py
+
+Created on Tue Nov 12 17:55:50 2024
+
+@author: bhard
+License: CC BY-SA 4.0, https://creativecommons.org/licenses/by-sa/4.0/
+"""
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+from UBWB_model import (simulate_trace, simulate_ensemble, simulate_stream,
+                        simulate_policies, trigger_cutback, TriggerPolicy,
+                        TRIGGER_CUTBACK_POLICY, RunStats, RunState, numba)
+import UBWB_model_utilities as Mu
+
+def hd_validation_flows():
+    """Natural flows used in the 2007HD validation runs, 1929-2000."""
+    return pd.DataFrame(
+        columns=["year", "flow"],
+        data=[
+            [1929, 21829585], [1930, 14621041], [1931, 8474134],
+            [1932, 17422187], [1933, 12183500], [1934, 6178192],
+            [1935, 12630349], [1936, 14648873], [1937, 14306056],
+            [1938, 18148319], [1939, 11164059], [1940, 9931657],
+            [1941, 20116678], [1942, 17225136], [1943, 13731401],
+            [1944, 15369422], [1945, 14140528], [1946, 11095453],
+            [1947, 16439486], [1948, 15139294], [1949, 16933584],
+            [1950, 13140416], [1951, 12505894], [1952, 20805422],
+            [1953, 11165419], [1954, 8496102], [1955, 9413908],
+            [1956, 11426874], [1957, 21500963], [1958, 15862511],
+            [1959, 9598169], [1960, 11524160], [1961, 10010259],
+            [1962, 17377609], [1963, 8840900], [1964, 10863586],
+            [1965, 19875027],[1966,10679844],[1967,11670830],
+            [1968,13739932], [1969,15272159], [1970,15344136],
+            [1971,15493659], [1972,13186637], [1973,18650193],
+            [1974,13285426], [1975,17072661], [1976,11313561],
+            [1977,5551188], [1978,15335909], [1979,17825429],
+            [1980,17927076], [1981,9015200], [1982,17489400],
+            [1983,24361989], [1984,25359376], [1985,21246109],
+            [1986,23013446], [1987,15640478], [1988,11456357],
+            [1989,9921847], [1990,9639803], [1991,12170021],
+            [1992,10895580], [1993,18160118], [1994,11125503],
+            [1995,20047166], [1996,14502293], [1997,21622438],
+            [1998,16798378], [1999,15934210], [2000,10646526]
+        ]
+    )
+
+
+def low_flow_test_flows():
+    """Meko et al., 2007 flows with inflows less than depletions."""
+    return pd.DataFrame(columns=["year","flow"],
+        #Meko et al., 2007 flows
+        data = [
+        #year, flow (af)
+        [1869,15940000], [1870,12800000], [1871,8560000],
+        [1872,16380000], [1873,4000000],  [1874,11660000],
+        [1875,13150000], [1876,15120000], [1877,13110000],
+        [1878,12710000], [1879,4000000],  [1880,13610000],
+        [1881,12330000], [1882,10010000], [1883,11670000],
+        [1884,17930000], [1885,17840000], [1886,14150000],
+        [1887,9180000], [1888,13940000], [1889,12790000],
+        [1890,15430000], [1891,16090000]
+        ])
+
+
+def main(data_path,output_path):
+    # Codes to validate the 2007HD results and to validate against previous
+    # outputs to catch introduced bugs
+    
+    # Validation against 2007HD, runs 2 and 6, 1930-1963
+    # 1930 starts with reservoirs full. Shortages occur in 1963 and 1964.
+    # 33 years of accumulation will reveal any differences.
+    # 1977 shortages/curtailments will not match due to difference in 
+    #   conceptual model. 
+    HD_flows = hd_validation_flows()
+    
+    #**********************Run 2********************************
+
+    HD_2007_run2_validation_outputs = simulate_trace(
+        HD_flows,
+        res_model='active',
+        lees_ferry_ann_q=8250000,  # Consistency with 2007HD
+        ub_demand=5790000,
+        ppr_volume=0
+    )
+    
+    trial_curtailment = HD_2007_run2_validation_outputs[
+                        HD_2007_run2_validation_outputs["year"] == 1963
+                        ].iloc[0]["curtailment"]
+    true_curtailment = 1153349.0 # From 2007HD
+    delta = round((trial_curtailment - true_curtailment)
+                  / true_curtailment * 100, 3)
+    
+    print('***HD 2007 Run 2 validation:')
+    print(
+        f'Curtailment validation:\n'
+        f'1963 trial: {trial_curtailment} '
+        f' true: {true_curtailment} '
+        f'delta: {delta}%'
+    )
+    trial_curtailment = HD_2007_run2_validation_outputs[
+                        HD_2007_run2_validation_outputs["year"] == 1977
+                        ].iloc[0]["curtailment"]
+    true_curtailment = 3136608  # From 2007HD
+    delta = round((trial_curtailment - true_curtailment)
+                  / true_curtailment * 100, 3)
+    
+    print(
+        f'1977 trial: {trial_curtailment}'
+        f' true: {true_curtailment} '
+        f'delta: {delta}%'
+    )
+    print(
+        f'HD 2007 Run 2 mass balance: '
+        f'{Mu.check_mass_balance(HD_2007_run2_validation_outputs)}'
+    )
+    run_name = "2007HD Run 2 validation"
+    metadata = ('reservoir_capacity,active,\n'
+                'Lees_Ferry_Ann_Q,8250000, MOR\n'
+                'UB_demand,5790000\nPPR_volume,0\n'
+                'Trigger,False'
+                )
+    Mu.process_single_trace(
+        HD_2007_run2_validation_outputs,
+        f'{run_name}',
+        output_path,
+        metadata = metadata)
+    
+    #*******************************Run 6********************************
+    HD_2007_run6_validation_outputs = simulate_trace(
+        HD_flows,
+        res_model='live',
+        lees_ferry_ann_q=8250000,  # Consistency with 2007HD
+        ub_demand=5980000,
+        ppr_volume=0
+    )
+    
+    trial_curtailment = HD_2007_run6_validation_outputs[
+                        HD_2007_run6_validation_outputs["year"] == 1963
+                        ].iloc[0]["curtailment"]
+    true_curtailment = 703237 # From 2007HD
+    delta = round((trial_curtailment - true_curtailment)
+                  / true_curtailment * 100, 3)
+    
+    print('\n***HD 2007 Run 6 validation:')
+    print(
+        f'Curtailment validation:\n'
+        f'1963 trial: {trial_curtailment} '
+        f' true: {true_curtailment} '
+        f'delta: {delta}%'
+    )
+    trial_curtailment = HD_2007_run6_validation_outputs[
+                        HD_2007_run6_validation_outputs["year"] == 1977
+                        ].iloc[0]["curtailment"]
+    true_curtailment = 3665093   # From 2007HD
+    delta = round((trial_curtailment - true_curtailment)
+                  / true_curtailment * 100, 3)
+    
+    print(
+        f'1977 trial: {trial_curtailment}'
+        f' true: {true_curtailment} '
+        f'delta: {delta}%'
+    )
+    print(
+        f'HD 2007 Run 6 mass balance: '
+        f'{Mu.check_mass_balance(HD_2007_run6_validation_outputs)}'
+    )
+    run_name = "2007HD Run 6 validation"
+    metadata = ('reservoir_capacity,active,\n'
+                'Lees_Ferry_Ann_Q,8250000, MOR\n'
+                'UB_demand,5980000\nPPR_volume,0\n'
+                'Trigger,False'
+                )
+    Mu.process_single_trace(
+        HD_2007_run6_validation_outputs,
+        f'{run_name}',
+        output_path,
+        metadata = metadata)
+    #********************Run extreme low flow test******************
+    # test inflow less than depletions
+    test_flows = low_flow_test_flows()
+    
+    low_flow_test_outputs =   simulate_trace(
+                                   test_flows,
+                                   res_model = 'active',
+                                   lees_ferry_ann_q = 8230000,
+                                   ub_demand = 5790000,
+                                   ppr_volume = 2267000)
+    run_name = "low_flow_test"
+    metadata = ('reservoir_capacity,active,\n'
+                'Lees_Ferry_Ann_Q,8230000\n'
+                'UB_demand,5790000\nPPR_volume,3317000\n'
+                'Trigger,False'
+                )
+    
+    Mu.process_single_trace(low_flow_test_outputs,run_name,output_path,metadata = metadata)
+    
+    print('\n****** Low-flow test *******')
+    trial_10yr = low_flow_test_outputs[
+                 low_flow_test_outputs["year"] == 1882
+                 ].iloc[0]["LF_10yr_flows"]
+    
+    true_10yr = 81680120  # taken from output of last code revision
+    delta = round((trial_10yr - true_10yr) / true_10yr * 100, 3)
+    print(
+        f"10yr validation: trial: {trial_10yr} true: {true_10yr} "
+        f"delta: {delta}%"
+    )
+    old_mass_balance = 6 # Hand calculated from output of last code revision.
+    print(
+        f'Low flow test mass balance: trial '
+        f'{Mu.check_mass_balance(low_flow_test_outputs)} '
+        f'last: {old_mass_balance}'
+        )
+
+    # ***********************Test using Meko outputs*******************
+
+    data_file = "meko_et_al_2007_762_2005_trace.csv"
+    Meko_LFflows = Mu.load_trace(f"{data_path}{data_file}")
+    
+    Meko_validation_outputs = simulate_trace(
+        Meko_LFflows, res_model = 'active',
+        lees_ferry_ann_q=8230000,
+        ub_demand=5790000,
+        ppr_volume=2317000
+    )
+    
+    print('\n***Meko 2007 test:')
+    trial_ppr = Meko_validation_outputs[
+                Meko_validation_outputs["year"] == 1902
+                ].iloc[0]["UB_BU"]
+    
+    true_ppr = 2317000  # will equal argument passed to simulate_trace
+    delta = round((trial_ppr - true_ppr) / true_ppr * 100, 3)
+    print(
+        f"PPR validation: trial: {trial_ppr} true: {true_ppr} "
+        f"delta: {delta}%"
+    )
+    
+    trial_10yr = Meko_validation_outputs[
+                 Meko_validation_outputs["year"] == 1902
+                 ].iloc[0]["LF_10yr_flows"]
+    
+    true_10yr = 77847390  # taken from output of last code revision
+    delta = round((trial_10yr - true_10yr) / true_10yr * 100, 3)
+    print(
+          f"10yr validation: trial: {trial_10yr} true: {true_10yr} "
+          f"delta: {delta}%"
+          )
+    
+    old_mass_balance = -57 # Hand calculated from output of last code revision.
+    print(
+        f'Meko 2007 mass balance: trial '
+        f'{Mu.check_mass_balance(Meko_validation_outputs)}'
+        f' last: {old_mass_balance}'
+    )
+    run_name = "Meko 2007 paleo_5790_8230_2317_PP_MOR"
+    metadata = ('reservoir_capacity,active,\n'
+                'Lees_Ferry_Ann_Q,8230000, MOR\n'
+                'UB_demand,5790000\nPPR_volume,3317000\n'
+                'Trigger,False'
+                )
+    Mu.process_single_trace(
+        Meko_validation_outputs,
+        f'{run_name}',
+        output_path,
+        metadata = metadata) 
+
+    # ***********************Batched ensemble test*******************
+    # Each 100-year block of the Meko trace run as a member of an ensemble
+    # must match the same block run alone.
+    meko_flows = Meko_LFflows['flow'].to_numpy()
+    n_traces = len(meko_flows) // 100
+    ensemble_outputs = simulate_ensemble(
+        meko_flows[:n_traces * 100].reshape(n_traces, 100),
+        res_model='active',
+        lees_ferry_ann_q=8230000,
+        ub_demand=5790000,
+        ppr_volume=2317000
+    )
+    max_delta = 0
+    for trace in range(n_traces):
+        trace_outputs = simulate_trace(
+            Meko_LFflows.iloc[trace * 100:(trace + 1) * 100],
+            res_model='active',
+            lees_ferry_ann_q=8230000,
+            ub_demand=5790000,
+            ppr_volume=2317000,
+            as_arrays=True
+        )
+        for column in ('end_con', 'curtailment', 'LF_flow', 'evap'):
+            max_delta = max(max_delta, abs(
+                trace_outputs[column] - ensemble_outputs[column][trace]).max())
+    print('\n***Batched ensemble test:')
+    print(f'{n_traces} traces, max delta from simulate_trace: {max_delta}')
+
+    # Per-trace start contents, where zero means full as in simulate_trace
+    start_contents = [0, 15000000, 0]
+    start_outputs = simulate_ensemble(
+        meko_flows[:300].reshape(3, 100),
+        start_contents=start_contents,
+        ub_demand=5790000,
+        ppr_volume=2317000
+    )
+    matches = all(
+        np.array_equal(
+            start_outputs['end_con'][trace],
+            simulate_trace(Meko_LFflows.iloc[trace * 100:(trace + 1) * 100],
+                           start_contents=contents, ub_demand=5790000,
+                           ppr_volume=2317000, as_arrays=True)['end_con'])
+        for trace, contents in enumerate(start_contents))
+    print(f'per-trace start contents match simulate_trace: {matches}')
+
+    # ***********************Trigger policy test*******************
+    # The table form of trigger_cutback must match the function, and each
+    # policy of a simulate_policies run must match its own ensemble run.
+    blocks = meko_flows[:n_traces * 100].reshape(n_traces, 100)
+    policies = [TRIGGER_CUTBACK_POLICY, TriggerPolicy([0.2], [0.3, 0])]
+    policy_outputs = simulate_policies(blocks, policies, ub_demand=6200000,
+                                       ppr_volume=2317000)
+    max_delta = 0
+    for k, trigger_func in enumerate((trigger_cutback, policies[1])):
+        trigger_outputs = simulate_ensemble(blocks,
+                                            trigger_func=trigger_func,
+                                            ub_demand=6200000,
+                                            ppr_volume=2317000)
+        for column in ('end_con', 'curtailment', 'trgr_cut'):
+            max_delta = max(max_delta, abs(
+                trigger_outputs[column] - policy_outputs[column][k]).max())
+    print('\n***Trigger policy test:')
+    print(
+        f'{len(policies)} policies, max delta from single runs: {max_delta}'
+    )
+    # Policies are named, saved with a run's state and written as metadata
+    policy_outputs, policy_state = simulate_trace(
+        Meko_LFflows.iloc[:100], trigger_func=policies[1],
+        ub_demand=6200000, ppr_volume=2317000, return_state=True)
+    with tempfile.TemporaryDirectory() as policy_path:
+        loaded_state = RunState.load(policy_state.save(
+            os.path.join(policy_path, 'state.json')))
+        file_spec = Mu.write_columnar(
+            os.path.join(policy_path, 'policy.TS.npz'), policy_outputs,
+            {'trigger_func': policies[1]})
+        run_metadata = Mu.read_columnar(file_spec).attrs['run_metadata']
+    print(f'policy state reloaded: {loaded_state == policy_state}')
+    try:
+        simulate_trace(Meko_LFflows.iloc[:100],
+                       trigger_func=TriggerPolicy.stack(policies),
+                       ub_demand=6200000, ppr_volume=2317000)
+    except ValueError as error:
+        print(f'stacked policy in simulate_trace: {error}')
+    print(f"policy metadata: {run_metadata['trigger_func']}")
+
+    # ***********************Compiled engine test*******************
+    # Falls back to the python engine if numba is not installed
+    compiled_outputs = simulate_trace(
+        Meko_LFflows, res_model = 'active',
+        lees_ferry_ann_q=8230000,
+        ub_demand=5790000,
+        ppr_volume=2317000,
+        engine='numba'
+    )
+    print('\n***Compiled engine test:')
+    print(
+        f'numba installed: {numba is not None}, outputs equal: '
+        f'{compiled_outputs.equals(Meko_validation_outputs)}'
+    )
+
+    # ***********************Lee Ferry record test*******************
+    # Records shorter or longer than nyrs must be read the same way by the
+    # python and numba engines and by simulate_ensemble.
+    record_flows = Meko_LFflows.iloc[:200]
+    max_delta = 0
+    for record_years in (5, 15):
+        record = [7000000 + 100000 * k for k in range(record_years)]
+        python_outputs = simulate_trace(
+            record_flows, lees_ferry_n_year_record=list(record),
+            ub_demand=6000000, ppr_volume=2317000, as_arrays=True)
+        compiled_outputs = simulate_trace(
+            record_flows, lees_ferry_n_year_record=list(record),
+            ub_demand=6000000, ppr_volume=2317000, as_arrays=True,
+            engine='numba')
+        record_ensemble = simulate_ensemble(
+            record_flows['flow'].to_numpy()[np.newaxis],
+            lees_ferry_n_year_record=record,
+            ub_demand=6000000, ppr_volume=2317000)
+        for column in ('end_con', 'curtailment', 'LF_10yr_flows'):
+            max_delta = max(
+                max_delta,
+                abs(python_outputs[column] - compiled_outputs[column]).max(),
+                abs(python_outputs[column]
+                    - record_ensemble[column][0]).max())
+    print('\n***Lee Ferry record test:')
+    print(f'5 and 15-year records, max delta between engines: {max_delta}')
+
+    # ***********************Closed-form evaporation test*******************
+    # Closed-form and iterated evaporation should agree to within the
+    # rounding of the evaporation functions.
+    closed_form_outputs = simulate_trace(
+        Meko_LFflows, res_model = 'active',
+        lees_ferry_ann_q=8230000,
+        ub_demand=5790000,
+        ppr_volume=2317000,
+        evap_solver='validate'
+    )
+    print('\n***Closed-form evaporation test:')
+    print(
+        f"max evap delta: {closed_form_outputs['evap_delta'].abs().max()} "
+        f"mass balance: {Mu.check_mass_balance(closed_form_outputs)}"
+    )
+
+    # ***********************Streaming test*******************
+    # The Meko trace read 64 years at a time must match the whole-trace run.
+    stream_blocks = simulate_stream(
+        zip(Meko_LFflows['year'], Meko_LFflows['flow']),
+        block_size=64,
+        res_model='active',
+        lees_ferry_ann_q=8230000,
+        ub_demand=5790000,
+        ppr_volume=2317000
+    )
+    stream_end_con = np.concatenate(
+        [block['end_con'] for block in stream_blocks])
+    print('\n***Streaming test:')
+    print(
+        f"max end_con delta from simulate_trace: "
+        f"{abs(stream_end_con - Meko_validation_outputs['end_con']).max()}"
+    )
+
+    # ***********************Instrumentation test*******************
+    # The per-year residuals must add up to the run's mass balance.
+    run_stats = RunStats()
+    simulate_trace(
+        Meko_LFflows, res_model = 'active',
+        lees_ferry_ann_q=8230000,
+        ub_demand=5790000,
+        ppr_volume=2317000,
+        stats=run_stats
+    )
+    print('\n***Instrumentation test:')
+    print(run_stats.counters)
+    print(
+        f'sum of residuals: {run_stats.residuals.sum()} mass balance: '
+        f'{Mu.check_mass_balance(Meko_validation_outputs)}'
+    )
+
+    # ***********************Resume test*******************
+    # Running to 1900, saving the state and continuing must match the
+    # whole-trace run.
+    first_years, state = simulate_trace(
+        Meko_LFflows[Meko_LFflows['year'] <= 1900],
+        res_model = 'active',
+        lees_ferry_ann_q=8230000,
+        ub_demand=5790000,
+        ppr_volume=2317000,
+        return_state=True
+    )
+    with tempfile.TemporaryDirectory() as state_path:
+        state = RunState.load(
+            state.save(os.path.join(state_path, 'state.json')))
+    last_years = simulate_trace(
+        Meko_LFflows[Meko_LFflows['year'] > 1900], state=state)
+    resumed_outputs = pd.concat([first_years, last_years])
+    print('\n***Resume test:')
+    print(
+        f"resumed at {state.year}, matches whole-trace run: "
+        f"{resumed_outputs.equals(Meko_validation_outputs)}"
+    )
+
+if __name__ == '__main__':
+
+    data_path = './'
+    output_path = './'
+    
+    main(data_path,output_path)
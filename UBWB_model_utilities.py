@@ -1,309 +1,965 @@
-# -*- coding: utf-8 -*-
-"""
-Created on Tue Nov 12 17:25:44 2024
-
-@author: Ben Harding
-License: CC BY-SA 4.0, https://creativecommons.org/licenses/by-sa/4.0/
-"""
-import pandas as pd
-import numpy as np
-import sys
-
-"""
-Output Utilities
-"""
-
-# Define default quantiles
-DEFAULT_QUANTILES = [10, 25, 50, 75, 90]
-
-def write_percentiles(file, data, labels, quantiles=DEFAULT_QUANTILES):
-    """Write percentiles, max, min, and mean values of data to a CSV file."""
-    # Data is a tuple of lists
-    columns = quantiles + ['Max', 'Min', 'Mean']
-    out_df = pd.DataFrame(columns=columns)
-    
-    for i, series in enumerate(data):
-        # Calculate percentiles and summary statistics
-        percentiles = list(np.nanpercentile(series, quantiles))
-        percentiles.append(np.nanmax(series))
-        percentiles.append(np.nanmin(series))
-        percentiles.append(float(np.nanmean(series)))
-        
-        # Assign calculated values to the DataFrame row
-        out_df.loc[labels[i]] = percentiles
-    
-    out_df.to_csv(file, lineterminator="\n")
-    return out_df
-
-
-def write_ts_output(file_spec, run_metadata, outputs):
-    """Write metadata and time series outputs to a CSV file."""
-    with open(file_spec, 'w') as file:
-        for key, value in run_metadata.items():
-            file.write(f"{key},{value}\n")
-
-    with open(file_spec, 'a') as file:
-        outputs.to_csv(file, index=False, lineterminator='\n')
-
-'''
-Spell utilities
-'''
-def characterize_spells(data, n_spell_dict=None, i_spell_dict=None):
-    """
-    Function to analyze spells of events in a series.
-    
-    Arguments:
-        data: list or Pandas series containing an ordered sequence
-              of positive excursions and zeros.
-        n_spell_dict (opt): dictionary holding lists of nested spells keyed by duration.
-        i_spell_dict (opt): dictionary holding lists of independent spells keyed by duration.
-    
-    Returns:
-        n_spell_dict, i_spell_dict
-
-    Events are positive excursions from zero, so for conventional
-    analysis of precipitation or streamflow spells the time series
-    must be normalized by subtracting the time-series values from the 
-    time-series mean.
-
-    Spells are reported by the average value of the excursions over the 
-    duration of the spell.
-
-    Two types of spells are characterized: conventional independent spells
-    and 'nested' spells (spells of all durations contained within independent spells).
-    """
-    if n_spell_dict is None:
-        n_spell_dict = {}
-    if i_spell_dict is None:
-        i_spell_dict = {}
-
-    remainder = list(data)  # will accept a series
-    while True:
-        # Strip off leading zeros
-        while remainder and remainder[0] == 0:
-            remainder.pop(0)
-        if not remainder:
-            break
-
-        # Extract and catalog the independent spell
-        try:
-            next_zero = remainder.index(0)
-        except ValueError:
-            next_zero = len(remainder)
-
-        run = remainder[:next_zero]
-        duration = len(run)
-        if duration not in i_spell_dict:
-            i_spell_dict[duration] = []
-        i_spell_dict[duration].append(sum(run) / float(duration))
-
-        # Find and catalog the nested spells
-        for nested_duration in range(1, len(run) + 1):
-            for idx in range(0, len(run) - nested_duration + 1):
-                if nested_duration not in n_spell_dict:
-                    n_spell_dict[nested_duration] = []
-                n_spell_dict[nested_duration].append(
-                    sum(run[idx:idx + nested_duration]) / float(nested_duration)
-                )
-
-        remainder = remainder[next_zero:]
-
-    return n_spell_dict, i_spell_dict
-
-
-def write_spell_dict(file, spell_dict, title=None):
-    """Writes each duration on one line."""
-    if title:
-        file.write(f"{title}\n")
-    file.write('Duration,count,mean\n')
-    for key, values in sorted(spell_dict.items()):
-        values_str = ",".join(map(str, values))
-        file.write(f"{key},{len(values)},{sum(values)/len(values)}, {values_str}\n")
-
-
-def write_spell_percentiles(file, spell_dict, quantiles, title=None):
-    """Writes percentiles for each spell duration."""
-    labels = list(spell_dict.keys())
-    data = list(spell_dict.values())
-    if title:
-        file.write(f"{title}\n")
-    write_percentiles(file, data, labels, quantiles)
-
-'''
-HD model functions
-'''
-
-def check_mass_balance(run_output):
-    """
-    Calculate mass balance around a run
-
-    Parameters
-    ----------
-    run_output : pandas.Dataframe
-        Output from simulate_trace.
-
-    Returns
-    -------
-    mass_balance : same as values in output
-        DESCRIPTION.
-    """
-    
-    mass_balance = run_output.iloc[0].start_con - run_output.iloc[-1].end_con
-    mass_balance += run_output['inflow'].sum()
-    mass_balance -= run_output['UB_BU'].sum()
-    mass_balance -= run_output['evap'].sum()
-    mass_balance -= run_output['LF_flow'].sum()
-    return mass_balance
-
-def calculate_intervals(data):
-    """
-    Calculate intervals based on spill and curtailment events.
-    
-    The interval includes the year of the curtailment since depletions
-    accumulate in that year.
-    """
-    events = pd.DataFrame(
-        columns=["year", "spill", "curtailment", 
-                 "from_spill", "from_curtailment"]
-    )
-    
-    from_spill = np.nan
-    from_curtailment = np.nan
-    s_intervals = []
-    c_intervals = []
-    
-    row_no = 0
-    for _, row in data.iterrows():
-        spill = row["spill"]
-        curtailment = row["curtailment"]
-
-        if spill > 0 or curtailment > 0:
-            events.at[row_no, "year"] = row["year"]
-            events.at[row_no, "spill"] = spill
-            events.at[row_no, "curtailment"] = curtailment
-
-            if curtailment > 0:
-                events.at[row_no, "from_spill"] = from_spill
-                events.at[row_no, "from_curtailment"] = from_curtailment
-                s_intervals.append(from_spill)
-                c_intervals.append(from_curtailment)
-                from_curtailment = 1
-                from_spill = np.nan
-            
-            if spill > 0:
-                from_spill = 1
-                from_curtailment = np.nan
-        else:
-            from_spill += 1 if not pd.isna(from_spill) else 0
-            from_curtailment += 1 if not pd.isna(from_curtailment) else 0
-        
-        row_no += 1
-
-    return events, s_intervals, c_intervals
-
-def process_single_trace(outputs, run_name, output_path, metadata=''):
-    """
-    Process a single trace of outputs, saving time series and curtailment data.
-    """
-    # Prepare metadata
-    metadata = f"{run_name}\n{metadata}\n"
-    
-    # Write time series CSV
-    ts_file_path = f"{output_path}{run_name}.TS.csv"
-    with open(ts_file_path, 'w', newline='\n') as f:
-        f.write(metadata)
-        outputs.to_csv(f, index=False, lineterminator='')
-    
-    # Calculate intervals
-    events, s_intervals, c_intervals = calculate_intervals(outputs)
-
-    # Analyze spells
-    nested_spells = {}
-    spells = {}
-    characterize_spells(
-        outputs['curtailment'], nested_spells, spells
-    )
-    
-    # Write curtailment data
-    curtailment_file_path = f"{output_path}{run_name}.curtailments.csv"
-    with open(curtailment_file_path, 'w', newline='\n') as outfile:
-        outfile.write(f"Outputs for {run_name}\n")
-        
-        # Write spell information
-        outfile.write(
-            f"Spell information for {run_name}\n"
-            "Discrete spell events\n"
-        )
-        write_spell_dict(outfile, spells)
-        outfile.write("Nested spells\n")
-        write_spell_dict(outfile, nested_spells)
-        
-        # Write curtailment intervals
-        outfile.write(
-            "Curtailment intervals from spill/curtailment\n"
-        )
-        
-        if not s_intervals:
-            outfile.write("Spill: Max: ,--, Min: ,--, Mean: ,--\n")
-        else:
-            outfile.write(
-                f"Spill: Max:,{np.nanmax(s_intervals)}, "
-                f"Min:,{np.nanmin(s_intervals)}, "
-                f"Mean:,{np.nanmean(s_intervals):.2f}\n"
-            )
-        
-        if not c_intervals:
-            outfile.write("Curt.: Max: ,--, Min: ,--, Mean: ,--\n")
-        else:
-            outfile.write(
-                f"Curt.: Max:,{np.nanmax(c_intervals)}, "
-                f"Min:,{np.nanmin(c_intervals)}, "
-                f"Mean:,{np.nanmean(c_intervals):.2f}\n"
-            )
-            
-'''
-Test functions for this module\.
-'''       
-        
-def test_output_utilities(output_path):
-    # Sample data and labels for testing
-    data = (range(0, 1001), range(1, 10))
-    labels = (1, 2)
-    
-    # Test writing percentiles to standard output
-    write_percentiles(sys.stdout, data, labels)
-    
-    # Specify output path (change as needed)
-    write_percentiles(f"{output_path}test_percentiles.csv", data, labels)
-    
-    # Additional test with a subset of data
-    d = (data[1],)
-    write_percentiles(sys.stdout, d, labels)       
-    
-def test_spell_utilities(output_path):
-    
-    test_data = [0, 0, 1, 3, 0, 0, 4, 5, 6, 0, 0, 7, 8, 9, 10,
-                0, 0, 11, 12, 13, 14, 15, 0]
-
-    nested_spell_dict, independent_spell_dict = characterize_spells(test_data)
-
-    print(f'len test data: {len(test_data)}.')
-    print(f'data: {test_data}')
-    print('test data results:')
-    print('****nested spell dict')
-    print(f'correct: 2: {[2.0, 4.5, 5.5, 7.5, 8.5, 9.5, 11.5, 12.5, 12.5, 13.5, 14.5]}')
-    write_spell_dict(sys.stdout, nested_spell_dict, title='nested spells')
-
-    print('\n****independent spell dict')
-    print('correct: {2: [2.0], 3: [5.0], 4: [8.5], 5: [13.0]}')
-    write_spell_dict(sys.stdout, independent_spell_dict, title='independent spells')
-
-    with open(output_path + "test_write_spell_percentiles.csv", "w") as file:
-        quantiles = [10, 25, 50, 75, 90]
-        write_spell_percentiles(file, nested_spell_dict, quantiles, title='nested spell percentiles')
-    
-if __name__ == '__main__':
-
-    output_path = './'
-    test_output_utilities(output_path)
-    test_spell_utilities(output_path)
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Nov 12 17:25:44 2024
+
+@author: Ben Harding
+License: CC BY-SA 4.0, https://creativecommons.org/licenses/by-sa/4.0/
+"""
+import glob
+import hashlib
+import io
+import json
+import os
+import sys
+import tempfile
+
+import pandas as pd
+import numpy as np
+try:
+    import pyarrow
+    import pyarrow.feather
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+from UBWB_model import (event_intervals, simulate_trace, simulate_ensemble,
+                        TriggerPolicy)
+
+"""
+Output Utilities
+"""
+
+# Define default quantiles
+DEFAULT_QUANTILES = [10, 25, 50, 75, 90]
+
+def _percentile_rows(data, quantiles):
+    """
+    Percentiles, max, min and mean of each series in data, ignoring NaNs,
+    as np.nanpercentile, np.nanmax, np.nanmin and np.nanmean give them.
+
+    Each series is sorted, NaNs last, and the sorted series are joined
+    into one array, so the statistics of all of them are found together
+    by indexing.  Returns an array with one row per series, NaN for empty
+    series.
+    """
+    series = [np.sort(np.asarray(values, dtype=np.float64).ravel())
+              for values in data]
+    rows = np.full((len(series), len(quantiles) + 3), np.nan)
+    if not series:
+        return rows
+    lengths = np.array([len(values) for values in series], dtype=np.int64)
+    ordered = np.concatenate(series)
+    missing = np.isnan(ordered)
+    counts = np.bincount(np.repeat(np.arange(len(series)), lengths)[~missing],
+                         minlength=len(series))
+    found = counts > 0
+    if not found.any():
+        return rows
+    offsets = (np.cumsum(lengths) - lengths)[found, None]
+    counts = counts[found, None]
+
+    # Linear interpolation between ranks, as np.percentile does it
+    virtual = (counts - 1) * np.true_divide(quantiles, 100)
+    previous = np.floor(virtual)
+    following = previous + 1
+    last = virtual >= counts - 1
+    # np.percentile takes the last value at these ranks and its gamma,
+    # which decides which way it interpolates, is counted from -1
+    previous[last] = following[last] = -1
+    gamma = virtual - previous
+    previous = np.where(last, counts - 1, previous).astype(np.int64)
+    following = np.where(last, counts - 1, following).astype(np.int64)
+    lower = ordered[offsets + previous]
+    upper = ordered[offsets + following]
+    difference = upper - lower
+    percentiles = np.where(gamma >= 0.5, upper - difference * (1 - gamma),
+                           lower + difference * gamma)
+
+    # np.nanmean sums in the original order of each series
+    sums = np.array([np.nansum(values) for values, present
+                     in zip(data, found) if present], dtype=np.float64)
+
+    rows[found, :len(quantiles)] = percentiles
+    rows[found, -3] = ordered[offsets + counts - 1][:, 0]
+    rows[found, -2] = ordered[offsets][:, 0]
+    rows[found, -1] = sums / counts[:, 0]
+    return rows
+
+
+def percentile_table(data, labels, quantiles=DEFAULT_QUANTILES):
+    """
+    Percentiles, max, min, and mean values of data, as a DataFrame with one
+    row for each series in data, labeled by labels, without writing it.
+
+    data is a collection of series of any lengths, e.g. lists, arrays or
+    the values of a spell dictionary.  QuantileSketches are reported by
+    their approximate percentiles.  NaNs are ignored.
+    """
+    data = list(data)
+    columns = list(quantiles) + ['Max', 'Min', 'Mean']
+    table = np.full((len(data), len(columns)), np.nan)
+    sketches = [isinstance(series, QuantileSketch) for series in data]
+    for i, series in enumerate(data):
+        if sketches[i]:
+            table[i] = series.summary(quantiles)
+    arrays = [i for i, sketch in enumerate(sketches) if not sketch]
+    table[arrays] = _percentile_rows([data[i] for i in arrays], quantiles)
+    return pd.DataFrame(table, index=list(labels)[:len(data)],
+                        columns=columns)
+
+
+def write_percentiles(file, data, labels, quantiles=DEFAULT_QUANTILES):
+    """Write percentiles, max, min, and mean values of data to a CSV file."""
+    # Data is a tuple of lists, arrays or QuantileSketches
+    out_df = percentile_table(data, labels, quantiles)
+    out_df.to_csv(file, lineterminator="\n")
+    return out_df
+
+
+def write_ts_output(file_spec, run_metadata, outputs):
+    """Write metadata and time series outputs to a CSV file."""
+    with open(file_spec, 'w') as file:
+        for key, value in run_metadata.items():
+            file.write(f"{key},{value}\n")
+
+    with open(file_spec, 'a') as file:
+        outputs.to_csv(file, index=False, lineterminator='\n')
+
+"""
+Binary columnar output.  Parquet and Feather files need pyarrow; .npz
+files need only numpy.  Each column is stored with its dtype, and run
+metadata is stored in the file's key/value metadata, so a run can be read
+back, in whole or by columns, without parsing text.
+"""
+COLUMNAR_FORMATS = ('.parquet', '.feather', '.npz')
+# Extension used when the caller does not choose one
+COLUMNAR_EXTENSION = '.npz' if pyarrow is None else '.parquet'
+
+
+def _json_value(value):
+    """JSON form of metadata values json cannot encode itself."""
+    if isinstance(value, TriggerPolicy):
+        return value.to_dict()
+    if callable(value):
+        return value.__name__
+    if isinstance(value, np.generic):
+        return value.item()
+    return str(value)
+
+
+def write_columnar(file_spec, outputs, run_metadata=None):
+    """
+    Write simulate_trace outputs to a binary columnar file.
+
+    The format follows the extension of file_spec, one of
+    COLUMNAR_FORMATS.  run_metadata is a dict, e.g. of the reservoir model,
+    Lees Ferry annual Q, UB demand, PPR volume and trigger of the run.
+    Its values are stored as JSON; callables are stored by name.
+
+    Returns file_spec, or None if the format cannot be written.
+    """
+    extension = os.path.splitext(file_spec)[1]
+    if extension not in COLUMNAR_FORMATS:
+        print('ERROR: Unknown columnar file format')
+        return None
+    if extension != '.npz' and pyarrow is None:
+        print('ERROR: pyarrow is needed to write Parquet or Feather files')
+        return None
+    metadata = {key: json.dumps(value, default=_json_value)
+                for key, value in (run_metadata or {}).items()}
+
+    if extension == '.npz':
+        arrays = {'__columns__': np.array(list(outputs.columns), dtype=str),
+                  '__index__': outputs.index.to_numpy(),
+                  '__metadata__': np.array(json.dumps(metadata))}
+        for i, name in enumerate(outputs.columns):
+            values = outputs[name].array
+            if isinstance(values, pd.arrays.IntegerArray):
+                # Nullable integers are stored as values and a mask
+                arrays[f'__mask__{i}'] = values.isna()
+                values = values.to_numpy(dtype=values.dtype.numpy_dtype,
+                                         na_value=0)
+            arrays[f'{i}'] = np.asarray(values)
+        np.savez(file_spec, **arrays)
+        return file_spec
+
+    table = pyarrow.Table.from_pandas(outputs)
+    table = table.replace_schema_metadata(
+        {**table.schema.metadata,
+         **{f'ubwb.{key}': value for key, value in metadata.items()}})
+    if extension == '.parquet':
+        pyarrow.parquet.write_table(table, file_spec)
+    else:
+        pyarrow.feather.write_feather(table, file_spec)
+    return file_spec
+
+
+def read_columnar(file_spec, columns=None):
+    """
+    Read a file written by write_columnar.
+
+    columns is a list of the columns to read, default all.  Only those
+    columns are read from the file.
+
+    Returns the DataFrame that was written, or its selected columns, with
+    the run metadata in its attrs['run_metadata'].
+    """
+    extension = os.path.splitext(file_spec)[1]
+    if extension not in COLUMNAR_FORMATS:
+        print('ERROR: Unknown columnar file format')
+        return None
+
+    if extension == '.npz':
+        with np.load(file_spec) as archive:
+            names = archive['__columns__'].tolist()
+            data = {}
+            for name in (names if columns is None else columns):
+                i = names.index(name)
+                values = archive[f'{i}']
+                if f'__mask__{i}' in archive.files:
+                    values = pd.arrays.IntegerArray(values,
+                                                    archive[f'__mask__{i}'])
+                data[name] = values
+            frame = pd.DataFrame(data, index=archive['__index__'])
+            metadata = json.loads(archive['__metadata__'].item())
+        if frame.index.equals(pd.RangeIndex(len(frame))):
+            frame.index = pd.RangeIndex(len(frame))
+    else:
+        if pyarrow is None:
+            print('ERROR: pyarrow is needed to read Parquet or Feather files')
+            return None
+        if extension == '.parquet':
+            table = pyarrow.parquet.read_table(file_spec, columns=columns)
+        else:
+            table = pyarrow.feather.read_table(file_spec, columns=columns)
+        frame = table.to_pandas()
+        metadata = {key.decode()[5:]: value.decode()
+                    for key, value in table.schema.metadata.items()
+                    if key.startswith(b'ubwb.')}
+
+    frame.attrs['run_metadata'] = {key: json.loads(value)
+                                   for key, value in metadata.items()}
+    return frame
+
+
+def read_columnar_runs(file_specs, columns=None):
+    """
+    Read selected columns of many columnar files into one DataFrame.
+
+    Rows are stacked in the order of file_specs, with a leading "run"
+    column holding each file's name without its extension.
+    """
+    frames = []
+    for file_spec in file_specs:
+        frame = read_columnar(file_spec, columns)
+        if frame is None:
+            return None
+        frame.insert(0, 'run',
+                     os.path.splitext(os.path.basename(file_spec))[0])
+        frames.append(frame)
+    return pd.concat(frames, ignore_index=True)
+
+
+"""
+Trace input.  Flow traces are parsed once and kept in a cache of NumPy
+files that later loads memory-map.
+"""
+TRACE_CACHE_DIR = os.path.join(tempfile.gettempdir(), 'ubwb_trace_cache')
+TRACE_COLUMNS = ['year', 'flow', 'UB demand']
+
+
+def _write_trace_cache(contents, cache_file):
+    """Parse the contents of a trace CSV and save them as a .npy file."""
+    trace = pd.read_csv(io.BytesIO(contents), comment='#')
+    if 'year' not in trace.columns or 'flow' not in trace.columns:
+        print('ERROR: trace has no "year" or "flow" column')
+        return False
+    names = [name for name in TRACE_COLUMNS if name in trace.columns]
+    if names[-1] != TRACE_COLUMNS[len(names) - 1]:
+        names = names[:2]
+    # One record per year, each column int64 if it holds whole numbers
+    dtypes = []
+    for name in names:
+        values = trace[name].to_numpy(dtype=np.float64)
+        dtypes.append(np.int64 if np.array_equal(values, np.round(values))
+                      else np.float64)
+    columns = np.empty(len(trace), dtype=list(zip(names, dtypes)))
+    for name in names:
+        columns[name] = trace[name]
+
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    # Save under a temporary name so other processes never see a partial
+    # file
+    temporary = f'{cache_file}.{os.getpid()}.tmp'
+    with open(temporary, 'wb') as file:
+        np.save(file, columns)
+    os.replace(temporary, cache_file)
+    return True
+
+
+def load_trace(file_spec, cache_dir=TRACE_CACHE_DIR):
+    """
+    Read a flow trace CSV with columns "year", "flow" and, optionally,
+    "UB demand" through a cache.
+
+    The first load of a file parses it and saves the columns as a typed
+    .npy file in cache_dir, named by hashes of the file's path and
+    contents.  Later loads of the same contents memory-map that file, so
+    they are nearly instant and processes loading the same trace share its
+    pages.  Cache files for earlier contents of the path are removed.
+
+    Returns a DataFrame of the columns, as read-only views of the cache.
+    Each is int64 if all its values are whole numbers and float64 otherwise.
+    Other columns of the CSV are not kept.
+    """
+    with open(file_spec, 'rb') as file:
+        contents = file.read()
+    path_key = hashlib.sha256(
+        os.path.abspath(file_spec).encode()).hexdigest()[:16]
+    content_key = hashlib.sha256(contents).hexdigest()[:16]
+    cache_file = os.path.join(cache_dir, f'{path_key}-{content_key}.npy')
+
+    if not os.path.exists(cache_file):
+        if not _write_trace_cache(contents, cache_file):
+            return None
+        for old_file in glob.glob(os.path.join(cache_dir, f'{path_key}-*.npy')):
+            if old_file != cache_file:
+                os.remove(old_file)
+
+    columns = np.load(cache_file, mmap_mode='r')
+    return pd.DataFrame({name: columns[name] for name in columns.dtype.names},
+                        copy=False)
+
+
+'''
+Spell utilities
+'''
+class QuantileSketch:
+    """
+    Mergeable summary of a stream of values: count, mean, max, min and
+    approximate percentiles.
+
+    Values are counted in logarithmic bins, so a percentile is reported to
+    within relative_accuracy of its value.  Zeros have a bin of their own.
+    Memory depends on the range of the values, not on how many there are.
+    """
+
+    def __init__(self, relative_accuracy=0.01):
+        self.relative_accuracy = relative_accuracy
+        self._log_gamma = np.log((1 + relative_accuracy)
+                                 / (1 - relative_accuracy))
+        self.count = 0
+        self.total = 0.0
+        self.max = np.nan
+        self.min = np.nan
+        self._positive = {}
+        self._negative = {}
+        self._zeros = 0
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else np.nan
+
+    def _bin(self, bins, values):
+        keys, counts = np.unique(
+            np.ceil(np.log(values) / self._log_gamma).astype(np.int64),
+            return_counts=True)
+        for key, count in zip(keys.tolist(), counts.tolist()):
+            bins[key] = bins.get(key, 0) + count
+
+    def add(self, values):
+        """Add an array of values.  NaNs are ignored."""
+        values = np.asarray(values, dtype=np.float64).ravel()
+        values = values[~np.isnan(values)]
+        if not len(values):
+            return self
+        self.count += len(values)
+        self.total += float(values.sum())
+        self.max = float(np.fmax(self.max, values.max()))
+        self.min = float(np.fmin(self.min, values.min()))
+        self._bin(self._positive, values[values > 0])
+        self._bin(self._negative, -values[values < 0])
+        self._zeros += int((values == 0).sum())
+        return self
+
+    def merge(self, other):
+        """Add the values summarized by another sketch of the same accuracy."""
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError('sketches have different accuracies')
+        self.count += other.count
+        self.total += other.total
+        self.max = float(np.fmax(self.max, other.max))
+        self.min = float(np.fmin(self.min, other.min))
+        for bins, other_bins in ((self._positive, other._positive),
+                                 (self._negative, other._negative)):
+            for key, count in other_bins.items():
+                bins[key] = bins.get(key, 0) + count
+        self._zeros += other._zeros
+        return self
+
+    def percentiles(self, quantiles):
+        """Approximate percentiles, interpolated between ranks as
+        np.percentile does."""
+        if not self.count:
+            return np.full(len(quantiles), np.nan)
+        gamma = np.exp(self._log_gamma)
+        # Bins in increasing order of value, each represented by its centre
+        negative = sorted(self._negative)[::-1]
+        positive = sorted(self._positive)
+        centres = np.concatenate((
+            -2 * gamma ** np.array(negative, dtype=np.float64) / (gamma + 1),
+            [0.0],
+            2 * gamma ** np.array(positive, dtype=np.float64) / (gamma + 1)))
+        counts = np.array([self._negative[key] for key in negative]
+                          + [self._zeros]
+                          + [self._positive[key] for key in positive])
+        last_rank = np.cumsum(counts) - 1
+        ranks = np.asarray(quantiles, dtype=np.float64) / 100 * (self.count
+                                                                 - 1)
+
+        def value(rank):
+            return centres[np.searchsorted(last_rank, rank)]
+
+        lower = np.floor(ranks)
+        fraction = ranks - lower
+        values = ((1 - fraction) * value(lower)
+                  + fraction * value(np.minimum(lower + 1, self.count - 1)))
+        return np.clip(values, self.min, self.max)
+
+    def summary(self, quantiles):
+        """Percentiles, max, min and mean, as write_percentiles reports."""
+        return [*self.percentiles(quantiles), self.max, self.min, self.mean]
+
+
+class EnsembleStatistics(QuantileSketch):
+    """
+    QuantileSketch that also counts the values exceeding thresholds, for
+    summarizing the curtailments, or other outputs, of an ensemble as its
+    traces are run, without keeping them.
+
+    Values can be added a trace or a batch of traces at a time, and the
+    statistics of ensembles run in different processes merged.  Counts,
+    max, min, exceedances and percentile bins merge exactly.  The total
+    behind the mean is a floating-point sum, exact for whole acre-feet.
+    write_percentiles and percentile_table report it as a QuantileSketch.
+    """
+
+    def __init__(self, thresholds=(), relative_accuracy=0.01):
+        super().__init__(relative_accuracy)
+        self.thresholds = np.sort(np.asarray(thresholds, dtype=np.float64))
+        self.exceedances = np.zeros(len(self.thresholds), dtype=np.int64)
+
+    def add(self, values):
+        """Add an array of values of any shape.  NaNs are ignored."""
+        values = np.asarray(values, dtype=np.float64).ravel()
+        values = np.sort(values[~np.isnan(values)])
+        # Values above each threshold
+        self.exceedances += len(values) - np.searchsorted(
+            values, self.thresholds, side='right')
+        return super().add(values)
+
+    def merge(self, other):
+        """Add the values summarized by statistics with the same thresholds
+        and accuracy."""
+        if not np.array_equal(other.thresholds, self.thresholds):
+            raise ValueError('statistics have different thresholds')
+        self.exceedances += other.exceedances
+        return super().merge(other)
+
+    def exceedance_table(self):
+        """
+        Count and fraction of the values above each threshold, as a
+        DataFrame indexed by threshold.
+        """
+        return pd.DataFrame(
+            {'Count': self.exceedances,
+             'Probability': (self.exceedances / self.count if self.count
+                             else np.full(len(self.thresholds), np.nan))},
+            index=pd.Index(self.thresholds, name='Threshold'))
+
+
+def fan_chart_columns(nyrs=10):
+    """Outputs banded by FanChart by default, for runs with nyrs."""
+    return ['end_con', 'LF_flow', f'LF_{nyrs}yr_flows', 'curtailment']
+
+
+class FanChart:
+    """
+    Percentile bands of ensemble outputs for each year of simulation, and
+    the probability of curtailment in each year, built up as traces are
+    run without keeping them.
+
+    Each year of each column is summarized by a QuantileSketch, so memory
+    depends on the number of years, not the number of traces.  Fan charts
+    of ensembles run in different processes can be merged.
+
+    columns are the outputs to band, default fan_chart_columns(nyrs), where
+    nyrs is that of the runs.
+    """
+
+    def __init__(self, columns=None, relative_accuracy=0.01, nyrs=10):
+        if columns is None:
+            columns = fan_chart_columns(nyrs)
+        self.columns = list(columns)
+        self.relative_accuracy = relative_accuracy
+        self.years = []
+        self._sketches = {column: [] for column in self.columns}
+        self.curtailed = np.zeros(0, dtype=np.int64)
+        self.traces = np.zeros(0, dtype=np.int64)
+
+    def _extend(self, n_years, years=None):
+        """Make room for n_years years, labeled by years if given."""
+        for sketches in self._sketches.values():
+            sketches.extend(QuantileSketch(self.relative_accuracy)
+                            for _ in range(n_years - len(sketches)))
+        if n_years > len(self.years):
+            self.years.extend(range(len(self.years), n_years)
+                              if years is None
+                              else np.asarray(years)[len(self.years):n_years]
+                              .tolist())
+        extra = n_years - len(self.traces)
+        if extra > 0:
+            self.curtailed = np.concatenate(
+                (self.curtailed, np.zeros(extra, dtype=np.int64)))
+            self.traces = np.concatenate(
+                (self.traces, np.zeros(extra, dtype=np.int64)))
+
+    def add(self, outputs):
+        """
+        Add the outputs of one trace, as simulate_trace returns them, or
+        of a batch, as simulate_ensemble returns them.  Years are counted
+        from the start of each trace and labeled by the "year" values of
+        the first traces to reach them.
+        """
+        curtailment = np.atleast_2d(np.asarray(outputs['curtailment'],
+                                               dtype=np.float64))
+        n_years = curtailment.shape[1]
+        years = None
+        if 'year' in outputs:
+            years = np.asarray(outputs['year'])
+            years = years[0] if years.ndim == 2 else years
+        self._extend(n_years, years)
+        for column in self.columns:
+            values = np.atleast_2d(np.asarray(outputs[column],
+                                              dtype=np.float64))
+            sketches = self._sketches[column]
+            for year in range(n_years):
+                sketches[year].add(values[:, year])
+        self.curtailed[:n_years] += (curtailment > 0).sum(axis=0)
+        self.traces[:n_years] += (~np.isnan(curtailment)).sum(axis=0)
+        return self
+
+    def merge(self, other):
+        """Add the traces summarized by another fan chart of the same
+        columns and accuracy."""
+        if (other.columns != self.columns
+                or other.relative_accuracy != self.relative_accuracy):
+            raise ValueError('fan charts have different columns or accuracy')
+        self._extend(len(other.years), other.years)
+        for column in self.columns:
+            for sketch, other_sketch in zip(self._sketches[column],
+                                            other._sketches[column]):
+                sketch.merge(other_sketch)
+        n_years = len(other.years)
+        self.curtailed[:n_years] += other.curtailed
+        self.traces[:n_years] += other.traces
+        return self
+
+    def curtailment_probability(self):
+        """Fraction of traces with curtailment in each year."""
+        with np.errstate(invalid='ignore'):
+            return pd.Series(self.curtailed / self.traces, index=self.years,
+                             name='Probability')
+
+    def tables(self, quantiles=DEFAULT_QUANTILES):
+        """
+        The bands of each column, as a dict of DataFrames with one row per
+        year laid out as write_percentiles writes them.
+        """
+        return {column: percentile_table(self._sketches[column], self.years,
+                                         quantiles)
+                for column in self.columns}
+
+    def write(self, output_path, run_name, quantiles=DEFAULT_QUANTILES):
+        """
+        Write the bands of each column to {run_name}.{column}.bands.csv and
+        the probability of curtailment to
+        {run_name}.curtailment_probability.csv.
+        """
+        for column in self.columns:
+            write_percentiles(f'{output_path}{run_name}.{column}.bands.csv',
+                              self._sketches[column], self.years, quantiles)
+        self.curtailment_probability().to_csv(
+            f'{output_path}{run_name}.curtailment_probability.csv',
+            index_label='year', lineterminator="\n")
+
+
+def _add_spells(spell_dict, duration, means, summary):
+    """Add the means of spells of one duration to a spell dictionary."""
+    if summary:
+        spell_dict.setdefault(duration, QuantileSketch()).add(means)
+    elif duration in spell_dict:
+        spell_dict[duration] = np.concatenate(
+            (np.asarray(spell_dict[duration], dtype=np.float64), means))
+    else:
+        spell_dict[duration] = means
+
+
+def characterize_spells(data, n_spell_dict=None, i_spell_dict=None,
+                        summary=False):
+    """
+    Function to analyze spells of events in a series.
+    
+    Arguments:
+        data: list or Pandas series containing an ordered sequence
+              of positive excursions and zeros.
+        n_spell_dict (opt): dictionary holding nested spells keyed by duration.
+        i_spell_dict (opt): dictionary holding independent spells keyed by duration.
+        summary (opt): if True, keep a QuantileSketch of the spells of each
+              duration instead of every spell.
+    
+    Returns:
+        n_spell_dict, i_spell_dict
+
+    Events are positive excursions from zero, so for conventional
+    analysis of precipitation or streamflow spells the time series
+    must be normalized by subtracting the time-series values from the 
+    time-series mean.
+
+    Spells are reported by the average value of the excursions over the 
+    duration of the spell.  The spells of each duration are held in a NumPy
+    array, in the order they occur.  Dictionaries passed in from an earlier
+    call are added to.
+
+    Two types of spells are characterized: conventional independent spells
+    and 'nested' spells (spells of all durations contained within independent spells).
+    """
+    if n_spell_dict is None:
+        n_spell_dict = {}
+    if i_spell_dict is None:
+        i_spell_dict = {}
+
+    values = np.asarray(data)  # will accept a series
+    if values.dtype.kind not in 'iu':
+        values = values.astype(np.float64)
+    events = values != 0
+    if not events.any():
+        return n_spell_dict, i_spell_dict
+
+    # Independent spells are the runs of events.  Each is summed on its
+    # own, so a NaN or a large value does not affect other spells.
+    edges = np.diff(np.concatenate(([0], events, [0])).astype(np.int8))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+    durations = ends - starts
+    # Sums run to the next start, past zeros only
+    means = np.add.reduceat(values, starts) / durations
+    # Catalog durations in the order they first occur
+    unique_durations, first = np.unique(durations, return_index=True)
+    for duration in unique_durations[np.argsort(first)].tolist():
+        _add_spells(i_spell_dict, duration, means[durations == duration],
+                    summary)
+
+    # Nested spells of each duration start at every event far enough from
+    # the end of its independent spell.  Their sums are running sums from
+    # each start, one event longer for each duration.
+    spell_starts = np.flatnonzero(events)
+    spell_ends = np.repeat(ends, durations)
+    sums = np.zeros(len(spell_starts), dtype=values.dtype)
+    for nested_duration in range(1, durations.max() + 1):
+        fits = spell_starts + nested_duration <= spell_ends
+        spell_starts, spell_ends = spell_starts[fits], spell_ends[fits]
+        sums = sums[fits] + values[spell_starts + nested_duration - 1]
+        _add_spells(n_spell_dict, nested_duration, sums / nested_duration,
+                    summary)
+
+    return n_spell_dict, i_spell_dict
+
+
+def write_spell_dict(file, spell_dict, title=None):
+    """Writes each duration on one line.  Summarized spells are written
+    without their values."""
+    if title:
+        file.write(f"{title}\n")
+    file.write('Duration,count,mean\n')
+    for key, values in sorted(spell_dict.items()):
+        if isinstance(values, QuantileSketch):
+            file.write(f"{key},{values.count},{values.mean}\n")
+            continue
+        values = np.asarray(values).tolist()
+        values_str = ",".join(map(str, values))
+        file.write(f"{key},{len(values)},{sum(values)/len(values)}, {values_str}\n")
+
+
+def write_spell_percentiles(file, spell_dict, quantiles, title=None):
+    """Writes percentiles for each spell duration."""
+    labels = list(spell_dict.keys())
+    data = list(spell_dict.values())
+    if title:
+        file.write(f"{title}\n")
+    write_percentiles(file, data, labels, quantiles)
+
+'''
+HD model functions
+'''
+
+def check_mass_balance(run_output):
+    """
+    Calculate mass balance around a run
+
+    Parameters
+    ----------
+    run_output : pandas.Dataframe or dict of arrays
+        Output from simulate_trace.
+
+    Returns
+    -------
+    mass_balance : same as values in output
+        DESCRIPTION.
+    """
+    
+    mass_balance = (np.asarray(run_output['start_con'])[0]
+                    - np.asarray(run_output['end_con'])[-1])
+    mass_balance += run_output['inflow'].sum()
+    mass_balance -= run_output['UB_BU'].sum()
+    mass_balance -= run_output['evap'].sum()
+    mass_balance -= run_output['LF_flow'].sum()
+    return mass_balance
+
+def calculate_intervals(data):
+    """
+    Calculate intervals based on spill and curtailment events.
+    
+    The interval includes the year of the curtailment since depletions
+    accumulate in that year.
+
+    data is a simulate_trace DataFrame or dict of arrays.  Intervals are
+    found by UBWB_model.event_intervals unless data already holds
+    "from_spill" and "from_curtailment" columns from a run with
+    intervals=True.
+    """
+    spill = np.asarray(data["spill"])
+    curtailment = np.asarray(data["curtailment"])
+    if "from_spill" in data and "from_curtailment" in data:
+        from_spill, from_curtailment = (
+            pd.array(data[name]).to_numpy(dtype=np.float64, na_value=np.nan)
+            for name in ("from_spill", "from_curtailment"))
+    else:
+        from_spill, from_curtailment = event_intervals(spill, curtailment)
+
+    rows = np.flatnonzero((spill > 0) | (curtailment > 0))
+    curtailed = curtailment[rows] > 0
+    events = pd.DataFrame(
+        {"year": np.asarray(data["year"])[rows],
+         "spill": spill[rows],
+         "curtailment": curtailment[rows],
+         "from_spill": np.where(curtailed, from_spill[rows], np.nan),
+         "from_curtailment": np.where(curtailed, from_curtailment[rows],
+                                      np.nan)},
+        index=rows)
+
+    # Years are counted in whole numbers, NaN where there is no interval
+    s_intervals, c_intervals = (
+        [np.nan if np.isnan(value) else int(value)
+         for value in intervals[rows[curtailed]].tolist()]
+        for intervals in (from_spill, from_curtailment))
+    return events, s_intervals, c_intervals
+
+def process_single_trace(outputs, run_name, output_path, metadata='',
+                         ts_format='.csv'):
+    """
+    Process a single trace of outputs, saving time series and curtailment data.
+
+    ts_format is '.csv' or one of COLUMNAR_FORMATS.  In a columnar file
+    each "key,value" line of metadata becomes a metadata entry, along with
+    run_name.
+    """
+    if ts_format != '.csv':
+        run_metadata = {'run_name': run_name}
+        run_metadata.update(line.split(',', 1)
+                            for line in metadata.splitlines() if ',' in line)
+        write_columnar(f"{output_path}{run_name}.TS{ts_format}", outputs,
+                       run_metadata)
+    else:
+        # Prepare metadata
+        metadata = f"{run_name}\n{metadata}\n"
+
+        # Write time series CSV
+        ts_file_path = f"{output_path}{run_name}.TS.csv"
+        with open(ts_file_path, 'w', newline='\n') as f:
+            f.write(metadata)
+            outputs.to_csv(f, index=False, lineterminator='')
+    
+    # Calculate intervals
+    events, s_intervals, c_intervals = calculate_intervals(outputs)
+
+    # Analyze spells
+    nested_spells = {}
+    spells = {}
+    characterize_spells(
+        outputs['curtailment'], nested_spells, spells
+    )
+    
+    # Write curtailment data
+    curtailment_file_path = f"{output_path}{run_name}.curtailments.csv"
+    with open(curtailment_file_path, 'w', newline='\n') as outfile:
+        outfile.write(f"Outputs for {run_name}\n")
+        
+        # Write spell information
+        outfile.write(
+            f"Spell information for {run_name}\n"
+            "Discrete spell events\n"
+        )
+        write_spell_dict(outfile, spells)
+        outfile.write("Nested spells\n")
+        write_spell_dict(outfile, nested_spells)
+        
+        # Write curtailment intervals
+        outfile.write(
+            "Curtailment intervals from spill/curtailment\n"
+        )
+        
+        if not s_intervals:
+            outfile.write("Spill: Max: ,--, Min: ,--, Mean: ,--\n")
+        else:
+            outfile.write(
+                f"Spill: Max:,{np.nanmax(s_intervals)}, "
+                f"Min:,{np.nanmin(s_intervals)}, "
+                f"Mean:,{np.nanmean(s_intervals):.2f}\n"
+            )
+        
+        if not c_intervals:
+            outfile.write("Curt.: Max: ,--, Min: ,--, Mean: ,--\n")
+        else:
+            outfile.write(
+                f"Curt.: Max:,{np.nanmax(c_intervals)}, "
+                f"Min:,{np.nanmin(c_intervals)}, "
+                f"Mean:,{np.nanmean(c_intervals):.2f}\n"
+            )
+            
+'''
+Test functions for this module\.
+'''       
+        
+def test_output_utilities(output_path):
+    # Sample data and labels for testing
+    data = (range(0, 1001), range(1, 10))
+    labels = (1, 2)
+    
+    # Test writing percentiles to standard output
+    write_percentiles(sys.stdout, data, labels)
+    
+    # Specify output path (change as needed)
+    write_percentiles(f"{output_path}test_percentiles.csv", data, labels)
+    
+    # Additional test with a subset of data
+    d = (data[1],)
+    write_percentiles(sys.stdout, d, labels)       
+
+    # The same table without writing it
+    print(percentile_table(data, labels))
+
+def test_columnar_output(output_path):
+    input_data = pd.DataFrame({'year': range(2000, 2020),
+                               'flow': 10 * [14000000, 6000000]})
+    outputs = simulate_trace(input_data, ub_demand=5790000)
+    file_spec = write_columnar(
+        f"{output_path}test_columnar{COLUMNAR_EXTENSION}", outputs,
+        {'res_model': 'active', 'ub_demand': 5790000, 'trigger': None})
+    copy = read_columnar(file_spec)
+    print(f"columnar copy equals outputs: {copy.equals(outputs)}, "
+          f"metadata: {copy.attrs['run_metadata']}")
+    print(read_columnar(file_spec, ['year', 'end_con']).head())
+
+def test_ensemble_statistics(output_path):
+    rng = np.random.default_rng(2010)
+    curtailments = np.maximum(rng.normal(0, 1e6, (40, 100)), 0).round()
+    # Two workers' statistics, one fed trace by trace, one in a batch
+    first = EnsembleStatistics(thresholds=[0, 5e5, 1e6])
+    for trace in curtailments[:25]:
+        first.add(trace)
+    second = EnsembleStatistics(thresholds=[0, 5e5, 1e6])
+    second.add(curtailments[25:])
+    first.merge(second)
+    print(first.exceedance_table())
+    print(f"exact exceedances: "
+          f"{[int((curtailments > t).sum()) for t in first.thresholds]}")
+    write_percentiles(sys.stdout, (first, curtailments),
+                      ('streamed', 'exact'))
+
+def test_fan_chart(output_path):
+    rng = np.random.default_rng(2026)
+    flows = np.maximum(rng.normal(13000000, 4000000, (24, 50)), 0).round()
+    years = np.arange(2026, 2076)
+    # Half the traces in a batch, the rest one at a time into a second
+    # fan chart, as two worker processes might
+    fan_chart = FanChart().add(simulate_ensemble(
+        flows[:12], years=years, ub_demand=5790000, ppr_volume=2317000))
+    other = FanChart()
+    for trace in flows[12:]:
+        other.add(simulate_trace(pd.DataFrame({'year': years, 'flow': trace}),
+                                 ub_demand=5790000, ppr_volume=2317000))
+    fan_chart.merge(other)
+    print(fan_chart.tables()['end_con'].head())
+    print(fan_chart.curtailment_probability().head())
+    outputs = simulate_ensemble(flows, years=years, ub_demand=5790000,
+                                ppr_volume=2317000)
+    exact = (outputs['curtailment'] > 0).mean(axis=0)
+    print(f"exact curtailment probability matches: "
+          f"{np.allclose(exact, fan_chart.curtailment_probability())}")
+    fan_chart.write(output_path, 'test_fan_chart')
+
+    # Runs with another compact accumulation period
+    fan_chart = FanChart(nyrs=20).add(simulate_ensemble(
+        flows, years=years, nyrs=20, ub_demand=5790000, ppr_volume=2317000))
+    print(f"20-year fan chart columns: {list(fan_chart.tables())}")
+    
+def test_spell_utilities(output_path):
+    
+    test_data = [0, 0, 1, 3, 0, 0, 4, 5, 6, 0, 0, 7, 8, 9, 10,
+                0, 0, 11, 12, 13, 14, 15, 0]
+
+    nested_spell_dict, independent_spell_dict = characterize_spells(test_data)
+
+    print(f'len test data: {len(test_data)}.')
+    print(f'data: {test_data}')
+    print('test data results:')
+    print('****nested spell dict')
+    print(f'correct: 2: {[2.0, 4.5, 5.5, 7.5, 8.5, 9.5, 11.5, 12.5, 12.5, 13.5, 14.5]}')
+    write_spell_dict(sys.stdout, nested_spell_dict, title='nested spells')
+
+    print('\n****independent spell dict')
+    print('correct: {2: [2.0], 3: [5.0], 4: [8.5], 5: [13.0]}')
+    write_spell_dict(sys.stdout, independent_spell_dict, title='independent spells')
+
+    with open(output_path + "test_write_spell_percentiles.csv", "w") as file:
+        quantiles = [10, 25, 50, 75, 90]
+        write_spell_percentiles(file, nested_spell_dict, quantiles, title='nested spell percentiles')
+
+    print('\n****nested spell summaries')
+    nested_summaries, _ = characterize_spells(test_data, summary=True)
+    write_spell_dict(sys.stdout, nested_summaries, title='nested spells')
+    write_spell_percentiles(sys.stdout, nested_summaries, [10, 50, 90])
+
+    # Spells are summed separately: a NaN or a large value in one spell
+    # does not change the others
+    nested_spell_dict, independent_spell_dict = characterize_spells(
+        [0, 5, np.nan, 0, 3, 4, 0, 7])
+    print('\n****spells with a NaN')
+    print('correct: {2: [nan, 3.5], 1: [7.0]}, nested 1: [5.0, nan, 3.0, '
+          '4.0, 7.0], 2: [nan, 3.5]')
+    print(independent_spell_dict, nested_spell_dict)
+    _, independent_spell_dict = characterize_spells([0, 1e15, 0, 0.1, 0.2])
+    print(f'float spell mean: {independent_spell_dict[2]}, correct: 0.15')
+
+if __name__ == '__main__':
+
+    output_path = './'
+    test_output_utilities(output_path)
+    test_spell_utilities(output_path)
+    test_columnar_output(output_path)
+    test_ensemble_statistics(output_path)
+    test_fan_chart(output_path)
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""
+Yield determination for the Upper Basin Water Balance model.
+
+The yield of a trace is the largest Upper Basin demand, or Lee Ferry
+annual delivery, that the trace can support without curtailment, or
+without any year's curtailment exceeding a tolerance.
+
+License: CC BY-SA 4.0, https://creativecommons.org/licenses/by-sa/4.0/
+"""
+import numpy as np
+import pandas as pd
+
+from UBWB_model import simulate_trace
+
+YIELD_PARAMETERS = ('ub_demand', 'lees_ferry_ann_q')
+
+
+def _trial(input_data, parameter, value, tolerance, kwargs, cache=None):
+    """
+    Run one trial value, stopping at the first year whose curtailment
+    exceeds the tolerance.  Returns whether the value is feasible and a
+    margin, the least water available to store plus the tolerance, which
+    is positive for values comfortably below the yield.
+    """
+    simulate = simulate_trace if cache is None else cache.simulate_trace
+    outputs = simulate(input_data, as_arrays=True,
+                       stop_curtailment=tolerance,
+                       **{parameter: value}, **kwargs)
+    feasible = not (outputs['curtailment'] > tolerance).any()
+    return feasible, outputs['net_avail'].min() + tolerance
+
+
+def find_yield(input_data, parameter='ub_demand', tolerance=0, bracket=None,
+               resolution=1000, max_trials=60, cache=None, **kwargs):
+    """
+    Find the largest value of parameter for which no year's curtailment
+    exceeds tolerance.
+
+    input_data is as for simulate_trace.  It must not have a "UB demand"
+        column when parameter is 'ub_demand'.
+    parameter is 'ub_demand' or 'lees_ferry_ann_q'.
+    bracket is a (low, high) first guess, e.g. the yield of a similar
+        trace give or take a margin.  It is widened if it does not contain
+        the yield.  Default is zero to the mean flow.
+    resolution is the width, in acre-feet, to which the yield is refined.
+    cache is a UBWB_model_cache.RunCache to take repeated trials from.
+    kwargs are other simulate_trace arguments, e.g. ppr_volume or engine.
+
+    The search narrows a bracket with secant steps on the margin, falling
+    back to bisection when a secant step does not halve the bracket.
+    Infeasible trials stop at the first excessive curtailment.
+
+    Returns a dict with 'yield', the largest feasible value found,
+    'infeasible', the smallest infeasible value found, and 'trials'.
+    """
+    if parameter not in YIELD_PARAMETERS:
+        print('ERROR: Unknown yield parameter')
+        return None
+    if parameter == 'ub_demand' and 'UB demand' in input_data.columns:
+        print('ERROR: input_data has a UB demand column')
+        return None
+    if bracket is None:
+        bracket = (0, int(input_data['flow'].mean()))
+    low, high = (int(round(value)) for value in bracket)
+    width = max(high - low, resolution)
+    trials = 0
+
+    def trial(value):
+        nonlocal trials
+        trials += 1
+        return _trial(input_data, parameter, value, tolerance, kwargs, cache)
+
+    # Widen the bracket until low is feasible and high is not
+    feasible, low_margin = trial(low)
+    while not feasible:
+        high, high_margin = low, low_margin
+        if low == 0:
+            return {'yield': None, 'infeasible': 0, 'trials': trials}
+        low = max(0, low - width)
+        width *= 2
+        feasible, low_margin = trial(low)
+    feasible, high_margin = trial(high)
+    while feasible:
+        low, low_margin = high, high_margin
+        high = low + width
+        width *= 2
+        if trials >= max_trials:
+            return {'yield': low, 'infeasible': None, 'trials': trials}
+        feasible, high_margin = trial(high)
+
+    # Narrow it
+    bisect = False
+    while high - low > resolution and trials < max_trials:
+        width = high - low
+        if not bisect and low_margin > 0 > high_margin:
+            value = low + width * low_margin / (low_margin - high_margin)
+        else:
+            value = (low + high) / 2
+        # Keep the trial inside the bracket
+        value = int(round(min(max(value, low + resolution / 2),
+                              high - resolution / 2)))
+        feasible, margin = trial(value)
+        if feasible:
+            low, low_margin = value, margin
+        else:
+            high, high_margin = value, margin
+        bisect = high - low > width / 2
+    return {'yield': low, 'infeasible': high, 'trials': trials}
+
+
+def find_yields(traces, parameter='ub_demand', tolerance=0, margin=250000,
+                **kwargs):
+    """
+    find_yield for each of a set of traces.
+
+    traces is a dict of names to simulate_trace input DataFrames, or a list
+        of DataFrames named by position.
+    Each search after the first starts from the previous yield plus or
+    minus margin acre-feet, which saves trials when traces are similar.
+    kwargs are passed to find_yield.
+
+    Returns a DataFrame with one row per trace.
+    """
+    if not isinstance(traces, dict):
+        traces = dict(enumerate(traces))
+    rows = []
+    bracket = kwargs.pop('bracket', None)
+    for trace_name, input_data in traces.items():
+        result = find_yield(input_data, parameter, tolerance,
+                            bracket=bracket, **kwargs)
+        rows.append({'trace': trace_name, **result})
+        if result['yield'] is not None and result['infeasible'] is not None:
+            bracket = (max(0, result['yield'] - margin),
+                       result['infeasible'] + margin)
+    return pd.DataFrame(rows)
+
+
+'''
+Test functions for this module.
+'''
+
+def test_find_yield(data_path):
+    data_file = "meko_et_al_2007_762_2005_trace.csv"
+    meko_flows = pd.read_csv(f"{data_path}{data_file}", comment="#")
+
+    result = find_yield(meko_flows, ppr_volume=2317000)
+    print(f"Meko 2007 UB yield: {result}")
+    for value in (result['yield'], result['infeasible']):
+        outputs = simulate_trace(meko_flows, ub_demand=value,
+                                 ppr_volume=2317000, as_arrays=True)
+        print(f"UB demand {value}: "
+              f"max curtailment {np.max(outputs['curtailment'])}")
+
+    traces = [meko_flows.iloc[i:i + 100] for i in range(0, 1200, 100)]
+    print(find_yields(traces, ppr_volume=2317000).to_string())
+
+
+if __name__ == '__main__':
+
+    data_path = './input data/'
+    test_find_yield(data_path)